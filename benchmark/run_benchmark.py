@@ -0,0 +1,209 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Offline benchmark of plugin workflows
+#
+# Plugin operations are run against a simulated host (see simulator.py) with synthetic
+# databases and backup locations, and for every operation wall time, number of round trips,
+# time spent on host and time of parsing sqlcmd output are reported.
+#
+# It has to be run with the plugin Python (2.7) and vSDK installed, after definitions
+# are generated (dvp build -g), from plugin directory:
+#
+#   python benchmark/run_benchmark.py --files 10,200,2000 --backups 10,1000,10000
+#
+# Only a local bash and standard tools (find, sed, stat) are used on simulated host
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[0:0] = [ os.path.join(ROOT, "src"), os.path.dirname(os.path.abspath(__file__)) ]
+
+from dlpx.virtualization import libs
+from dlpx.virtualization.common import RemoteConnection
+from dlpx.virtualization.common import RemoteEnvironment
+from dlpx.virtualization.common import RemoteHost
+from dlpx.virtualization.common import RemoteUser
+
+from controller import tracing
+import controller.db_object
+from mssql.mssql_ctl import mssql_ctl
+from operations import linked
+from operations import virtual
+
+import simulator
+
+
+DATABASE = "benchdb"
+
+# log backups added between resync and pre_snapshot
+NEW_BACKUPS = 10
+
+
+class parameters(object):
+    """
+    Plain object with attributes used instead of vSDK generated definitions
+    """
+
+    def __init__(self, **kargs):
+        self.__dict__.update(kargs)
+
+
+class parse_timer(object):
+    """
+    Measure time spent in parsing methods of mssql_ctl
+    """
+
+    METHODS = [ "parse_backup_headers", "parse_file_row" ]
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.originals = {}
+
+
+    def wrap(self, name):
+        original = getattr(mssql_ctl, name)
+        self.originals[name] = original
+        timer = self
+
+        def timed(*args, **kargs):
+            start = time.time()
+            try:
+                return original(*args, **kargs)
+            finally:
+                timer.seconds = timer.seconds + time.time() - start
+        setattr(mssql_ctl, name, timed)
+
+
+    def __enter__(self):
+        for name in self.METHODS:
+            self.wrap(name)
+        return self
+
+
+    def __exit__(self, *args):
+        for (name, original) in self.originals.items():
+            setattr(mssql_ctl, name, original)
+
+
+def connection():
+    host = RemoteHost(name="sim", reference="SIM-HOST", binary_path="/tmp", scratch_path="/tmp")
+    environment = RemoteEnvironment(name="sim", reference="SIM-ENV", host=host)
+    return RemoteConnection(environment=environment, user=RemoteUser(name="sim", reference="SIM-USER"))
+
+
+def repository(sim):
+    return parameters(uid=os.getuid(), gid=os.getgid(), client_path=sim.client_path, rdbms_path="/opt/mssql/bin",
+                      conf_path=os.path.join(sim.root, "mssql.conf"),
+                      version=simulator.SIM_VERSION, pretty_name="sim", prettyName="sim")
+
+
+def staged_source(sim):
+    return parameters(staged_connection=connection(), parameters=parameters(
+        backup_location=sim.backup_location, backup_pattern="*.bak", mount_path=os.path.join(sim.root, "mnt", "staging"),
+        instance_user="sa", instance_password="sim", for_upgrade=False, sqlcmd_session=False,
+        header_probe_parallelism=4, restore_tuning_mode="default", restore_stats_percent=10))
+
+
+def virtual_source(sim, name):
+    return parameters(connection=connection(), parameters=parameters(
+        database_name=name, mount_path=os.path.join(sim.root, "mnt", name), instance_user="sa",
+        instance_password="sim", sqlcmd_session=False))
+
+
+def snapshot(sim, attachable):
+    db_files = [ { "logicalname": name, "physicalname": physical, "filetype": filetype, "groupname": group or "NULL",
+                   "fileid": fileid } for (name, physical, filetype, group, fileid) in sim.files ]
+    return parameters(db_files=json.dumps(db_files), backup_time="2020-01-01 00:00:00",
+                      mssql_version=simulator.SIM_VERSION, attachable=attachable)
+
+
+def measure(name, function, *args):
+    """
+    Run function as plugin operation and return a result row
+    """
+    with parse_timer() as timer:
+        start = time.time()
+        with tracing.trace_operation(name) as trace:
+            function(*args)
+        wall = time.time() - start
+    return {
+        "operation": name,
+        "wall": wall,
+        "round_trips": len(trace.spans),
+        "host": sum([ x.seconds for x in trace.spans ]),
+        "parse": timer.seconds
+    }
+
+
+def run_scenario(files, backups, latency, sql_latency):
+    """
+    Run all operations for a database with files files and backups backup files
+    """
+    root = tempfile.mkdtemp(prefix="dlpx_bench.")
+    try:
+        sim = simulator.world(root, DATABASE, files, sql_latency)
+        sim.add_backups(backups)
+        host = simulator.host(latency)
+        libs.run_bash = host.run_bash
+
+        repo = repository(sim)
+        staged = staged_source(sim)
+        source_config = parameters(database_name=DATABASE)
+
+        results = []
+        results.append(measure("linked.resync", linked.resync, staged, repo, source_config))
+        sim.add_backups(NEW_BACKUPS)
+        results.append(measure("linked.pre_snapshot", linked.pre_snapshot, staged, repo, source_config))
+        results.append(measure("linked.staging_status", linked.staging_status, staged, repo, source_config))
+        # second status check is using host-wide state cache
+        results.append(measure("linked.staging_status (cached)", linked.staging_status, staged, repo, source_config))
+        results.append(measure("virtual.configure (attach)", virtual.configure,
+                               virtual_source(sim, "vdb_attach"), snapshot(sim, True), repo))
+        results.append(measure("virtual.configure (seed)", virtual.configure,
+                               virtual_source(sim, "vdb_seed"), snapshot(sim, False), repo))
+        results.append(measure("virtual.vdb_status", virtual.vdb_status,
+                               virtual_source(sim, "vdb_attach"), repo, parameters(database_name="vdb_attach")))
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plugin operations against a simulated host")
+    parser.add_argument("--files", default="10,200,2000", help="comma separated numbers of database files")
+    parser.add_argument("--backups", default="10,1000,10000", help="comma separated numbers of backup files")
+    parser.add_argument("--latency", type=float, default=0.005, help="round trip latency in seconds")
+    parser.add_argument("--sql-latency", type=float, default=0.0, help="latency of every sqlcmd call in seconds")
+    parser.add_argument("--poll-wait", type=int, default=1, help="wait of background command poll in seconds")
+    parser.add_argument("--json", help="save results into JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # background restores are finished immediately on simulated host
+    controller.db_object.POLL_WAIT = args.poll_wait
+
+    all_results = []
+    print("{:>6} {:>7}  {:<32} {:>9} {:>7} {:>9} {:>9}".format("files", "backups", "operation", "wall[s]", "trips", "host[s]", "parse[s]"))
+    for files in [ int(x) for x in args.files.split(",") ]:
+        for backups in [ int(x) for x in args.backups.split(",") ]:
+            for result in run_scenario(files, backups, args.latency, args.sql_latency):
+                result.update({ "files": files, "backups": backups })
+                all_results.append(result)
+                print("{files:>6} {backups:>7}  {operation:<32} {wall:>9.3f} {round_trips:>7} {host:>9.3f} {parse:>9.3f}".format(**result))
+                sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Simulated host for plugin benchmark (see run_benchmark.py)
+#
+# dlpx.virtualization.libs.run_bash is replaced by run_bash from this module, which runs
+# commands with local bash after a configurable round trip latency.
+# sqlcmd is replaced by a stand-in script generated into world directory:
+# - RESTORE LABELONLY / HEADERONLY output is a content of synthetic backup file
+# - RESTORE FILELISTONLY and sys.database_files output is prepared once for a database
+# - other statements (restore, create, drop, status queries, batch markers) are run by
+#   "python simulator.py sqlcmd <world>" against a database state saved in world/state.json
+
+import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+FIELD_SEPARATOR = "\x1f"
+
+SIM_VERSION = "15.0.4000.1"
+
+LABELONLY_COLUMNS = [
+    "MediaName", "MediaSetId", "FamilyCount", "FamilySequenceNumber", "MediaFamilyId", "MediaSequenceNumber",
+    "MediaLabelPresent", "MediaDescription", "SoftwareName", "SoftwareVendorId", "MediaDate", "MirrorCount",
+    "IsCompressed"
+]
+
+HEADERONLY_COLUMNS = [
+    "BackupName", "BackupDescription", "BackupType", "ExpirationDate", "Compressed", "Position", "DeviceType",
+    "UserName", "ServerName", "DatabaseName", "DatabaseVersion", "DatabaseCreationDate", "BackupSize", "FirstLSN",
+    "LastLSN", "CheckpointLSN", "DatabaseBackupLSN", "BackupStartDate", "BackupFinishDate", "SortOrder", "CodePage",
+    "UnicodeLocaleId", "UnicodeComparisonStyle", "CompatibilityLevel", "SoftwareVendorId", "SoftwareVersionMajor",
+    "SoftwareVersionMinor", "SoftwareVersionBuild", "MachineName", "Flags", "BindingID", "RecoveryForkID",
+    "Collation", "FamilyGUID", "HasBulkLoggedData", "IsSnapshot", "IsReadOnly", "IsSingleUser",
+    "HasBackupChecksums", "IsDamaged", "BeginsLogChain", "HasIncompleteMetaData", "IsForceOffline", "IsCopyOnly",
+    "FirstRecoveryForkID", "ForkPointLSN", "RecoveryModel", "DifferentialBaseLSN", "DifferentialBaseGUID",
+    "BackupTypeDescription", "BackupSetGUID", "CompressedBackupSize", "Containment", "KeyAlgorithm",
+    "EncryptorThumbprint", "EncryptorType"
+]
+
+FILELISTONLY_COLUMNS = [
+    "LogicalName", "PhysicalName", "Type", "FileGroupName", "Size", "MaxSize", "FileId", "CreateLSN", "DropLSN",
+    "UniqueId", "ReadOnlyLSN", "ReadWriteLSN", "BackupSizeInBytes", "SourceBlockSize", "FileGroupId",
+    "LogGroupGUID", "DifferentialBaseLSN", "DifferentialBaseGUID", "IsReadOnly", "IsPresent", "TDEThumbprint",
+    "SnapshotUrl"
+]
+
+DATABASE_FILES_COLUMNS = [ "LogicalName", "FileId", "PhysicalName", "Type", "FileGroupName" ]
+
+# data files per filegroup in synthetic database
+FILES_PER_FILEGROUP = 8
+
+# every full backup is followed by logs
+LOGS_PER_FULL = 49
+
+# LSN distance between backups
+LSN_STEP = 100000
+
+SQLCMD = """#!/bin/bash
+# sqlcmd stand-in generated by benchmark/simulator.py
+query=""
+database=""
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -Q) query="$2"; shift ;;
+        -d) database="$2"; shift ;;
+    esac
+    shift
+done
+[ -n "$query" ] || query=$(cat)
+sleep {sql_latency}
+case "$query" in
+    *HEADERONLY*)
+        path=$(printf '%s' "$query" | sed -n "s/.*HEADERONLY FROM DISK='\\([^']*\\)'.*/\\1/p" | head -n 1)
+        if [ ! -f "$path" ]; then
+            echo "Msg 3201, Level 16, State 2, Server sim, Line 1"
+            echo "Cannot open backup device '$path'. Operating system error 2(The system cannot find the file specified.)."
+            exit 1
+        fi
+        cat "$path" ;;
+    *FILELISTONLY*)
+        cat {world}/filelist.out ;;
+    *sys.database_files*)
+        cat {world}/database_files.out ;;
+    *)
+        printf '%s' "$query" | SIM_DATABASE="$database" {python} {simulator} sqlcmd {world} ;;
+esac
+"""
+
+
+def result_set(columns, rows):
+    """
+    Return sqlcmd output of one result set printed with -W and unit separator
+    """
+    lines = [ FIELD_SEPARATOR.join(columns), FIELD_SEPARATOR.join([ "-" * len(x) for x in columns ]) ]
+    lines.extend([ FIELD_SEPARATOR.join([ "NULL" if x is None else str(x) for x in row ]) for row in rows ])
+    return "\n".join(lines) + "\n\n"
+
+
+def database_files(database, count):
+    """
+    Return a list of files (logical name, physical name, type, filegroup, file id) for database
+    with count files - one log file and data files in filegroups of FILES_PER_FILEGROUP files
+    """
+    files = [ ("{}".format(database), "{}.mdf".format(database), "D", "PRIMARY", 1),
+              ("{}_log".format(database), "{}_log.ldf".format(database), "L", None, 2) ]
+    for index in range(count - 2):
+        group = index // FILES_PER_FILEGROUP
+        filegroup = "PRIMARY" if group == 0 else "FG{}".format(group)
+        files.append(("{}_{}".format(database, index + 3), "{}_{}.ndf".format(database, index + 3), "D", filegroup, index + 3))
+    return files[:max(count, 2)]
+
+
+class world(object):
+    """
+    Synthetic host - backup location with backup files of one database, mount paths,
+    sqlcmd stand-in and database state
+    """
+
+    def __init__(self, root, database, files, sql_latency=0.0):
+        self.root = root
+        self.database = database
+        self.files = database_files(database, files)
+        self.backup_location = os.path.join(root, "backups")
+        self.world_path = os.path.join(root, "world")
+        self.client_path = os.path.join(root, "bin")
+        self.backups = 0
+        for d in [ self.backup_location, self.world_path, self.client_path, os.path.join(root, "mnt") ]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+        with open(os.path.join(self.client_path, "sqlcmd"), "w") as f:
+            f.write(SQLCMD.format(sql_latency=sql_latency, world=self.world_path, python=sys.executable,
+                                  simulator=os.path.abspath(__file__)))
+        os.chmod(os.path.join(self.client_path, "sqlcmd"), 0o755)
+
+        filelist = [ (name, "/var/opt/mssql/data/{}".format(physical), filetype, group, 8388608, 35184372080640, fileid,
+                      0, 0, "00000000-0000-0000-0000-00000000000{}".format(fileid % 10), 0, 0, 8388608, 4096, 1,
+                      None, 0, "00000000-0000-0000-0000-000000000000", 0, 1, None, None)
+                     for (name, physical, filetype, group, fileid) in self.files ]
+        with open(os.path.join(self.world_path, "filelist.out"), "w") as f:
+            f.write(result_set(FILELISTONLY_COLUMNS, filelist))
+        with open(os.path.join(self.world_path, "database_files.out"), "w") as f:
+            f.write(result_set(DATABASE_FILES_COLUMNS, [ (name, fileid, "/var/opt/mssql/data/{}".format(physical), filetype, group)
+                                                         for (name, physical, filetype, group, fileid) in self.files ]))
+        save_state(self.world_path, { "databases": {} })
+
+
+    def add_backups(self, count):
+        """
+        Write count backup files - full backup followed by LOGS_PER_FULL logs
+        Every backup continues LSN chain of previous one
+        """
+        start = datetime.datetime(2020, 1, 1)
+        for index in range(self.backups, self.backups + count):
+            first_lsn = index * LSN_STEP + 1
+            last_lsn = (index + 1) * LSN_STEP + 1
+            full_index = index - index % (LOGS_PER_FULL + 1)
+            full_checkpoint = full_index * LSN_STEP + 50
+            backup_start = start + datetime.timedelta(minutes=15 * index)
+            if index == full_index:
+                (backup_type, name, checkpoint, base) = (1, "full", full_checkpoint, 0)
+            else:
+                (backup_type, name, checkpoint, base) = (2, "log", 0, full_checkpoint)
+            header = [ None ] * len(HEADERONLY_COLUMNS)
+            values = {
+                "BackupType": backup_type, "Compressed": 0, "Position": 1, "DeviceType": 2, "UserName": "sa",
+                "ServerName": "sim", "DatabaseName": self.database, "DatabaseVersion": 904,
+                "DatabaseCreationDate": "2020-01-01 00:00:00.000", "BackupSize": 1048576 * (len(self.files) if backup_type == 1 else 1),
+                "FirstLSN": first_lsn, "LastLSN": last_lsn, "CheckpointLSN": checkpoint, "DatabaseBackupLSN": base,
+                "BackupStartDate": backup_start.strftime("%Y-%m-%d %H:%M:%S.000"),
+                "BackupFinishDate": (backup_start + datetime.timedelta(seconds=30)).strftime("%Y-%m-%d %H:%M:%S.000"),
+                "SoftwareVersionMajor": 15, "SoftwareVersionMinor": 0, "SoftwareVersionBuild": 4000, "MachineName": "sim",
+                "RecoveryModel": "FULL", "BackupTypeDescription": "Database" if backup_type == 1 else "Transaction Log"
+            }
+            for (column, value) in values.items():
+                header[HEADERONLY_COLUMNS.index(column)] = value
+            label = [ None, "{{SIM-MEDIA-{}}}".format(index), 1, 1, "{{SIM-FAMILY-{}}}".format(index), 1, 0, None,
+                      "Microsoft SQL Server", 4608, backup_start.strftime("%Y-%m-%d %H:%M:%S.000"), 1, 0 ]
+            path = os.path.join(self.backup_location, "{}_{}_{:06d}.bak".format(self.database, name, index))
+            with open(path, "w") as f:
+                f.write(result_set(LABELONLY_COLUMNS, [ label ]) + result_set(HEADERONLY_COLUMNS, [ header ]))
+        self.backups = self.backups + count
+
+
+class run_bash_response(object):
+    """
+    Same attributes as response of libs.run_bash
+    """
+
+    def __init__(self, stdout, stderr, exit_code):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = exit_code
+
+
+class host(object):
+    """
+    Replacement of libs.run_bash - command is run with local bash after latency seconds
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+
+
+    def run_bash(self, remote_connection, command, variables=None, use_login_shell=False, check=False):
+        self.round_trips = self.round_trips + 1
+        time.sleep(self.latency)
+        env = dict(os.environ)
+        env.update(variables or {})
+        process = subprocess.Popen([ "bash", "-c", command ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        (stdout, stderr) = process.communicate()
+        return run_bash_response(stdout.decode("utf-8"), stderr.decode("utf-8"), process.returncode)
+
+
+# sqlcmd stand-in for statements changing or reading database state
+
+def load_state(world_path):
+    with open(os.path.join(world_path, "state.json")) as f:
+        return json.load(f)
+
+
+def save_state(world_path, state):
+    with open(os.path.join(world_path, "state.json"), "w") as f:
+        json.dump(state, f)
+
+
+STATEMENT = re.compile(r"\b(PRINT|SELECT|RESTORE\s+DATABASE|RESTORE\s+LOG|DROP\s+DATABASE|CREATE\s+DATABASE|"
+                       r"BACKUP\s+DATABASE|exec\s+sp_detach_db|ALTER\s+DATABASE)\b", re.IGNORECASE)
+
+
+def restore_state(statement):
+    if re.search(r"\bNORECOVERY\b", statement, re.IGNORECASE):
+        return "RESTORING"
+    if re.search(r"\bSTANDBY\b", statement, re.IGNORECASE):
+        return "STANDBY"
+    return "ONLINE"
+
+
+def state_row(name, state):
+    """
+    Return a sys.databases row: name, state_desc, is_in_standby, is_read_only
+    """
+    if state == "STANDBY":
+        return (name, "ONLINE", "1", "1")
+    return (name, state, "0", "0")
+
+
+def run_statement(statement, state):
+    """
+    Run one statement against database state - print output like sqlcmd
+    Return False if statement failed
+    """
+    keyword = " ".join(STATEMENT.match(statement).group(1).upper().split())
+    databases = state["databases"]
+    name = re.match(r"\S+\s+\S+\s+\[?(\w+)", statement)
+    name = name.group(1) if name else None
+
+    if keyword == "PRINT":
+        text = re.match(r"PRINT\s+'([^']*)'(\s*\+\s*CONVERT)?", statement, re.IGNORECASE)
+        if text:
+            now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:23]
+            print(text.group(1) + (now if text.group(2) else ""))
+    elif keyword == "SELECT":
+        status = re.search(r"state_desc from sys.databases where name = '([^']*)'", statement, re.IGNORECASE)
+        states = re.search(r"SELECT name, state_desc, is_in_standby, is_read_only FROM sys.databases(?: WHERE name = '([^']*)')?",
+                           statement, re.IGNORECASE)
+        if status:
+            if status.group(1) in databases:
+                print(state_row(status.group(1), databases[status.group(1)])[1])
+        elif states:
+            rows = [ (x, "ONLINE") for x in [ "master", "tempdb", "model", "msdb" ] ] + sorted(databases.items())
+            sys.stdout.write(result_set([ "name", "state_desc", "is_in_standby", "is_read_only" ],
+                                        [ state_row(x, y) for (x, y) in rows if states.group(1) in [ None, x ] ]))
+        elif re.search(r"SELECT name from sys.databases", statement, re.IGNORECASE):
+            for database in [ "master", "tempdb", "model", "msdb" ] + sorted(databases.keys()):
+                print(database)
+    elif keyword in [ "RESTORE DATABASE", "RESTORE LOG" ]:
+        if keyword == "RESTORE LOG" and name not in databases:
+            print("Msg 3701, Level 11, State 1, Server sim, Line 1")
+            print("Cannot restore database '{}' because it does not exist.".format(name))
+            return False
+        stats = re.search(r"STATS=(\d+)", statement, re.IGNORECASE)
+        if stats:
+            for percent in range(int(stats.group(1)), 101, int(stats.group(1))):
+                print("{} percent processed.".format(percent))
+                sys.stdout.flush()
+        databases[name] = restore_state(statement)
+        if re.search(r"\bFROM\b", statement, re.IGNORECASE):
+            print("{} successfully processed 1024 pages in 0.100 seconds (80.000 MB/sec).".format(keyword))
+    elif keyword == "DROP DATABASE" or keyword == "EXEC SP_DETACH_DB":
+        name = re.search(r"(?:DATABASE\s+|sp_detach_db\s+')(\w+)", statement, re.IGNORECASE).group(1)
+        if name not in databases:
+            print("Msg 3701, Level 11, State 1, Server sim, Line 1")
+            print("Cannot drop the database '{}', because it does not exist.".format(name))
+            return False
+        del databases[name]
+    elif keyword == "CREATE DATABASE":
+        databases[name] = "ONLINE"
+    elif keyword == "BACKUP DATABASE":
+        path = re.search(r"TO\s+DISK\s*=\s*'([^']*)'", statement, re.IGNORECASE).group(1)
+        with open(path, "w") as f:
+            f.write("\0" * 65536)
+    elif keyword == "ALTER DATABASE":
+        if re.search(r"SET\s+OFFLINE", statement, re.IGNORECASE):
+            databases[name] = "OFFLINE"
+        elif re.search(r"SET\s+ONLINE", statement, re.IGNORECASE):
+            databases[name] = "ONLINE"
+    return True
+
+
+def sqlcmd(world_path):
+    """
+    Run script from stdin - batches are separated by GO, and script is stopped on first error (-b)
+    """
+    state = load_state(world_path)
+    script = sys.stdin.read()
+    exit_code = 0
+    for batch in re.split(r"^\s*GO\s*$", script, flags=re.MULTILINE | re.IGNORECASE):
+        matches = list(STATEMENT.finditer(batch))
+        for (index, match) in enumerate(matches):
+            end = matches[index + 1].start() if index + 1 < len(matches) else len(batch)
+            if not run_statement(batch[match.start():end], state):
+                exit_code = 1
+                break
+        if exit_code != 0:
+            break
+    save_state(world_path, state)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "sqlcmd":
+        sqlcmd(sys.argv[2])
+    else:
+        sys.stderr.write("usage: simulator.py sqlcmd <world directory>\n")
+        sys.exit(2)
@@ -9,7 +9,9 @@ from generated.definitions import (
 )
 
 from operations.discovery import find_repos
+from operations.discovery import find_source_configs
 from controller.helper import setup_logger
+from controller import tracing
 from operations import linked
 from operations import virtual
 
@@ -33,26 +35,29 @@ def repository_discovery(source_connection):
     # by the SDK tools from the plugin's root directory.
     #
 
-    return find_repos(source_connection)
+    with tracing.trace_operation("discovery.repository"):
+        return find_repos(source_connection)
 
 
 @plugin.discovery.source_config()
 def source_config_discovery(source_connection, repository):
     #
-    # To have automatic discovery of source configs, return a list of
-    # SourceConfigDefinitions similar to the list of
-    # RepositoryDefinitions above.
+    # All user databases of repository instance are returned with size
+    # and backup metadata. Instance credentials (SQLCMDUSER and SQLCMDPASSWORD)
+    # have to be set in environment user profile.
     #
 
-    return []
+    with tracing.trace_operation("discovery.source_config"):
+        return find_source_configs(source_connection, repository)
 
 
 @plugin.linked.pre_snapshot()
 def linked_pre_snapshot(staged_source, repository, source_config, snapshot_parameters):
-    if int(snapshot_parameters.resync) == 1:
-        linked.resync(staged_source, repository, source_config)
-    else:
-        linked.pre_snapshot(staged_source, repository, source_config)
+    with tracing.trace_operation("linked.pre_snapshot"):
+        if int(snapshot_parameters.resync) == 1:
+            linked.resync(staged_source, repository, source_config)
+        else:
+            linked.pre_snapshot(staged_source, repository, source_config)
 
 
 @plugin.linked.post_snapshot()
@@ -60,7 +65,8 @@ def linked_post_snapshot(staged_source,
                          repository,
                          source_config,
                          snapshot_parameters):
-    return linked.post_snapshot(staged_source, repository, source_config)
+    with tracing.trace_operation("linked.post_snapshot"):
+        return linked.post_snapshot(staged_source, repository, source_config)
 
 
 @plugin.linked.mount_specification()
@@ -70,36 +76,49 @@ def linked_mount_specification(staged_source, repository):
 
 @plugin.linked.start_staging()
 def linked_start_staging(staged_source, repository, source_config):
-    linked.start_staging(staged_source, repository, source_config)
+    with tracing.trace_operation("linked.start_staging"):
+        linked.start_staging(staged_source, repository, source_config)
 
 
 @plugin.linked.stop_staging()
 def linked_stop_staging(staged_source, repository, source_config):
-    linked.stop_staging(staged_source, repository, source_config)
+    with tracing.trace_operation("linked.stop_staging"):
+        linked.stop_staging(staged_source, repository, source_config)
 
 
 @plugin.linked.status()
 def linked_status(staged_source, repository, source_config):
-    return linked.staging_status(staged_source, repository, source_config)
+    with tracing.trace_operation("linked.status"):
+        return linked.staging_status(staged_source, repository, source_config)
 
 @plugin.virtual.configure()
 def configure(virtual_source, snapshot, repository):
-    return virtual.configure(virtual_source, snapshot, repository)
+    with tracing.trace_operation("virtual.configure"):
+        return virtual.configure(virtual_source, snapshot, repository)
 
 
 @plugin.virtual.unconfigure()
 def unconfigure(virtual_source, repository, source_config):
-    return virtual.unconfigure(virtual_source, repository, source_config)
+    with tracing.trace_operation("virtual.unconfigure"):
+        return virtual.unconfigure(virtual_source, repository, source_config)
 
 
 @plugin.virtual.reconfigure()
 def reconfigure(virtual_source, repository, source_config, snapshot):
-    return virtual.reconfigure(virtual_source, repository, source_config, snapshot)
+    with tracing.trace_operation("virtual.reconfigure"):
+        return virtual.reconfigure(virtual_source, repository, source_config, snapshot)
+
+
+@plugin.virtual.pre_snapshot()
+def virtual_pre_snapshot(virtual_source, repository, source_config):
+    with tracing.trace_operation("virtual.pre_snapshot"):
+        virtual.pre_snapshot(virtual_source, repository, source_config)
 
 
 @plugin.virtual.post_snapshot()
 def virtual_post_snapshot(virtual_source, repository, source_config):
-    return virtual.post_snapshot(virtual_source, repository, source_config)
+    with tracing.trace_operation("virtual.post_snapshot"):
+        return virtual.post_snapshot(virtual_source, repository, source_config)
 
 
 @plugin.virtual.mount_specification()
@@ -109,14 +128,17 @@ def virtual_mount_specification(virtual_source, repository):
 
 @plugin.virtual.status()
 def virtual_status(virtual_source, repository, source_config):
-    return virtual.vdb_status(virtual_source, repository, source_config)
+    with tracing.trace_operation("virtual.status"):
+        return virtual.vdb_status(virtual_source, repository, source_config)
 
 
 @plugin.virtual.start()
 def start(virtual_source, repository, source_config):
-    virtual.start_vdb(virtual_source, repository, source_config)
+    with tracing.trace_operation("virtual.start"):
+        virtual.start_vdb(virtual_source, repository, source_config)
 
 
 @plugin.virtual.stop()
 def stop(virtual_source, repository, source_config):
-    virtual.stop_vdb(virtual_source, repository, source_config)
+    with tracing.trace_operation("virtual.stop"):
+        virtual.stop_vdb(virtual_source, repository, source_config)
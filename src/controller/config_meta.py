@@ -10,6 +10,9 @@ logger = logging.getLogger(__name__)
 
 
 class config_meta(object):
+    __slots__ = ("source_connection", "repository", "source_config", "staged_source",
+                 "snapshot_parameters", "virtual_source", "snapshot")
+
     def __init__(self,
                  source_connection=None,
                  repository=None,
@@ -32,6 +35,7 @@ class config_meta(object):
         Depend on the init arguments - dSource flag is set to True or False
         connection parameter is always set to a connection provided by vSDK
         source parameter is pointed to staged_source or virtual source - depend on init parameters
+        Derived parameters are resolved on access
         """
 
         self.source_connection = source_connection
@@ -42,18 +46,25 @@ class config_meta(object):
         self.virtual_source = virtual_source
         self.snapshot = snapshot
 
-        # Entry for other parameters which is being used in function
 
-        if virtual_source is None:
-            self.dSource = True
-            self.connection = staged_source.staged_connection
-            self.source = staged_source
-        else:
-            self.dSource = False
-            self.connection = virtual_source.connection
-            self.source = virtual_source
-            
+    @property
+    def dSource(self):
+        return self.virtual_source is None
 
-        self.parameters = self.source.parameters
+    @property
+    def connection(self):
+        if self.dSource:
+            return self.staged_source.staged_connection
+        else:
+            return self.virtual_source.connection
 
+    @property
+    def source(self):
+        if self.dSource:
+            return self.staged_source
+        else:
+            return self.virtual_source
 
+    @property
+    def parameters(self):
+        return self.source.parameters
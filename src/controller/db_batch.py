@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+
+import datetime
+import logging
+
+from controller.plugin_exception import plugin_exception
+from controller.plugin_exception import db_batch_exception
+from mssql import db_commands
+
+
+logger = logging.getLogger(__name__)
+
+BEGIN_MARKER = "DLPX-BATCH-BEGIN"
+END_MARKER = "DLPX-BATCH-END"
+
+# markers are printed with server time (ODBC canonical with milliseconds)
+# to measure execution time of every command
+MARKER_TIME = "CONVERT(varchar(23), SYSUTCDATETIME(), 121)"
+MARKER_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class db_batch(object):
+    """
+    Class to queue database commands and run them as a one sqlcmd script
+
+    Only commands with a statement version (<command_name>_sql function)
+    in db_commands module can be queued. Output of every command is wrapped
+    with markers, so output and errors can be mapped back to the command.
+
+    batch = db_object.db_batch()
+    batch.add("rename_datafile", database=dbname, filename=..., physical_filename=...)
+    output = batch.run()
+    """
+
+    def __init__(self, db_object):
+        self.__db_object = db_object
+        self.__commands = []
+        self.__timings = []
+
+
+    def __len__(self):
+        return len(self.__commands)
+
+
+    @property
+    def timings(self):
+        """
+        List of execution times (in seconds) of commands from last run
+        None is set for commands which didn't finish
+        """
+        return self.__timings
+
+
+    def add(self, command_name, **kargs):
+        """
+        Queue a command_name with kargs parameters
+        """
+        logger.debug("db_batch add {}".format(command_name))
+        method_to_call = getattr(db_commands, "{}_sql".format(command_name))
+        self.__commands.append((command_name, kargs, method_to_call(**kargs)))
+
+
+    def generate_script(self):
+        """
+        Return a sqlcmd script with all queued commands wrapped by markers
+        """
+        sections = []
+        for (index, (command_name, kargs, statement)) in enumerate(self.__commands):
+            sections.append("""PRINT '{begin} {index} ' + {time}
+                    GO
+                    {statement}
+                    PRINT '{end} {index} ' + {time}
+                    GO""".format(begin=BEGIN_MARKER, end=END_MARKER, index=index, statement=statement, time=MARKER_TIME))
+        return "\n                    ".join(sections)
+
+
+    def split_output(self, lines):
+        """
+        Split output lines into a list of outputs - one per queued command
+        and set execution time of every finished command
+        Return a tuple with list of outputs and index of last started and not finished command
+        """
+        outputs = [ [] for c in self.__commands ]
+        self.__timings = [ None for c in self.__commands ]
+        started = None
+        current = None
+        for line in lines:
+            if line.startswith(BEGIN_MARKER):
+                current = int(line.split()[1])
+                started = self.parse_marker_time(line)
+            elif line.startswith(END_MARKER):
+                finished = self.parse_marker_time(line)
+                if started is not None and finished is not None:
+                    self.__timings[current] = (finished - started).total_seconds()
+                current = None
+            elif current is not None:
+                outputs[current].append(line)
+        return (outputs, current)
+
+
+    def parse_marker_time(self, line):
+        """
+        Return a server time from marker line or None if it can't be parsed
+        """
+        try:
+            return datetime.datetime.strptime(" ".join(line.split()[2:4]), MARKER_TIME_FORMAT)
+        except ValueError:
+            return None
+
+
+    def run(self):
+        """
+        Run all queued commands in one sqlcmd invocation
+        Return a list of outputs (list of lines) - one per queued command
+        Raise db_batch_exception pointing to a failed command
+        or plugin_exception if error can't be mapped to a command (ex. login problem)
+        """
+        logger.debug("db_batch run {} commands".format(len(self.__commands)))
+        if not self.__commands:
+            return []
+
+        try:
+            lines = self.__db_object.run_db_command("sqlcmd_script", script=self.generate_script())
+            (outputs, failed) = self.split_output(lines)
+        except plugin_exception as p:
+            lines = map(lambda x: x.strip(), p.stdout.split("\n"))
+            (outputs, failed) = self.split_output(lines)
+            if failed is None:
+                raise
+            (command_name, kargs, statement) = self.__commands[failed]
+            logger.debug("db_batch command {} {} failed".format(failed, command_name))
+            raise db_batch_exception(p, command_name, kargs, "\n".join(outputs[failed]))
+
+        self.__commands = []
+        return outputs
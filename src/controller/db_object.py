@@ -2,16 +2,28 @@ from controller import os_commands
 from controller.helper import execute_bash
 from controller.helper import need_sudo
 from controller.plugin_exception import plugin_exception
+from controller.os_command_response import OS_Command_Response
 from controller.config_meta import config_meta
+from controller.db_batch import db_batch
+from controller.db_session import db_session
+from controller.step_journal import step_journal
+from controller.step_journal import remove_journal
+from controller.result_set import line_reader
+from controller import tracing
 from dlpx.virtualization.platform.exceptions import UserError
 import logging
 import os
 import json
+from contextlib import contextmanager
 
 from mssql import db_commands
+from mssql import mssql_status
 
 logger = logging.getLogger(__name__)
 
+# how long (in seconds) one poll of background command is waiting for command to finish
+POLL_WAIT = 15
+
 
 class db_object(object):
     """
@@ -24,8 +36,13 @@ class db_object(object):
     objects via named parameters like this:
  
     db_object(staged_source=staged_source, repository=repository, source_config=source_config, etc)
+
+    Attributes depending on a connection (sudo) or parameters (paths) are resolved
+    on first access, so operation is paying only for things it's using
     """
 
+    __slots__ = ("__config", "__sudo", "__config_path", "__db_path", "__session")
+
     def __init__(self, **kargs):
         """
         Class constructor
@@ -42,14 +59,12 @@ class db_object(object):
         logger.debug("initialize db_object")
         # save all init objects into config_meta object for standard access
         self.__config = config_meta(**kargs)
-        # compare if repository owner is equal environment user executing commands and set sudo and uid property
-        self.__sudo = need_sudo(
-            self.__config.connection, self.__config.repository.uid, self.__config.repository.gid)
-        self.__uid = self.__config.repository.uid
-        # set config directory to mount_point/.config
-        self.__config_path = os.path.join(self.__config.parameters.mount_path, '.config')
-        # database files path set directory to mount_point/db
-        self.__db_path = os.path.join(self.__config.parameters.mount_path, 'db')
+        # sudo and paths are set on first access
+        self.__sudo = None
+        self.__config_path = None
+        self.__db_path = None
+        # persistent sqlcmd session - set only inside sqlcmd_session context
+        self.__session = None
 
 
     @property
@@ -64,29 +79,39 @@ class db_object(object):
     def sudo(self):
         """
         define class property and return a __sudo property
+        compare if repository owner is equal environment user executing commands
         """
+        if self.__sudo is None:
+            self.__sudo = need_sudo(
+                self.config.connection, self.config.repository.uid, self.config.repository.gid)
         return self.__sudo
 
     @property
     def config_path(self):
         """
         define class property and return a __config_path property
+        config directory is set to mount_point/.config
         """
+        if self.__config_path is None:
+            self.__config_path = os.path.join(self.config.parameters.mount_path, '.config')
         return self.__config_path
 
     @property
     def db_path(self):
         """
         define class property and return a __db_path property
+        database files path is set to mount_point/db
         """
+        if self.__db_path is None:
+            self.__db_path = os.path.join(self.config.parameters.mount_path, 'db')
         return self.__db_path
 
     @property
     def uid(self):
         """
-        define class property and return a __uid property
+        define class property and return a repository owner uid
         """
-        return self.__uid
+        return self.config.repository.uid
 
 
     def get_db_name(self):
@@ -110,8 +135,6 @@ class db_object(object):
         logger.debug("save_json")
         # add exception
         obj_json = json.dumps(obj)
-        obj_json = obj_json.replace('"', '\\"')
-        logger.debug("fixed object: {}".format(obj_json))
         
         cmd = os_commands.write_file(file_path, obj_json, self.sudo, self.uid)
         write_file = execute_bash(source_connection=self.config.connection, command_name=cmd)
@@ -137,6 +160,23 @@ class db_object(object):
         return obj
 
 
+    def append_json(self, file_path, obj, keep):
+        """
+        Append obj to a list saved as JSON file using a file_path
+        Only last keep elements are saved. Missing or broken file is started from scratch
+        Raise plugin_exception if file can't be saved
+        """
+        logger.debug("append_json")
+        try:
+            history = self.load_json(file_path)
+        except (plugin_exception, ValueError):
+            history = []
+        if not isinstance(history, list):
+            history = []
+        self.save_json(file_path, (history + [ obj ])[-keep:])
+
+
+    @tracing.traced_db_command
     def run_db_command(self, command_name, **kargs):
         """
         Run a database command provided by command_name
@@ -147,6 +187,44 @@ class db_object(object):
         are automatically set by this function
         """
         logger.debug("run_db_command")
+        if self.__session is not None and hasattr(db_commands, "{}_sql".format(command_name)):
+            return self.__session.run(command_name, **kargs)
+
+        (cmd, env) = self.get_db_command(command_name, **kargs)
+        sqlcommand = execute_bash(
+            source_connection=self.config.connection, command_name=cmd, environment_vars=env)
+
+        if sqlcommand.exit_code != 0:
+            raise plugin_exception(sqlcommand)
+
+        to_list = map(lambda x: x.strip(), sqlcommand.stdout.split("\n"))
+        return to_list
+
+
+    @tracing.traced_db_command
+    def query_db_command(self, command_name, **kargs):
+        """
+        Run a database command printing result sets with column names (see result_set module)
+        and return a line_reader for command output, so rows can be read one by one
+        Command is never run in sqlcmd session, as session output has no column names
+        Raise plugin_exception if command failed
+        """
+        logger.debug("query_db_command")
+        (cmd, env) = self.get_db_command(command_name, **kargs)
+        sqlcommand = execute_bash(
+            source_connection=self.config.connection, command_name=cmd, environment_vars=env)
+
+        if sqlcommand.exit_code != 0:
+            raise plugin_exception(sqlcommand)
+
+        return line_reader(sqlcommand.stdout)
+
+
+    def get_db_command(self, command_name, **kargs):
+        """
+        Return a tuple with shell command for command_name from db_commands module
+        and environment variables (password) needed to run it
+        """
         client_path = self.config.repository.client_path
         if self.config.dSource:
             username = self.config.staged_source.parameters.instance_user
@@ -155,18 +233,126 @@ class db_object(object):
             username = self.config.virtual_source.parameters.instance_user
             password = self.config.virtual_source.parameters.instance_password
 
-        env = {"SQLCMDPASSWORD": password}
+        # repository of instance on non default port (see mssql_discovery)
+        env = db_commands.sqlcmd_environment(password, getattr(self.config.repository, "port", None))
         method_to_call = getattr(db_commands, command_name)
         cmd = method_to_call(client_path=client_path,
                              username=username, **kargs)
-        sqlcommand = execute_bash(
-            source_connection=self.config.connection, command_name=cmd, environment_vars=env)
+        return (cmd, env)
 
-        if sqlcommand.exit_code != 0:
-            raise plugin_exception(sqlcommand)
 
-        to_list = map(lambda x: x.strip(), sqlcommand.stdout.split("\n"))
-        return to_list
+    @tracing.traced_db_command
+    def run_db_command_progress(self, command_name, on_line, **kargs):
+        """
+        Run a long running database command as a background job on the host
+        Output is polled every POLL_WAIT seconds and every new line is passed to on_line function
+        as soon as it's read, so progress can be reported while command is running
+
+        Return output as list of lines like run_db_command
+        Raise plugin_exception if command failed
+        """
+        logger.debug("run_db_command_progress")
+        (cmd, env) = self.get_db_command(command_name, **kargs)
+        job = execute_bash(source_connection=self.config.connection,
+                           command_name=os_commands.background_start(cmd), environment_vars=env)
+        if job.exit_code != 0:
+            raise plugin_exception(job)
+        job_dir = job.stdout.split("\n")[-1].strip()
+
+        lines = []
+        status = "running"
+        try:
+            while status == "running":
+                poll = execute_bash(source_connection=self.config.connection,
+                                    command_name=os_commands.background_poll(job_dir, len(lines), POLL_WAIT))
+                if poll.exit_code != 0:
+                    raise plugin_exception(poll)
+                output = poll.stdout.split("\n")
+                (marker, status, total) = output[0].split()
+                new_lines = map(lambda x: x.strip(), output[1:])
+                if status == "running":
+                    # only complete lines are printed, so number of lines is known
+                    # (empty lines at the end are removed from stdout)
+                    count = int(total) - len(lines)
+                    new_lines = (new_lines + [ "" ] * count)[:count]
+                for line in new_lines:
+                    on_line(line)
+                lines.extend(new_lines)
+        finally:
+            cleanup = execute_bash(source_connection=self.config.connection, command_name=os_commands.background_cleanup(job_dir))
+            if "DLPX-JOB aborted" in cleanup.stdout:
+                logger.info("background command {} was aborted after {} lines of output".format(command_name, len(lines)))
+
+        if status != "0":
+            logger.debug("background command {} finished with status {}".format(command_name, status))
+            raise plugin_exception(OS_Command_Response("\n".join(lines), "", 1))
+
+        return lines
+
+
+    @contextmanager
+    def sqlcmd_session(self):
+        """
+        Run all commands inside context using one persistent sqlcmd process (see db_session class)
+        Session is used only if sqlcmd_session parameter is set for dSource or VDB,
+        if session can't be started commands are run in a standard way
+        """
+        logger.debug("sqlcmd_session")
+        if not getattr(self.config.parameters, "sqlcmd_session", False) or self.__session is not None:
+            yield
+            return
+
+        session = db_session(self)
+        try:
+            session.start()
+        except plugin_exception as p:
+            logger.debug("Can't start sqlcmd session - using one sqlcmd per command. stdout: {} stderr: {}".format(p.stdout, p.stderr))
+            session = None
+
+        self.__session = session
+        try:
+            yield
+        finally:
+            self.__session = None
+            if session is not None:
+                session.stop()
+
+
+    def create_journal(self, operation, inputs, expected_states=None):
+        """
+        Return a step journal for operation started with inputs (see step_journal class)
+        Steps finished by previous interrupted run with same inputs are skipped
+        expected_states is a dictionary step -> state of database left by step - if database
+        is not in that state (ex. it was detached or dropped since) journal is started from scratch
+        """
+        logger.debug("create_journal")
+        journal = step_journal(self, operation, inputs)
+        if journal.pending() and expected_states and journal.steps[-1] in expected_states:
+            expected = expected_states[journal.steps[-1]]
+            state = self.get_db_state()
+            if state != expected:
+                logger.debug("database state is {} instead of {} after step {} - starting {} from scratch".format(
+                    state, expected, journal.steps[-1], operation))
+                journal.reset()
+        return journal
+
+
+    def remove_journal(self, operation):
+        """
+        Remove a step journal of operation - database left by interrupted operation
+        was detached or dropped, so next run has to start from scratch
+        """
+        logger.debug("remove_journal")
+        remove_journal(self, operation)
+
+
+    def create_batch(self):
+        """
+        Return an empty db_batch object to queue a database commands
+        and run them as a one sqlcmd script (see db_batch class)
+        """
+        logger.debug("create_batch")
+        return db_batch(self)
 
 
     def db_exist(self):
@@ -193,6 +379,24 @@ class db_object(object):
         else:
             return False
 
+    def get_db_state(self):
+        """
+        Return a state of staging database or VDB (state_desc from sys.databases)
+        or None if there is no such database
+        """
+        logger.debug("get_db_state")
+        if self.config.dSource:
+            dbname = "{}_staging".format(self.get_db_name())
+        else:
+            dbname = self.get_db_name()
+        try:
+            status = self.run_db_command("get_mssql_databases_status", database=dbname)
+        except plugin_exception as p:
+            raise UserError("Error reading state of database {}".format(dbname), action="Check output for detailed error",
+                            output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        states = [ x for x in status if x ]
+        return states[0] if states else None
+
     def check_vdb(self):
         """
         Check status of staging database or VDB
@@ -212,6 +416,14 @@ class db_object(object):
             logger.debug("problem with monitoring")
             return "OFFLINE"
 
+    def invalidate_db_states(self):
+        """
+        Remove host-wide cache of database states after state of database was changed
+        """
+        logger.debug("invalidate_db_states")
+        mssql_status.invalidate_states(self.config.connection, self.config.repository, self.sudo)
+
+
     def offline_vdb(self):
         """
         Bring a VDB offline
@@ -224,6 +436,8 @@ class db_object(object):
         except plugin_exception as p:
             raise UserError("Problem with offlining database {}".format(
                 dbname), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        finally:
+            self.invalidate_db_states()
 
     def online_vdb(self):
         """
@@ -237,3 +451,5 @@ class db_object(object):
         except plugin_exception as p:
             raise UserError("Problem with onlining database {}".format(
                 dbname), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        finally:
+            self.invalidate_db_states()
@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+
+import logging
+import re
+
+from controller.os_command_response import OS_Command_Response
+from controller.plugin_exception import plugin_exception
+from mssql import db_commands
+
+
+logger = logging.getLogger(__name__)
+
+MARKER = "DLPX-SESSION-END"
+
+# seconds a statement can run in session - sqlcmd still running after that is hanging
+# and session is killed, so operation is not waiting forever
+SESSION_TIMEOUT = 3600
+
+# sqlcmd is not started with -b in session mode, so errors has to be found in output
+# severity above 10 is an error (same rule as used by sqlcmd -b)
+match_error = re.compile(r'^Msg \d+, Level (\d+), State \d+')
+
+
+class db_session(object):
+    """
+    Class for managing a persistent sqlcmd process on the host
+
+    One sqlcmd process is started and logged in once, and statements
+    are streamed to it over a named pipe. Every statement still needs one
+    execute_bash call, but it's not paying for sqlcmd process start and SQL login.
+
+    Only commands with a statement version (<command_name>_sql function)
+    in db_commands module can be run in session
+    """
+
+    def __init__(self, db_object):
+        self.__db_object = db_object
+        self.__session_dir = None
+        self.__counter = 0
+
+
+    @property
+    def session_dir(self):
+        return self.__session_dir
+
+
+    def start(self):
+        """
+        Start sqlcmd process on the host
+        Raise plugin_exception if process can't be started
+        """
+        logger.debug("db_session start")
+        output = self.__db_object.run_db_command("session_start")
+        self.__session_dir = output[-1]
+        logger.debug("sqlcmd session started in {}".format(self.__session_dir))
+
+
+    def run(self, command_name, **kargs):
+        """
+        Run a command_name in session and return output as list of lines
+        Raise plugin_exception if command failed
+        """
+        logger.debug("db_session run {}".format(command_name))
+        method_to_call = getattr(db_commands, "{}_sql".format(command_name))
+        self.__counter = self.__counter + 1
+        marker = "{} {}".format(MARKER, self.__counter)
+        lines = self.__db_object.run_db_command("session_exec", session_dir=self.__session_dir,
+                                                marker=marker, timeout=SESSION_TIMEOUT, script=method_to_call(**kargs))
+
+        for line in lines:
+            error = re.search(match_error, line)
+            if error and int(error.group(1)) > 10:
+                logger.debug("command {} failed in session".format(command_name))
+                raise plugin_exception(OS_Command_Response("\n".join(lines), "", 1))
+
+        return lines
+
+
+    def stop(self):
+        """
+        Stop sqlcmd process and remove session directory
+        Errors are only logged as session is not needed anymore
+        """
+        logger.debug("db_session stop")
+        if self.__session_dir is None:
+            return
+        try:
+            self.__db_object.run_db_command("session_stop", session_dir=self.__session_dir)
+        except plugin_exception:
+            logger.debug("can't stop sqlcmd session in {}".format(self.__session_dir))
+        self.__session_dir = None
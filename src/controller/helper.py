@@ -4,6 +4,7 @@
 
 import logging
 import re
+import time
 
 from dlpx.virtualization import libs
 from dlpx.virtualization.libs import exceptions
@@ -15,6 +16,8 @@ from dlpx.virtualization.libs import PlatformHandler
 
 from controller.os_command_response import OS_Command_Response
 from controller import os_commands
+from controller import host_facts
+from controller import tracing
 
 # logger object
 logger = logging.getLogger(__name__)
@@ -41,23 +44,6 @@ def setup_logger():
     logger.setLevel(logging.DEBUG)
 
 
-def find_ids(source_connection, install_path):
-    """ 
-    return the repository uid and gid
-    """
-    cmd = os_commands.get_ids(install_path)
-    ids = execute_bash(source_connection, cmd)
-    ids = re.search(r"[-rwx.]+\s\d\s([\d]+)\s([\d]+).*", ids.stdout)
-    if ids:
-        uid = int(ids.group(1))
-        gid = int(ids.group(2))
-    else:
-        uid = -1
-        gid = -1
-    logger.debug("repository user uid {} gid {}".format(uid, gid))
-    return (uid, gid)
-
-
 def make_nonprimary_connection(primary_connection, secondary_env_ref, secondary_user_ref):
     """
     Create a connection to 2nd server is VDB has more than one environment defined 
@@ -94,12 +80,34 @@ def execute_bash(source_connection, command_name, **kwargs ):
 
 
     logger.debug("Bash command: {}".format(command_name))
+    start = time.time()
     result = libs.run_bash(source_connection, command=command_name, variables=environment_vars, use_login_shell=True)
+    response = OS_Command_Response(result.stdout, result.stderr, result.exit_code)
+    try:
+        tracing.record(command_name, environment_vars, time.time() - start, response)
+    except Exception:
+        # command already ran - trace is only a diagnostic, so it can't fail the command
+        logger.debug("Can't record bash command in trace")
 
-    return OS_Command_Response(result.stdout, result.stderr, result.exit_code)
+    return response
 
 
 
+def iter_fields(data, separator="\0"):
+    """
+    Yield fields from data separated by separator
+    data is scanned in place without building a list of all fields
+    """
+    start = 0
+    while True:
+        end = data.find(separator, start)
+        if end == -1:
+            yield data[start:]
+            return
+        yield data[start:end]
+        start = end + 1
+
+
 def decode_list(data):
     rv = []
     for item in data:
@@ -142,6 +150,41 @@ def need_sudo(source_connection, repo_uid, repo_gid):
 def find_whoami(source_connection):
     """ 
     return the user env id
+    value is cached in host facts
+    """
+    (uid, gid) = host_facts.cached_fact(source_connection, "whoami", lambda: read_whoami(source_connection))
+    if uid == -1:
+        # don't keep a failed lookup
+        host_facts.invalidate(source_connection, "whoami")
+    return (uid, gid)
+
+
+def get_available_memory(source_connection):
+    """
+    return available memory on host in bytes or None if it can't be read
+    value is cached in host facts for a minute
+    """
+    memory = host_facts.cached_fact(source_connection, "memory:available", lambda: read_available_memory(source_connection), ttl=60)
+    if memory == -1:
+        host_facts.invalidate(source_connection, "memory:available")
+        return None
+    return memory
+
+
+def read_available_memory(source_connection):
+    """
+    read available memory (MemAvailable from /proc/meminfo) from host
+    """
+    memory = execute_bash(source_connection, os_commands.get_available_memory())
+    logger.debug("available memory output: {}".format(memory.stdout))
+    if memory.exit_code == 0 and memory.stdout.strip().isdigit():
+        return int(memory.stdout.strip()) * 1024
+    return -1
+
+
+def read_whoami(source_connection):
+    """ 
+    read the user env id from host
     """
 
     who = execute_bash(source_connection, os_commands.whoami())
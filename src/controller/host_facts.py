@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Cache of host facts (environment user and repository owner ids, available memory, source configs)
+# Facts are kept in plugin process memory and they are shared by all operations
+# running for same environment and environment user
+
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# default time to live of cached host facts (in seconds)
+DEFAULT_TTL = 600
+
+# key is a tuple (environment reference, user reference)
+# value is a dictionary of fact name -> (timestamp, value)
+host_facts = {}
+
+
+def connection_key(source_connection):
+    """
+    Return a cache key for connection - environment and user reference
+    """
+    return (source_connection.environment.reference, source_connection.user.reference)
+
+
+def get_fact(source_connection, name, ttl=DEFAULT_TTL):
+    """
+    Return a cached fact or None if fact is not cached or it's expired
+    """
+    facts = host_facts.get(connection_key(source_connection), {})
+    if name not in facts:
+        return None
+    (timestamp, value) = facts[name]
+    if time.time() - timestamp > ttl:
+        logger.debug("host fact {} expired".format(name))
+        del facts[name]
+        return None
+    return value
+
+
+def set_fact(source_connection, name, value):
+    """
+    Save a fact in cache
+    """
+    logger.debug("caching host fact {}: {}".format(name, value))
+    facts = host_facts.setdefault(connection_key(source_connection), {})
+    facts[name] = (time.time(), value)
+
+
+def cached_fact(source_connection, name, loader, ttl=DEFAULT_TTL):
+    """
+    Return a cached fact or call loader (without arguments) and cache returned value
+    """
+    value = get_fact(source_connection, name, ttl)
+    if value is None:
+        value = loader()
+        set_fact(source_connection, name, value)
+    else:
+        logger.debug("using cached host fact {}: {}".format(name, value))
+    return value
+
+
+def invalidate(source_connection=None, name=None):
+    """
+    Remove facts from cache
+    - for all connections if source_connection is None
+    - all facts for source_connection if name is None
+    - one fact for source_connection
+    """
+    if source_connection is None:
+        logger.debug("invalidate all host facts")
+        host_facts.clear()
+    elif name is None:
+        logger.debug("invalidate host facts for {}".format(connection_key(source_connection)))
+        host_facts.pop(connection_key(source_connection), None)
+    else:
+        host_facts.get(connection_key(source_connection), {}).pop(name, None)
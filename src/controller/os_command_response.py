@@ -4,6 +4,16 @@
 
 import logging
 
+def to_utf8(value):
+    """
+    Return value as UTF-8 string - run_bash output is unicode and output built from
+    lines of other responses is already a string
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
 class OS_Command_Response(object):
     """
     A class to pass a OS command response
@@ -12,8 +22,8 @@ class OS_Command_Response(object):
     """
     def __init__(self, stdout, stderr, exit_code):
         logger = logging.getLogger(__name__)
-        self.__stdout = stdout.encode('utf-8').strip()
-        self.__stderr = stderr.encode('utf-8').strip()
+        self.__stdout = to_utf8(stdout).strip()
+        self.__stderr = to_utf8(stderr).strip()
         self.__exit_code = int(exit_code)
         logger.debug("Command stdout is {}".format(self.__stdout))
         logger.debug("Command stderr is {}".format(self.__stderr))
@@ -59,27 +59,17 @@ def check_directory(dir_path, sudo=False, uid=None):
 
 
 def write_file(filename, data, sudo=False, uid=None):
+    # quoted heredoc - data is written as is without any shell expansion
     if sudo:
-        return "echo {data} | sudo -u \#{uid} tee {filename} > /dev/null ".format(filename=filename, data=data, uid=uid)
+        return "sudo -u \#{uid} tee {filename} > /dev/null << 'EOF'\n{data}\nEOF\n".format(filename=filename, data=data, uid=uid)
     else:
-        return "echo {data} | tee {filename} > /dev/null".format(filename=filename, data=data)
+        return "tee {filename} > /dev/null << 'EOF'\n{data}\nEOF\n".format(filename=filename, data=data)
 
 
 def get_ip_of_hostname():
     return "hostname -i"
 
 
-def get_ids(install_path):
-    return "ls -n {install_path}".format(install_path=install_path)
-
-
-def get_hostname(short=True):
-    if short:
-        return "hostname -s"
-    else:
-        return "hostname -f"
-
-
 def delete_file(filename, force=False, sudo=False, uid=None):
     if force:
         fopt = "-f"
@@ -120,16 +110,144 @@ def whoami():
     return "id"
 
 
-def sed(filename, regex):
-    return 'sed -i -e "{}" {}'.format(regex, filename)
+def prune_files(dir_path, pattern, keep, sudo=False, uid=None):
+    # remove all but keep most recently modified files matching pattern
+    # directory is listed by owner, as environment user may not be able to read it
+    if sudo:
+        return "sudo -u \#{uid} find {dir_path} -maxdepth 1 -name '{pattern}' -printf '%T@ %p\\n' 2>/dev/null | sort -rn | tail -n +{first} | cut -d ' ' -f 2- | xargs -r sudo -u \#{uid} rm -f".format(dir_path=dir_path, pattern=pattern, first=keep + 1, uid=uid)
+    else:
+        return "find {dir_path} -maxdepth 1 -name '{pattern}' -printf '%T@ %p\\n' 2>/dev/null | sort -rn | tail -n +{first} | cut -d ' ' -f 2- | xargs -r rm -f".format(dir_path=dir_path, pattern=pattern, first=keep + 1)
 
 
-def rpm(package_name):
-    return "rpm -q {package_name}".format(package_name=package_name)
+def touch_file(file_path, sudo=False, uid=None):
+    # set modification time to now
+    if sudo:
+        return "sudo -u \#{uid} touch -c {file_path}".format(file_path=file_path, uid=uid)
+    else:
+        return "touch -c {file_path}".format(file_path=file_path)
 
 
-def list_dir(dir_path, sudo=False, uid=None):
+def file_size(file_path, sudo=False, uid=None):
+    # size in bytes
     if sudo:
-        return """sudo -u \#{uid} ls -l --time-style="+%Y-%m-%d %H:%M:%S" {dir_path}""".format(dir_path=dir_path, uid=uid)
+        return "sudo -u \#{uid} stat -c %s {file_path}".format(file_path=file_path, uid=uid)
     else:
-        return """ls -l --time-style="+%Y-%m-%d %H:%M:%S" {dir_path}""".format(dir_path=dir_path)
\ No newline at end of file
+        return "stat -c %s {file_path}".format(file_path=file_path)
+
+
+def get_available_memory():
+    # MemAvailable in kB
+    return "awk '/^MemAvailable:/ {print $2}' /proc/meminfo"
+
+
+# Background job - command is started with nohup and output is written into job directory
+# so long running commands (ex. restore) can be monitored by polling job output
+
+def background_start(command):
+    return """job_dir=$(mktemp -d /tmp/dlpx_job.XXXXXX) || exit 1
+cat > $job_dir/cmd << 'DLPX_JOB_EOF'
+{command}
+DLPX_JOB_EOF
+touch $job_dir/out
+nohup setsid bash -c "bash $job_dir/cmd > $job_dir/out 2>&1; echo \\$? > $job_dir/rc.tmp; mv $job_dir/rc.tmp $job_dir/rc" > /dev/null 2>&1 &
+echo $! > $job_dir/pid
+echo $job_dir
+    """.format(command=command)
+
+
+def background_poll(job_dir, lines, wait):
+    """
+    Wait up to wait seconds for job to finish and print a line: DLPX-JOB <exit code|running|lost> <number of lines>
+    followed by output lines after first lines - only complete lines are printed while job is running
+    """
+    return """i=0
+while [ ! -f {job_dir}/rc ] && [ $i -lt {wait} ]; do sleep 1; i=$((i + 1)); done
+if [ -f {job_dir}/rc ]; then status=$(cat {job_dir}/rc)
+elif kill -0 $(cat {job_dir}/pid) 2>/dev/null; then status=running
+elif [ -f {job_dir}/rc ]; then status=$(cat {job_dir}/rc)
+else status=lost; fi
+total=$(wc -l < {job_dir}/out)
+echo "DLPX-JOB $status $total"
+if [ "$status" = running ]; then head -n $total {job_dir}/out | tail -n +$(({lines} + 1)); else tail -n +$(({lines} + 1)) {job_dir}/out; fi
+    """.format(job_dir=job_dir, lines=lines, wait=wait)
+
+
+def background_cleanup(job_dir):
+    """
+    Remove job directory - job which is still running (poll failed or operation was cancelled)
+    is killed with whole process group started by setsid and DLPX-JOB aborted is printed
+    """
+    return """if [ ! -f {job_dir}/rc ] && kill -0 $(cat {job_dir}/pid) 2>/dev/null; then
+    kill -TERM -- -$(cat {job_dir}/pid) 2>/dev/null
+    echo "DLPX-JOB aborted"
+fi
+rm -rf {job_dir}
+    """.format(job_dir=job_dir)
+
+
+def sed(filename, regex):
+    return 'sed -i -e "{}" {}'.format(regex, filename)
+
+
+def discovery_probe(server_package, client_package, server_path, client_path, conf_path, conf_pattern):
+    """
+    Print one JSON document with all facts needed by repository discovery:
+    installed server and client packages, server and client path (null if directory doesn't exist),
+    uid and gid of conf_path owner (-1 if missing), uid and gid of user, short hostname
+    and list of instances
+
+    Instance is defined by mssql.conf file - conf_path, files matching conf_pattern
+    and MSSQL_CONF of running sqlservr processes. For every instance there is a conf path,
+    owner ids, TCP port, default data directory, memory limit (0 if not set)
+    and running flag (port is listening)
+    """
+    return """json_string() {{ printf '"%s"' "$(printf '%s' "$1" | sed -e 's/\\\\/\\\\\\\\/g' -e 's/"/\\\\"/g')"; }}
+json_list() {{ sep=""; printf '['; while IFS= read -r line; do [ -n "$line" ] || continue; printf '%s' "$sep"; json_string "$line"; sep=", "; done; printf ']'; }}
+packages() {{ out=$(rpm -q $1 2>/dev/null) && printf '%s\\n' "$out" | json_list || printf '[]'; }}
+directory() {{ [ -d $1 ] && json_string $1 || printf 'null'; }}
+conf_value() {{ awk -v section="[$2]" -v key="$3" '/^[ \\t]*\\[/ {{ current = $1 }} current == section && index($0, "=") {{ name = substr($0, 1, index($0, "=") - 1); gsub(/[ \\t]/, "", name); if (name == key) {{ value = substr($0, index($0, "=") + 1); gsub(/^[ \\t]+|[ \\t\\r]+$/, "", value); print value; exit }} }}' $1 2>/dev/null; }}
+listening=$(awk '$4 == "0A" {{ split($2, a, ":"); print a[2] }}' /proc/net/tcp /proc/net/tcp6 2>/dev/null | sort -u)
+instance() {{
+    ids=$(stat -c '%u, %g' $1 2>/dev/null) || ids="-1, -1"
+    port=$(conf_value $1 network tcpport); port=${{port:-1433}}
+    data_dir=$(conf_value $1 filelocation defaultdatadir); data_dir=${{data_dir:-$(dirname $1)/data}}
+    memory=$(conf_value $1 memory memorylimitmb); memory=${{memory:-0}}
+    if echo "$listening" | grep -qx $(printf '%04X' $port); then running=true; else running=false; fi
+    printf '{{"conf_path": %s, "ids": [%s], "port": %s, "data_dir": %s, "memory_limit_mb": %s, "running": %s}}' \\
+        "$(json_string $1)" "$ids" "$port" "$(json_string $data_dir)" "$memory" "$running"
+}}
+instances() {{
+    sep=""; printf '['
+    for conf in $( (echo {conf_path}; ls -1 {conf_pattern} 2>/dev/null;
+                    for pid in $(pgrep -x sqlservr 2>/dev/null); do tr '\\0' '\\n' < /proc/$pid/environ 2>/dev/null | sed -n 's/^MSSQL_CONF=//p'; done) | awk '!seen[$0]++'); do
+        [ -f $conf ] || [ $conf = {conf_path} ] || continue
+        printf '%s' "$sep"; instance $conf; sep=", "
+    done
+    printf ']'
+}}
+ids=$(stat -c '%u, %g' {conf_path} 2>/dev/null) || ids="-1, -1"
+printf '{{"server_packages": %s, "client_packages": %s, ' "$(packages {server_package})" "$(packages {client_package})"
+printf '"server_path": %s, "client_path": %s, ' "$(directory {server_path})" "$(directory {client_path})"
+printf '"ids": [%s], "whoami": [%s, %s], ' "$ids" "$(id -u)" "$(id -g)"
+printf '"hostname": %s, "instances": %s}}\\n' "$(json_string "$(hostname -s)")" "$(instances)"
+    """.format(server_package=server_package, client_package=client_package, server_path=server_path,
+               client_path=client_path, conf_path=conf_path, conf_pattern=conf_pattern)
+
+
+def list_files(dir_path, pattern, newer_than=None, sudo=False, uid=None):
+    """
+    Print null delimited records: path, size, mtime, ctime (epoch) of files in dir_path matching pattern
+    followed by TOTAL and number of all matching files
+    If newer_than (epoch) is set, only files changed after are printed
+    """
+    if sudo:
+        find = "sudo -u \#{uid} find".format(uid=uid)
+    else:
+        find = "find"
+    if newer_than is not None:
+        newer = "-newerct '@{}'".format(newer_than)
+    else:
+        newer = ""
+    return """{find} {dir_path} -maxdepth 1 -type f -name '{pattern}' {newer} -printf '%p\\0%s\\0%T@\\0%C@\\0' && \
+printf 'TOTAL\\0' && {find} {dir_path} -maxdepth 1 -type f -name '{pattern}' -printf . | wc -c""".format(find=find, dir_path=dir_path, pattern=pattern, newer=newer)
+
@@ -26,3 +26,29 @@ class plugin_exception(Exception):
     def exit_code(self):
         return self.__exit_code
 
+
+
+class db_batch_exception(plugin_exception):
+    """
+    Class to define an exception raised when a command queued in a db_batch failed
+    stdout is limited to the output of the failing command
+    command_name and kargs point to the command which failed
+    """
+    def __init__(self, os_command_response, command_name, kargs, output):
+        super(db_batch_exception, self).__init__(os_command_response)
+        self.__command_name = command_name
+        self.__kargs = kargs
+        self.__output = output
+
+
+    @property
+    def stdout(self):
+        return self.__output
+
+    @property
+    def command_name(self):
+        return self.__command_name
+
+    @property
+    def kargs(self):
+        return self.__kargs
@@ -0,0 +1,190 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# sqlcmd columns are separated by ASCII unit separator, which is not expected in names,
+# paths or any other values, and trailing spaces are removed (-W)
+# column names are printed once for every result set, followed by a line of dashes
+FIELD_SEPARATOR = "\x1f"
+SQLCMD_OPTIONS = "-W -s $'\\x1f'"
+
+NULL = "NULL"
+
+
+class line_reader(object):
+    """
+    Read lines of command output one by one without splitting a whole output into a list
+    """
+
+    __slots__ = ("__output", "__position")
+
+    def __init__(self, output):
+        self.__output = output
+        self.__position = 0
+
+
+    def __line_at(self, position):
+        """
+        Return a tuple with line starting at position and position of next line
+        or (None, position) at end of output
+        """
+        if position >= len(self.__output):
+            return (None, position)
+        end = self.__output.find("\n", position)
+        if end == -1:
+            end = len(self.__output)
+        return (self.__output[position:end].rstrip("\r"), end + 1)
+
+
+    def peek(self, offset=0):
+        """
+        Return a line without reading it - offset is a number of lines to skip
+        """
+        position = self.__position
+        for i in range(offset + 1):
+            (line, position) = self.__line_at(position)
+        return line
+
+
+    def readline(self):
+        """
+        Return a next line or None at end of output
+        """
+        (line, self.__position) = self.__line_at(self.__position)
+        return line
+
+
+    def __iter__(self):
+        line = self.readline()
+        while line is not None:
+            yield line
+            line = self.readline()
+
+
+def is_dashes(line):
+    """
+    Check if line is a line of dashes printed after column names
+    """
+    return line is not None and line != "" and line.replace(FIELD_SEPARATOR, "").strip("-") == ""
+
+
+def is_header(reader):
+    """
+    Check if next line of reader is a column names line of a new result set
+    """
+    return bool(reader.peek()) and is_dashes(reader.peek(1))
+
+
+def read_result_sets(reader, stop=None):
+    """
+    Return a generator of result sets (see result_set class) read from line_reader
+    Lines between result sets which are not a result set (messages, empty lines) are skipped
+    stop is a function to check if line is ending a command output (ex. marker line)
+    Result set has to be read before a next one is returned, rows which were not read are skipped
+    """
+    while True:
+        line = reader.peek()
+        if line is None or (stop is not None and stop(line)):
+            return
+        if not is_header(reader):
+            reader.readline()
+            continue
+        columns = reader.readline().split(FIELD_SEPARATOR)
+        reader.readline()
+        rows = result_set(columns, reader, stop)
+        yield rows
+        rows.skip()
+
+
+def first_result_set(reader):
+    """
+    Return a first result set from line_reader or an empty list if there is no result set
+    """
+    return next(read_result_sets(reader), [])
+
+
+class result_set(object):
+    """
+    Rows of one sqlcmd result set read lazily from line_reader
+    Map of column name to column index is build once for result set
+
+    for row in result_set:
+        row["LogicalName"], row.number("FileId")
+    """
+
+    __slots__ = ("__columns", "__reader", "__stop", "__done")
+
+    def __init__(self, columns, reader, stop=None):
+        self.__columns = dict([ (name, index) for (index, name) in enumerate(columns) ])
+        self.__reader = reader
+        self.__stop = stop
+        self.__done = False
+
+
+    @property
+    def columns(self):
+        """
+        Dictionary column name -> column index
+        """
+        return self.__columns
+
+
+    def __iter__(self):
+        while not self.__done:
+            line = self.__reader.peek()
+            # result set is finished by empty line, end of output or a next result set
+            if not line or (self.__stop is not None and self.__stop(line)) or is_header(self.__reader):
+                self.__done = True
+                return
+            yield result_row(self.__reader.readline().split(FIELD_SEPARATOR), self.__columns)
+
+
+    def skip(self):
+        """
+        Skip all rows which were not read
+        """
+        for row in self:
+            pass
+
+
+class result_row(object):
+    """
+    One row of result set - values are accessed by column name, and NULL is returned as None
+    """
+
+    __slots__ = ("__values", "__columns")
+
+    def __init__(self, values, columns):
+        self.__values = values
+        self.__columns = columns
+
+
+    def __getitem__(self, name):
+        value = self.__values[self.__columns[name]]
+        if value == NULL:
+            return None
+        return value
+
+
+    def get(self, name, default=None):
+        """
+        Return a value of column name or default if there is no such column
+        """
+        if name not in self.__columns or self.__columns[name] >= len(self.__values):
+            return default
+        return self[name]
+
+
+    def number(self, name):
+        """
+        Return a value of column name as integer (LSN, size, id) or None for NULL
+        """
+        value = self.get(name)
+        if value is not None and value.isdigit():
+            return int(value)
+        return None
@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+
+import hashlib
+import json
+import logging
+import os
+
+from controller import os_commands
+from controller.helper import execute_bash
+from controller.plugin_exception import plugin_exception
+
+
+logger = logging.getLogger(__name__)
+
+
+def journal_path(db_object, operation):
+    """
+    Return a path of step journal of operation in .config directory
+    """
+    return os.path.join(db_object.config_path, "{}_journal_{}.json".format(db_object.get_db_name(), operation))
+
+
+def remove_journal(db_object, operation):
+    """
+    Remove step journal of operation, so next run is started from scratch
+    """
+    cmd = os_commands.delete_file(journal_path(db_object, operation), True, db_object.sudo, db_object.uid)
+    execute_bash(source_connection=db_object.config.connection, command_name=cmd)
+
+
+class step_journal(object):
+    """
+    Journal of finished steps of a long operation saved in .config directory
+
+    Every finished step is saved, so if operation is retried with same inputs
+    (backup files, positions, LSN, file list) steps which already finished are skipped.
+    Journal is removed when operation is finished. If inputs are different
+    journal is started from scratch.
+
+    journal = db_object.create_journal("start_staging", inputs)
+    journal.run("create_seed", self.create_seed, file_list)
+    ...
+    journal.finish()
+    """
+
+    def __init__(self, db_object, operation, inputs):
+        self.__db_object = db_object
+        self.__operation = operation
+        self.__inputs_hash = hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+        self.__file_path = journal_path(db_object, operation)
+        self.__steps = []
+        self.__pending = False
+        self.load()
+
+
+    @property
+    def steps(self):
+        return self.__steps
+
+
+    def load(self):
+        """
+        Load finished steps from journal file if it was saved for same inputs
+        """
+        try:
+            obj = self.__db_object.load_json(self.__file_path)
+        except (plugin_exception, ValueError):
+            return
+
+        if obj.get("inputs_hash") != self.__inputs_hash:
+            logger.debug("journal {} was saved for other inputs - starting from scratch".format(self.__operation))
+            return
+
+        self.__steps = [ str(x) for x in obj.get("steps", []) ]
+        self.__pending = len(self.__steps) > 0
+        logger.debug("journal {} - finished steps: {}".format(self.__operation, self.__steps))
+
+
+    def pending(self):
+        """
+        Return True if journal was loaded with finished steps, so interrupted operation is continued
+        """
+        return self.__pending
+
+
+    def run(self, step, function, *args, **kargs):
+        """
+        Run a function as a step - if step was finished before it's skipped
+        Return a function result or None for skipped step
+        """
+        if step in self.__steps:
+            logger.debug("journal {} - step {} already finished - skipping".format(self.__operation, step))
+            return None
+
+        result = function(*args, **kargs)
+        self.__steps.append(step)
+        try:
+            self.__db_object.save_json(self.__file_path, {
+                "operation": self.__operation,
+                "inputs_hash": self.__inputs_hash,
+                "steps": self.__steps
+            })
+        except plugin_exception:
+            # without journal operation is still OK - it will be restarted from beginning on retry
+            logger.debug("journal {} - can't save step {}".format(self.__operation, step))
+        return result
+
+
+    def finish(self):
+        """
+        Remove journal - operation is finished
+        """
+        logger.debug("journal {} finished".format(self.__operation))
+        self.reset()
+
+
+    def reset(self):
+        """
+        Remove journal and forget finished steps - operation is started from scratch
+        """
+        self.__steps = []
+        self.__pending = False
+        remove_journal(self.__db_object, self.__operation)
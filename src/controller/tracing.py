@@ -0,0 +1,166 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Execution tracing
+# Every execute_bash call (round trip to host) is recorded as a span with duration,
+# bytes sent and received and exit code. Spans are collected for a plugin operation
+# (see trace_operation used in plugin_runner.py) and a summary is logged when operation ends
+
+import functools
+import logging
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+# number of slowest calls in operation summary
+TOP_SPANS = 10
+
+# length of command text in slowest calls (commands are logged in full at debug level)
+COMMAND_TEXT = 60
+
+# trace of running plugin operation - plugin is running one operation at the time
+current_trace = None
+
+# stack of db_command names (see db_object.run_db_command) to tag spans
+db_commands = []
+
+
+class span(object):
+    """
+    One execute_bash call
+    """
+
+    __slots__ = ("operation", "db_command", "command", "seconds", "bytes_in", "bytes_out", "exit_code")
+
+    def __init__(self, operation, db_command, command, seconds, bytes_in, bytes_out, exit_code):
+        self.operation = operation
+        self.db_command = db_command
+        self.command = command
+        self.seconds = seconds
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.exit_code = exit_code
+
+
+    def __str__(self):
+        return "{} {:.3f}s in {}B out {}B exit {}".format(self.db_command or self.command, self.seconds,
+                                                         self.bytes_in, self.bytes_out, self.exit_code)
+
+
+class trace(object):
+    """
+    Spans of one plugin operation
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.spans = []
+        self.start = time.time()
+
+
+    def add(self, command, seconds, bytes_in, bytes_out, exit_code):
+        """
+        Add a span tagged with currently running db_command
+        """
+        # nested commands (ex. statement run in sqlcmd session) are joined with /
+        db_command = "/".join(db_commands) or None
+        command = " ".join(command.split())[:COMMAND_TEXT]
+        if isinstance(command, unicode):
+            command = command.encode('utf-8')
+        self.spans.append(span(self.operation, db_command, command, seconds, bytes_in, bytes_out, exit_code))
+
+
+    def summary(self, top=TOP_SPANS):
+        """
+        Return a list of summary lines - total round trips and time, time per db_command
+        and top slowest calls
+        """
+        seconds = time.time() - self.start
+        bash_seconds = sum([ x.seconds for x in self.spans ])
+        lines = [ "operation {}: {} round trips, {:.3f}s on host of {:.3f}s, in {}B out {}B".format(
+            self.operation, len(self.spans), bash_seconds, seconds,
+            sum([ x.bytes_in for x in self.spans ]), sum([ x.bytes_out for x in self.spans ])) ]
+
+        per_command = {}
+        for x in self.spans:
+            (count, total) = per_command.get(x.db_command or "bash", (0, 0))
+            per_command[x.db_command or "bash"] = (count + 1, total + x.seconds)
+        for (name, (count, total)) in sorted(per_command.items(), key=lambda x: -x[1][1]):
+            lines.append("  {}: {} calls {:.3f}s".format(name, count, total))
+
+        lines.append("  slowest calls:")
+        for x in sorted(self.spans, key=lambda x: -x.seconds)[:top]:
+            lines.append("    {}".format(x))
+        return lines
+
+
+def byte_length(value):
+    """
+    Return a size of value in bytes - unicode is counted as UTF-8
+    """
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(str(value))
+
+
+def record(command, environment_vars, seconds, response):
+    """
+    Record an execute_bash call in current trace
+    Values of environment variables (passwords) are counted as bytes sent, but never logged
+    """
+    bytes_in = byte_length(command) + sum([ byte_length(k) + byte_length(v) for (k, v) in environment_vars.items() ])
+    bytes_out = byte_length(response.stdout or "") + byte_length(response.stderr or "")
+    logger.debug("Bash command finished in {:.3f}s exit code {} in {}B out {}B".format(
+        seconds, response.exit_code, bytes_in, bytes_out))
+    if current_trace is not None:
+        current_trace.add(command, seconds, bytes_in, bytes_out, response.exit_code)
+
+
+@contextmanager
+def db_command(name):
+    """
+    Tag all execute_bash calls inside context with db_command name
+    """
+    db_commands.append(name)
+    try:
+        yield
+    finally:
+        db_commands.pop()
+
+
+def traced_db_command(method):
+    """
+    Decorator for db_object methods running a db_command - first argument is a command name
+    """
+    @functools.wraps(method)
+    def wrapper(self, command_name, *args, **kargs):
+        with db_command(command_name):
+            return method(self, command_name, *args, **kargs)
+    return wrapper
+
+
+@contextmanager
+def trace_operation(operation):
+    """
+    Collect spans of all execute_bash calls inside context and log a summary at the end
+    Nested operation is a part of outer one
+    """
+    global current_trace
+    if current_trace is not None:
+        yield current_trace
+        return
+
+    current_trace = trace(operation)
+    try:
+        yield current_trace
+    finally:
+        try:
+            for line in current_trace.summary():
+                logger.info(line)
+        except Exception:
+            # summary is only a diagnostic, so it can't fail the operation
+            logger.debug("Can't log summary of operation {}".format(operation))
+        current_trace = None
+
@@ -0,0 +1,146 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# catalog saved with other version is dropped and rebuilt
+CATALOG_VERSION = 4
+
+
+class backup_catalog(object):
+    """
+    Catalog of backup files found in backup location with parsed RESTORE HEADERONLY rows
+    Catalog is saved as JSON in dSource .config directory, and file entry is valid
+    as long as file size and modification time is the same as at probe time
+    Watermark is a newest change time (epoch) of all files in catalog, and it's used
+    to list only files changed since last scan
+
+    Catalog JSON format:
+    {
+        "version": CATALOG_VERSION,
+        "watermark": ctime,
+        "files": {
+            path: { "size": size, "mtime": mtime, "headers": [ header, ... ] }
+        }
+    }
+
+    Every header has a media set id and family number from RESTORE LABELONLY,
+    so stripes of one backup (media families) can be grouped into one backup set
+    """
+
+    def __init__(self, obj=None):
+        """
+        Create a catalog from loaded JSON object or an empty one if obj is None
+        """
+        self.__files = {}
+        self.__watermark = None
+        self.__changed = False
+        if obj is not None:
+            if obj.get("version") == CATALOG_VERSION:
+                self.__files = obj["files"]
+                self.__watermark = obj.get("watermark")
+            else:
+                logger.debug("backup catalog version {} is not supported - rebuilding".format(obj.get("version")))
+                self.__changed = True
+
+
+    @property
+    def changed(self):
+        return self.__changed
+
+    @property
+    def files(self):
+        return self.__files
+
+    @property
+    def watermark(self):
+        return self.__watermark
+
+    @watermark.setter
+    def watermark(self, value):
+        if value != self.__watermark:
+            self.__watermark = value
+            self.__changed = True
+
+
+    def to_json(self):
+        """
+        Return a catalog as object to save as JSON
+        """
+        return {
+            "version": CATALOG_VERSION,
+            "watermark": self.__watermark,
+            "files": self.__files
+        }
+
+
+    def lookup(self, path, size, mtime):
+        """
+        Return a list of headers for path or None if file is not in catalog
+        or it was changed since probe
+        """
+        entry = self.__files.get(path)
+        if entry is None:
+            return None
+        if entry["size"] != size or entry["mtime"] != mtime:
+            logger.debug("backup file {} changed since last probe".format(path))
+            return None
+        return entry["headers"]
+
+
+    def update(self, path, size, mtime, headers):
+        """
+        Save a list of headers for path
+        """
+        self.__files[path] = {
+            "size": size,
+            "mtime": mtime,
+            "headers": headers
+        }
+        self.__changed = True
+
+
+    def prune(self, existing_paths):
+        """
+        Remove entries for files which don't exist anymore
+        """
+        existing_paths = set(existing_paths)
+        for path in [ x for x in self.__files.keys() if x not in existing_paths ]:
+            logger.debug("removing {} from backup catalog".format(path))
+            del self.__files[path]
+            self.__changed = True
+
+
+    def backup_sets(self, file_list):
+        """
+        Return a list of backup sets for file_list (list of tuples path, size, mtime)
+        Headers from all stripes of a media set are merged into one backup set
+        with a list of files ordered by family number. Set is skipped if some stripes are missing.
+        """
+        backup_sets = []
+        stripes = {}
+        for (path, size, mtime) in file_list:
+            for header in self.lookup(path, size, mtime) or []:
+                if header.get("family_count", 1) > 1 and header.get("media_set_id"):
+                    key = (header["media_set_id"], header["position"])
+                    stripes.setdefault(key, []).append(header)
+                else:
+                    backup_set = dict(header)
+                    backup_set["files"] = [ path ]
+                    backup_sets.append(backup_set)
+
+        for (key, headers) in stripes.items():
+            families = dict([ (x["family_sequence"], x) for x in headers ])
+            headers = [ families[x] for x in sorted(families.keys()) ]
+            if len(headers) != headers[0]["family_count"]:
+                logger.debug("media set {} has {} of {} stripes - skipping".format(key[0], len(headers), headers[0]["family_count"]))
+                continue
+            backup_set = dict(headers[0])
+            backup_set["files"] = [ x["filename"] for x in headers ]
+            backup_sets.append(backup_set)
+
+        return backup_sets
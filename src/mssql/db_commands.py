@@ -3,22 +3,73 @@
 #
 
 from controller.helper import execute_bash
+from controller.result_set import SQLCMD_OPTIONS
+
+
+def sqlcmd_environment(password, port=None):
+    """
+    Return environment variables for sqlcmd - password and server, if instance is listening on port
+    If password is None, SQLCMDPASSWORD from environment user profile is used
+    """
+    env = {}
+    if password is not None:
+        env["SQLCMDPASSWORD"] = password
+    if port:
+        env["SQLCMDSERVER"] = "localhost,{}".format(port)
+    return env
+
+
+def sqlcmd_script(client_path, username, script):
+    """
+    Run a script with one or more GO terminated statements in a single sqlcmd invocation
+    Heredoc is quoted so shell is not expanding anything inside a script
+    """
+    return """{client_path}/sqlcmd -h -1 -b -U {username} << 'EOF'
+                    {script}
+                    EXIT
+EOF
+    """.format(client_path=client_path, username=username, script=script)
+
+
+def disk_list(backup_paths):
+    """
+    Return a FROM clause devices for a backup set - one DISK for every stripe (media family)
+    """
+    return ",\n                    ".join([ "DISK='{}'".format(x) for x in backup_paths ])
+
+
+def tuning_options(tuning):
+    """
+    Return a restore options for tuning dictionary (see restore_tuning module)
+    Options are prefixed with comma, so they can be appended to WITH clause
+    """
+    if not tuning:
+        return ""
+    options = []
+    for (option, key) in [("BUFFERCOUNT", "buffer_count"), ("MAXTRANSFERSIZE", "max_transfer_size"), ("BLOCKSIZE", "block_size")]:
+        if tuning.get(key):
+            options.append(", {}={}".format(option, tuning[key]))
+    return "".join(options)
+
+
+def list_db_names_sql():
+    return """SET NOCOUNT ON
+                    SELECT name from sys.databases
+                    GO"""
 
 
 def list_db_names(client_path, username):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} \
-        -Q "set nocount on; SELECT name from sys.databases"
-        """.format(client_path=client_path, username=username)
+    return sqlcmd_script(client_path, username, list_db_names_sql())
 
 
-def get_backup_file_info(client_path, username, backup_path):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} -s '|' <<EOF
+def get_backup_file_info(client_path, username, backup_paths):
+    return """{client_path}/sqlcmd -b -U {username} {options} <<EOF
                     SET NOCOUNT ON
-                    RESTORE FILELISTONLY FROM DISK='{backup_path}'
+                    RESTORE FILELISTONLY FROM {disks}
                     GO
                     EXIT
 EOF
-    """.format(client_path=client_path, username=username, backup_path=backup_path)
+    """.format(client_path=client_path, username=username, options=SQLCMD_OPTIONS, disks=disk_list(backup_paths))
 
 
 def get_last_backup(connection):
@@ -41,52 +92,87 @@ def get_last_backup(connection):
     return new_backups
 
 
-def get_backup_headers(client_path, username, backup_path):
-    return """{os_client_path}/sqlcmd -h -1 -b -U {username} -s '|' << EOF
-                    SET NOCOUNT ON
-                    RESTORE HEADERONLY FROM DISK='{backup_path}'
-                    GO
-                    EXIT
+def probe_backup_headers(client_path, username, backup_paths, parallelism):
+    """
+    Run RESTORE LABELONLY and RESTORE HEADERONLY for all backup_paths using up to parallelism sqlcmd processes
+    Output of every file is printed after a line: DLPX-PROBE <index in backup_paths> <sqlcmd exit code>
+    First line of output is a media label (used to find stripes of one media set) followed by headers
+    """
+    paths = "\n".join([ x.replace("'", "''") for x in backup_paths ])
+    return """probe_dir=$(mktemp -d /tmp/dlpx_probe.XXXXXX) || exit 1
+probe() {{
+    {client_path}/sqlcmd -b -U {username} {options} -Q "SET NOCOUNT ON; RESTORE LABELONLY FROM DISK='$2'; RESTORE HEADERONLY FROM DISK='$2'" > $probe_dir/$1.out 2>&1
+    echo $? > $probe_dir/$1.rc
+}}
+index=0
+while IFS= read -r backup_path; do
+    while [ $(jobs -rp | wc -l) -ge {parallelism} ]; do sleep 0.1; done
+    probe $index "$backup_path" &
+    index=$((index + 1))
+done << 'EOF'
+{paths}
 EOF
-        """.format(os_client_path=client_path, username=username, backup_path=backup_path)
+wait
+i=0
+while [ $i -lt $index ]; do
+    echo "DLPX-PROBE $i $(cat $probe_dir/$i.rc)"
+    cat $probe_dir/$i.out
+    i=$((i + 1))
+done
+rm -rf $probe_dir
+    """.format(client_path=client_path, username=username, options=SQLCMD_OPTIONS, paths=paths, parallelism=parallelism)
+
+
+def checkpoint_database_sql(database):
+    return """USE {database}
+                    GO
+                    CHECKPOINT
+                    GO
+                    USE master
+                    GO""".format(database=database)
+
+
+def checkpoint_database(client_path, database, username):
+    return sqlcmd_script(client_path, username, checkpoint_database_sql(database))
+
+
+def offline_mssql_sql(database):
+    return """ALTER DATABASE {database} SET offline WITH ROLLBACK IMMEDIATE
+                    GO""".format(database=database)
 
 
 def offline_mssql(client_path, database, username):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} SET offline WITH ROLLBACK IMMEDIATE
-                    GO
-                    EXIT
-EOF
-                    """.format(client_path=client_path, database=database, username=username)
+    return sqlcmd_script(client_path, username, offline_mssql_sql(database))
+
+
+def online_mssql_sql(database):
+    return """ALTER DATABASE {database} SET online
+                    GO""".format(database=database)
 
 
 def online_mssql(client_path, database, username):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} SET online
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username)
+    return sqlcmd_script(client_path, username, online_mssql_sql(database))
+
+
+def drop_database_sql(database):
+    return """DROP DATABASE {database}
+                    GO""".format(database=database)
 
 
 def drop_database(client_path, database, username):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    DROP DATABASE {database}
-                    GO
-                    EXIT
-EOF
-                    """.format(client_path=client_path, database=database, username=username)
+    return sqlcmd_script(client_path, username, drop_database_sql(database))
 
 
 def get_mssql_databases_fileinfo(client_path, database, username):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} -d {database} -s '|' << EOF
+    return """{client_path}/sqlcmd -b -U {username} -d {database} {options} << EOF
                     SET NOCOUNT ON
-                    select f.name, f.file_id, f.physical_name, case f.type when 0 then 'D' when 1 then 'L' end, fg.name as filegroup
+                    select f.name as LogicalName, f.file_id as FileId, f.physical_name as PhysicalName,
+                    case f.type when 0 then 'D' when 1 then 'L' end as Type, fg.name as FileGroupName
                     from sys.database_files f left join sys.filegroups fg on f.data_space_id = fg.data_space_id
                     GO
                     EXIT
 EOF
-            """.format(client_path=client_path, database=database, username=username)
+            """.format(client_path=client_path, database=database, username=username, options=SQLCMD_OPTIONS)
 
 
 def list_existing_mssql_databases(client_path, database, username):
@@ -102,69 +188,179 @@ EOF
                     """.format(client_path=client_path, database=database, username=username)
 
 
-def get_mssql_databases_status(client_path, database, username):
-    return """{client_path}/sqlcmd -h -1 -U {username} -s '|' -Q 'set nocount on; SELECT state_desc from sys.databases where name = "{database}" ' """.format(client_path=client_path, database=database, username=username)
-
-# Need update with a loop to create the correct number of files
-# and by the {username}me associating theme to the correct filegroup(s)
+def get_mssql_databases_status_sql(database):
+    return """SET NOCOUNT ON
+                    SELECT state_desc from sys.databases where name = '{database}'
+                    GO""".format(database=database)
 
 
-def create_target_mssql_vdb(client_path, database, username, filename, physical_filename, logname, physical_logname):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
+def get_mssql_databases_status(client_path, database, username):
+    return sqlcmd_script(client_path, username, get_mssql_databases_status_sql(database))
+
+
+# columns of database state used by status checks (see mssql_status module)
+DATABASE_STATE_COLUMNS = "name, state_desc, is_in_standby, is_read_only"
+
+
+def get_databases_state_cached(client_path, username, cache_path, ttl, login_timeout, query_timeout, sudo=False, uid=None):
+    """
+    Print a line: DLPX-STATE <cache age in seconds> followed by a result set with state of all databases
+    Result set is read from host-wide cache file, which is refreshed by one query if it's older than ttl
+    Cache is written by repository owner (sudo) and new file is renamed into place, so readers never see partial file
+    Refresh is serialized with flock - lock file is created by repository owner and opened read only,
+    so environment user can lock it too (lock is only stopping concurrent refreshes)
+    If cache can't be written, query output is printed anyway
+    Exit code is not 0 if cache is stale and query failed
+    """
+    if sudo:
+        run = "sudo -u \#{uid} ".format(uid=uid)
+    else:
+        run = ""
+    return """cache={cache_path}
+age() {{ modified=$({run}stat -c %Y $cache 2>/dev/null) && echo $(( $(date +%s) - modified )) || echo -1; }}
+state_age=$(age)
+if [ $state_age -lt 0 ] || [ $state_age -ge {ttl} ]; then
+    {run}mkdir -p -m 755 $(dirname $cache) 2>/dev/null
+    [ -f $cache.lock ] || {{ {run}touch $cache.lock && {run}chmod 644 $cache.lock; }} 2>/dev/null
+    {{ exec 9<$cache.lock && flock -w {query_timeout} 9; }} 2>/dev/null
+    state_age=$(age)
+    if [ $state_age -lt 0 ] || [ $state_age -ge {ttl} ]; then
+        output=$({client_path}/sqlcmd -b -l {login_timeout} -t {query_timeout} -U {username} {options} -Q "SET NOCOUNT ON; SELECT {columns} FROM sys.databases" 2>&1) || {{ printf '%s\\n' "$output"; exit 1; }}
+        printf '%s\\n' "$output" | {run}tee $cache.$$ > /dev/null 2>&1 && {run}chmod 644 $cache.$$ && {run}mv -f $cache.$$ $cache || {run}rm -f $cache.$$ 2>/dev/null
+        echo "DLPX-STATE 0"
+        printf '%s\\n' "$output"
+        exit 0
+    fi
+fi
+echo "DLPX-STATE $state_age"
+{run}cat $cache
+    """.format(client_path=client_path, username=username, options=SQLCMD_OPTIONS, cache_path=cache_path, ttl=ttl,
+               login_timeout=login_timeout, query_timeout=query_timeout, columns=DATABASE_STATE_COLUMNS, run=run)
+
+
+def get_database_state(client_path, database, username, login_timeout, query_timeout):
+    """
+    Print a result set with state of database - sqlcmd is failing if instance is not answering
+    within login_timeout or query is running longer than query_timeout seconds
+    """
+    return """{client_path}/sqlcmd -b -l {login_timeout} -t {query_timeout} -U {username} {options} -Q "SET NOCOUNT ON; SELECT {columns} FROM sys.databases WHERE name = '{database}'"
+    """.format(client_path=client_path, username=username, options=SQLCMD_OPTIONS, database=database,
+               login_timeout=login_timeout, query_timeout=query_timeout, columns=DATABASE_STATE_COLUMNS)
+
+
+def list_source_databases(client_path, login_timeout, query_timeout):
+    """
+    Print a result set with all user databases and their state, size, file count, recovery model,
+    last full, differential and log backup and average log backup interval over last 7 days from msdb
+    There is no instance user for source config discovery, so sqlcmd is using SQLCMDUSER and SQLCMDPASSWORD
+    from environment user profile - DLPX-NO-CREDENTIALS is printed if they are not set
+    """
+    return """[ -n "$SQLCMDUSER" ] || {{ echo DLPX-NO-CREDENTIALS; exit 0; }}
+{client_path}/sqlcmd -b -l {login_timeout} -t {query_timeout} {options} << 'EOF'
                     SET NOCOUNT ON
+                    SELECT d.name, d.state_desc, d.is_in_standby, d.recovery_model_desc, f.size_mb, f.file_count,
+                    CONVERT(varchar(19), b.last_full, 120) AS last_full,
+                    CONVERT(varchar(19), b.last_diff, 120) AS last_diff,
+                    CONVERT(varchar(19), b.last_log, 120) AS last_log,
+                    DATEDIFF(minute, b.first_recent_log, b.last_recent_log) / NULLIF(b.recent_logs - 1, 0) AS log_interval_min
+                    FROM sys.databases d
+                    LEFT JOIN (SELECT database_id, SUM(CAST(size AS bigint)) * 8 / 1024 AS size_mb, COUNT(*) AS file_count
+                               FROM sys.master_files GROUP BY database_id) f ON f.database_id = d.database_id
+                    LEFT JOIN (SELECT database_name,
+                               MAX(CASE WHEN type = 'D' THEN backup_finish_date END) AS last_full,
+                               MAX(CASE WHEN type = 'I' THEN backup_finish_date END) AS last_diff,
+                               MAX(CASE WHEN type = 'L' THEN backup_finish_date END) AS last_log,
+                               MIN(CASE WHEN type = 'L' AND backup_finish_date > DATEADD(day, -7, GETDATE()) THEN backup_finish_date END) AS first_recent_log,
+                               MAX(CASE WHEN type = 'L' AND backup_finish_date > DATEADD(day, -7, GETDATE()) THEN backup_finish_date END) AS last_recent_log,
+                               SUM(CASE WHEN type = 'L' AND backup_finish_date > DATEADD(day, -7, GETDATE()) THEN 1 ELSE 0 END) AS recent_logs
+                               FROM msdb.dbo.backupset GROUP BY database_name) b ON b.database_name = d.name
+                    WHERE d.database_id > 4
+                    ORDER BY d.name
+                    GO
+                    EXIT
+EOF
+    """.format(client_path=client_path, login_timeout=login_timeout, query_timeout=query_timeout, options=SQLCMD_OPTIONS)
+
+
+def create_target_mssql_vdb_sql(database, filename, physical_filename, logname, physical_logname):
+    return """SET NOCOUNT ON
                     USE master
                     GO
                     CREATE DATABASE {database}
                     ON PRIMARY(NAME={filename}, FILENAME='{physical_filename}')
                     LOG ON(NAME={logname}, FILENAME='{physical_logname}')
-                    GO
-                    EXIT
-EOF
-                    """.format(client_path=client_path, database=database, username=username, filename=filename, physical_filename=physical_filename,
+                    GO""".format(database=database, filename=filename, physical_filename=physical_filename,
                                logname=logname, physical_logname=physical_logname)
 
+
+def create_target_mssql_vdb(client_path, database, username, filename, physical_filename, logname, physical_logname):
+    return sqlcmd_script(client_path, username, create_target_mssql_vdb_sql(database, filename, physical_filename, logname, physical_logname))
+
 # Need update with a loop to associate the logical files
 # with the correct physical file destination on staging
 
 
-def restore_full_backup(client_path, database, username, backup_path, mount_path, move, position):
+def restore_full_backup(client_path, database, username, backup_paths, mount_path, move, position, tuning=None, stats=10):
     return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
                     SET NOCOUNT ON
                     RESTORE DATABASE {database}_staging
-                    FROM DISK='{backup_path}'
+                    FROM {disks}
                     WITH STANDBY='{mount_path}/standby.bak',
-                    FILE={position},
+                    FILE={position}, STATS={stats}{tuning},
                     {move}
                     GO
                     EXIT
 EOF
-                    """.format(client_path=client_path, database=database, username=username, backup_path=backup_path, mount_path=mount_path, move=move, position=position)
+                    """.format(client_path=client_path, database=database, username=username, disks=disk_list(backup_paths), mount_path=mount_path, move=move, position=position, tuning=tuning_options(tuning), stats=stats)
 
 
-def restore_full_backup_for_upgrade(client_path, database, username, backup_path, mount_path, move, position):
+def restore_full_backup_for_upgrade(client_path, database, username, backup_paths, mount_path, move, position, tuning=None, stats=10):
     return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
                     SET NOCOUNT ON
                     RESTORE DATABASE {database}_staging
-                    FROM DISK='{backup_path}'
+                    FROM {disks}
                     WITH NORECOVERY,
-                    FILE={position},
+                    FILE={position}, STATS={stats}{tuning},
                     {move}
                     GO
                     EXIT
 EOF
-                    """.format(client_path=client_path, database=database, username=username, backup_path=backup_path, mount_path=mount_path, move=move, position=position)
+                    """.format(client_path=client_path, database=database, username=username, disks=disk_list(backup_paths), mount_path=mount_path, move=move, position=position, tuning=tuning_options(tuning), stats=stats)
 
 
-def restore_transactionlog_backup(client_path, database, username, backup_location, mount_path):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    SET NOCOUNT ON
-                    RESTORE LOG  ${database}_staging
-                    FROM DISK='{backup_location}'
-                    WITH STANDBY='{mount_path}/standby.bak'
-                    GO
-                    EXIT
-EOF
-                    """.format(client_path=client_path, database=database, username=username, backup_location=backup_location, mount_path=mount_path)
+# statements used to apply a run of transaction logs in one script (see mssql_ctl.restore_log_run)
+# all logs except the last one are restored WITH NORECOVERY, so standby file is written only once
+
+def restore_log_norecovery_sql(database, backup_paths, position):
+    return """SET NOCOUNT ON
+                    RESTORE LOG {database}
+                    FROM {disks}
+                    WITH NORECOVERY,
+                    FILE={position}
+                    GO""".format(database=database, disks=disk_list(backup_paths), position=position)
+
+
+def restore_log_standby_sql(database, backup_paths, position, standby_path):
+    return """SET NOCOUNT ON
+                    RESTORE LOG {database}
+                    FROM {disks}
+                    WITH STANDBY='{standby_path}',
+                    FILE={position}
+                    GO""".format(database=database, disks=disk_list(backup_paths), position=position, standby_path=standby_path)
+
+
+def get_last_restored_lsn_sql(database):
+    return """SET NOCOUNT ON
+                    SELECT TOP 1 bs.last_lsn
+                    FROM msdb.dbo.restorehistory rh
+                    JOIN msdb.dbo.backupset bs ON rh.backup_set_id = bs.backup_set_id
+                    WHERE rh.destination_database_name = '{database}'
+                    ORDER BY rh.restore_history_id DESC
+                    GO""".format(database=database)
+
+
+def get_last_restored_lsn(client_path, database, username):
+    return sqlcmd_script(client_path, username, get_last_restored_lsn_sql(database))
 
 
 def get_last_allied_backup(client_path, username):
@@ -196,73 +392,46 @@ EOF
 
 # SELECT count(1) groupexist FROM sys.filegroups where name='$fileGroup'
 
-def create_filegroup(client_path, database, username, filegroup):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} ADD FILEGROUP {filegroup}
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, filegroup=filegroup)
-
+def create_filegroup_sql(database, filegroup):
+    return """ALTER DATABASE {database} ADD FILEGROUP {filegroup}
+                    GO""".format(database=database, filegroup=filegroup)
 
-def add_datafile_to_group(client_path, database, username, filegroup, filename, physical_filename):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} ADD FILE
-                    (name = "{filename}" , filename = "{physical_filename}") TO FILEGROUP {filegroup}
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, filegroup=filegroup, filename=filename, physical_filename=physical_filename)
 
-
-def add_datafile(client_path, database, username, filename, physical_filename):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} ADD FILE
+def create_filegroup(client_path, database, username, filegroup):
+    return sqlcmd_script(client_path, username, create_filegroup_sql(database, filegroup))
+
+
+def add_files_sql(database, filegroup, filetype, files):
+    """
+    Add a list of files (tuples logical name, physical name) in one statement
+    File ids are assigned in order of the list
+    """
+    filespecs = ",\n                    ".join([ """(name = "{}" , filename = "{}")""".format(name, physical) for (name, physical) in files ])
+    if filetype == "L":
+        return """ALTER DATABASE {database} ADD LOG FILE
+                    {filespecs}
+                    GO""".format(database=database, filespecs=filespecs)
+    else:
+        return """ALTER DATABASE {database} ADD FILE
+                    {filespecs}
+                    TO FILEGROUP [{filegroup}]
+                    GO""".format(database=database, filespecs=filespecs, filegroup=filegroup)
+
+
+def remove_files_sql(database, filenames):
+    # files are empty (never used) so they can be removed without shrink
+    return """{statements}
+                    GO""".format(statements="\n                    ".join([ "ALTER DATABASE {} REMOVE FILE [{}]".format(database, x) for x in filenames ]))
+
+
+def rename_datafile_sql(database, filename, physical_filename):
+    return """ALTER DATABASE {database} MODIFY FILE
                     (name = "{filename}" , filename = "{physical_filename}")
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, filename=filename, physical_filename=physical_filename)
-
-
-def add_logfile(client_path, database, username, logfile, physical_logfile):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} ADD LOG FILE
-                    (name = "{logfile}" , filename = "{physical_logfile}")
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, logfile=logfile, physical_logfile=physical_logfile)
-
-
-def drop_datafile(client_path, database, username, filename):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} REMOVE FILE {filename}
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, filename=filename)
-
-
-def shrink_datafile(client_path, database, username, filename):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    USE {database}
-                    GO
-                    DBCC SHRINKFILE ('{filename}', EMPTYFILE)
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, filename=filename)
+                    GO""".format(database=database, filename=filename, physical_filename=physical_filename)
 
 
 def rename_datafile(client_path, database, username, filename, physical_filename):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-                    ALTER DATABASE {database} MODIFY FILE
-                    (name = "{filename}" , filename = "{physical_filename}")
-                    GO
-            EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, filename=filename, physical_filename=physical_filename)
+    return sqlcmd_script(client_path, username, rename_datafile_sql(database, filename, physical_filename))
 
 # ALTER DATABASE [$databaseName] ADD FILE (name = N'$logicalName', filename = N'$physicalPath') TO FILEGROUP [$fileGroup]
 
@@ -287,55 +456,149 @@ EOF
         """.format(os_client_path=os_client_path, database=database)
 
 
+def attach_database_sql(database, files):
+    return """CREATE DATABASE {database} ON
+                    {files}
+                    FOR ATTACH
+                    GO""".format(database=database, files=files)
+
+
 def attach_database(client_path, database, username, files):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-    CREATE DATABASE {database} ON 
-    {files}
-    FOR ATTACH
-    GO
-    EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, files=files)
+    return sqlcmd_script(client_path, username, attach_database_sql(database, files))
+
+
+def detach_database_sql(database):
+    return """exec sp_detach_db '{database}', True
+                    GO""".format(database=database)
+
 
 def detach_database(client_path, database, username):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-    exec sp_detach_db '{database}', True
-    GO
-    EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username)
+    return sqlcmd_script(client_path, username, detach_database_sql(database))
 
 
-def backup_database(client_path, database, username, backup_path):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-    backup database {database} to disk='{backup_path}'
-    GO
-    EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, backup_path=backup_path)
+def compression_option(compression):
+    # backup compression is not supported by all editions (ex. Express)
+    if compression:
+        return ", COMPRESSION"
+    return ""
+
+
+def backup_database_sql(database, backup_path, compression=False):
+    return """backup database {database} to disk='{backup_path}' WITH INIT, FORMAT, COPY_ONLY{compression}
+                    GO""".format(database=database, backup_path=backup_path, compression=compression_option(compression))
+
+
+def backup_database(client_path, database, username, backup_path, compression=False):
+    return sqlcmd_script(client_path, username, backup_database_sql(database, backup_path, compression))
+
+
+def restore_seed_database_sql(database, backup_path, move=None, tuning=None):
+    if move:
+        move = ", " + move
+    return """restore database {database} from disk='{backup_path}' WITH NORECOVERY, REPLACE{move}{tuning}
+                    GO""".format(database=database, backup_path=backup_path, move=move or "", tuning=tuning_options(tuning))
+
+
+def restore_seed_database(client_path, database, username, backup_path, move=None, tuning=None):
+    return sqlcmd_script(client_path, username, restore_seed_database_sql(database, backup_path, move, tuning))
 
-def restore_seed_database(client_path, database, username, backup_path):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-    restore database {database} from disk='{backup_path}' WITH NORECOVERY, REPLACE
-    GO
-    EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username, backup_path=backup_path)
+
+# seed template cache (see mssql_ctl.create_seed)
+
+def backup_seed_template_sql(database, backup_path, compression=False):
+    return """BACKUP DATABASE {database} TO DISK='{backup_path}' WITH INIT, FORMAT, COPY_ONLY{compression}
+                    GO""".format(database=database, backup_path=backup_path, compression=compression_option(compression))
+
+
+def backup_seed_template(client_path, database, username, backup_path, compression=False):
+    return sqlcmd_script(client_path, username, backup_seed_template_sql(database, backup_path, compression))
+
+
+def restore_seed_template_sql(database, backup_path, move):
+    return """RESTORE DATABASE {database} FROM DISK='{backup_path}' WITH RECOVERY, REPLACE,
+                    {move}
+                    GO""".format(database=database, backup_path=backup_path, move=move)
+
+
+def restore_seed_template(client_path, database, username, backup_path, move):
+    return sqlcmd_script(client_path, username, restore_seed_template_sql(database, backup_path, move))
+
+
+def restore_norecovery_only_sql(database):
+    return """restore database {database} WITH NORECOVERY
+                    GO""".format(database=database)
 
 
 def restore_norecovery_only(client_path, database, username):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-    restore database {database} WITH NORECOVERY
-    GO
-    EXIT
-EOF
-    """.format(client_path=client_path, database=database, username=username)
+    return sqlcmd_script(client_path, username, restore_norecovery_only_sql(database))
+
+
+def restore_standby_sql(database, standby_path):
+    return """restore database {database} WITH standby='{standby_path}'
+                    GO""".format(database=database, standby_path=standby_path)
 
 
 def restore_standby(client_path, database, username, standby_path):
-    return """{client_path}/sqlcmd -h -1 -b -U {username} << EOF
-    restore database {database} WITH standby='{standby_path}'
-    GO
-    EXIT
+    return sqlcmd_script(client_path, username, restore_standby_sql(database, standby_path))
+
+
+# Persistent sqlcmd session (see db_session class)
+# sqlcmd is reading statements from a named pipe, and output is written into a file
+# stdin is opened in read-write mode so sqlcmd is not getting EOF between statements
+
+def session_start(client_path, username):
+    return """session_dir=$(mktemp -d /tmp/dlpx_sqlcmd.XXXXXX) || exit 1
+cd $session_dir && mkfifo -m 600 in && touch out || exit 1
+if which stdbuf > /dev/null 2>&1; then linebuf="stdbuf -oL"; else linebuf=""; fi
+nohup setsid $linebuf {client_path}/sqlcmd -h -1 -s '|' -U {username} 0<>in > out 2>&1 &
+echo $! > pid
+sleep 0.2
+if ! kill -0 $(cat pid) 2>/dev/null; then cat out; rm -rf $session_dir; exit 1; fi
+echo $session_dir
+    """.format(client_path=client_path, username=username)
+
+
+def session_exec(client_path, username, session_dir, marker, timeout, script):
+    """
+    Send script to sqlcmd session and print its output - if marker is not printed within
+    timeout seconds, sqlcmd process group is killed and exit code is 3
+    Pipe is opened read-write, so write is not blocked if sqlcmd died meanwhile
+    """
+    return """cd {session_dir} || exit 2
+pid=$(cat pid)
+if ! kill -0 $pid 2>/dev/null; then echo "sqlcmd session process is not running" >&2; exit 2; fi
+offset=$(stat -c %s out)
+start=$(date +%s)
+cat 1<> in << 'EOF'
+                    {script}
+                    PRINT '{marker}'
+                    GO
 EOF
-    """.format(client_path=client_path, database=database, username=username, standby_path=standby_path)
+while ! tail -c +$((offset + 1)) out | grep -q '^{marker}$'; do
+    if ! kill -0 $pid 2>/dev/null; then
+        tail -c +$((offset + 1)) out
+        echo "sqlcmd session process is not running" >&2
+        exit 2
+    fi
+    if [ $(( $(date +%s) - start )) -ge {timeout} ]; then
+        tail -c +$((offset + 1)) out
+        kill -TERM -- -$pid 2>/dev/null || kill -TERM $pid 2>/dev/null
+        echo "sqlcmd session is not answering for {timeout}s - session was killed" >&2
+        exit 3
+    fi
+    sleep 0.1
+done
+tail -c +$((offset + 1)) out | sed '/^{marker}$/,$d'
+    """.format(session_dir=session_dir, marker=marker, timeout=timeout, script=script)
+
+
+def session_stop(client_path, username, session_dir):
+    return """cd {session_dir} || exit 0
+pid=$(cat pid)
+if kill -0 $pid 2>/dev/null; then
+    echo EXIT 1<> in
+    sleep 0.2
+    kill $pid 2>/dev/null
+fi
+cd / && rm -rf {session_dir}
+    """.format(session_dir=session_dir)
@@ -9,6 +9,8 @@ import re
 import json
 import ntpath
 import datetime
+import time
+import hashlib
 
 from controller.config_meta import config_meta
 from dlpx.virtualization.platform import Status
@@ -19,11 +21,56 @@ from controller import os_commands
 from controller.helper import execute_bash
 from controller.helper import need_sudo
 from controller.plugin_exception import plugin_exception
+from controller.plugin_exception import db_batch_exception
 from controller.db_object import db_object
+from controller.helper import decode_dict
+from controller.helper import iter_fields
+from controller.helper import get_available_memory
+from controller.result_set import read_result_sets
+from controller.result_set import first_result_set
+from mssql.backup_catalog import backup_catalog
+from mssql import restore_planner
+from mssql import restore_tuning
+from mssql import restore_stats
+from mssql import mssql_status
 
 
 logger = logging.getLogger(__name__)
 
+# number of restores kept in restore metrics file
+RESTORE_METRICS_KEEP = 100
+
+# seed templates (backups of empty seed databases) shared by all dSources and VDBs of instance
+# directory is kept in plugin directory of instance, as it has to be writable by SQL Server
+SEED_CACHE_DIR = "seed_cache"
+SEED_CACHE_KEEP = 20
+
+# number of VDB provisions kept in provision history file
+PROVISION_HISTORY_KEEP = 50
+
+# number of dSource enables kept in enable metrics file
+ENABLE_METRICS_KEEP = 50
+
+ATTACH = "attach"
+SEED = "seed"
+
+# state of database left by steps of interrupted create_vdb and start_staging -
+# finished steps are skipped only if database is still in that state
+CREATE_VDB_STATES = {
+    "create_seed": "ONLINE",
+    "offline_vdb": "OFFLINE",
+    "replace_files": "OFFLINE",
+    "online_vdb": "ONLINE"
+}
+START_STAGING_STATES = {
+    "restore_seed_database": "RESTORING",
+    "replace_files": "RESTORING"
+}
+
+# Msg 1844, Level 16, State 1, Server host, Line 1
+# BACKUP DATABASE WITH COMPRESSION is not supported on Express Edition (64-bit).
+match_compression_not_supported = re.compile(r"Msg 1844,|WITH COMPRESSION is not supported")
+
 
 class mssql_ctl(db_object):
     """
@@ -31,6 +78,8 @@ class mssql_ctl(db_object):
     It has methods for cluster wide operations like start, stop, create or restore
     """
 
+    __slots__ = ("__seed_path",)
+
     def __init__(self, **kargs):
         """
         Class constructor
@@ -47,60 +96,29 @@ class mssql_ctl(db_object):
         logger.debug("initialize mssql_ctl")
         # Initializing the parent class constructor
         super(mssql_ctl, self).__init__(**kargs)
-        self.__seed_path = os.path.join(self.config.parameters.mount_path, '.seed')
+        # seed path is set on first access
+        self.__seed_path = None
 
     @property
     def seed_path(self):
+        if self.__seed_path is None:
+            self.__seed_path = os.path.join(self.config.parameters.mount_path, '.seed')
         return self.__seed_path
 
 
-    def apply_fresh_backups(self, client_path, username, backup_path, backup_location):
-        last_applied = self.run_db_command("get_mssql_backup_infos")
-        last_applied = last_applied.split('/')
-        last_applied = last_applied[0].strip()
-        last_applied = datetime.strptime(last_applied, '%Y-%m-%d %H:%M:%S.%f')
-        new_backups = self.run_db_command("get_last_backup")
-        for backup in new_backups:
-            for timestamp, backup_file in backup.items():
-                timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S%f')
-                if timestamp > last_applied:
-                    #       print "Backup to be applied : " + backup_file
-                    backup = "Full"
-                    if backup == "Full":
-                        print("call <restore backup...> function")
-                    elif backup == "Transaction log":
-                        print("call <restore log...> function ")
-                    elif backup == "Differential database":
-                        print("call <restore backup...>function")
-                    else:
-                        print("not yet supported")
-
-        return False
-
-
-    def get_backup_file_info(self, backup_path):
+    def get_backup_file_info(self, backup_paths):
         logger.debug("get_backup_file_info")
         filelist = []
 
         try:
-            filesinfo = self.run_db_command(
-                "get_backup_file_info", backup_path=backup_path)
+            filesinfo = self.query_db_command(
+                "get_backup_file_info", backup_paths=backup_paths)
         except plugin_exception as p:
             raise UserError("Restore filelist failure from path {}".format(
-                backup_path), action="Check if you are restoring valid backup", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
-
-        for line in filesinfo:
-            cols = line.split('|')
-            (logicalfilename, physicalfilename,
-             filetype, filegroupname) = cols[:4]
-            fileid = cols[6]
-            filedef = {
-                "logicalname": logicalfilename.strip(),
-                "physicalname": ntpath.basename(physicalfilename.strip()),
-                "filetype": filetype.strip(),
-                "groupname": filegroupname.strip(),
-                "fileid": int(fileid.strip())
-            }
+                ", ".join(backup_paths)), action="Check if you are restoring valid backup", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+
+        for row in first_result_set(filesinfo):
+            filedef = self.parse_file_row(row)
             logger.debug(filedef)
             filelist.append(filedef)
         return filelist
@@ -113,31 +131,82 @@ class mssql_ctl(db_object):
         else:
             dbname = self.get_db_name()
         try:
-            filesinfo = self.run_db_command(
+            filesinfo = self.query_db_command(
                 "get_mssql_databases_fileinfo", database=dbname)
         except plugin_exception as p:
             raise UserError("Reading data file list from database {} failed".format(
                 dbname), action="Check if this is a valid database and if credentials are OK", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
         filelist = []
-        for line in filesinfo:
-            cols = line.split('|')
-            (logicalfilename, fileid, physicalfilename,
-             filetype, filegroupname) = cols
-            filedef = {
-                "logicalname": logicalfilename.strip(),
-                "physicalname": ntpath.basename(physicalfilename.strip()),
-                "filetype": filetype.strip(),
-                "groupname": filegroupname.strip(),
-                "fileid": int(fileid.strip())
-            }
+        for row in first_result_set(filesinfo):
+            filedef = self.parse_file_row(row)
             logger.debug(filedef)
             filelist.append(filedef)
         return filelist
 
+    def parse_file_row(self, row):
+        """
+        Return a file definition from RESTORE FILELISTONLY or database file list row
+        Filegroup of log file is saved as NULL
+        """
+        return {
+            "logicalname": row["LogicalName"],
+            "physicalname": ntpath.basename(row["PhysicalName"]),
+            "filetype": row["Type"],
+            "groupname": row["FileGroupName"] or "NULL",
+            "fileid": row.number("FileId")
+        }
+
     def generate_move(self, x):
         return "MOVE '{}' TO '{}'".format(x["logicalname"], os.path.join(self.db_path, x["physicalname"]))
 
-    def get_backup_headers(self, filename):
+    def get_backup_headers_parallel(self, filenames):
+        """
+        Probe headers of all filenames using one command on host
+        with up to header_probe_parallelism concurrent sqlcmd processes
+        Return a tuple with dictionary filename -> list of headers
+        and a list of tuples (filename, output) for files which failed
+        """
+        logger.debug("get_backup_headers_parallel")
+        parallelism = getattr(self.config.parameters, "header_probe_parallelism", None) or 4
+        backup_paths = [ os.path.join(self.config.parameters.backup_location, x) for x in filenames ]
+
+        try:
+            output = self.query_db_command("probe_backup_headers", backup_paths=backup_paths, parallelism=max(1, int(parallelism)))
+        except plugin_exception as p:
+            raise UserError("Reading data from backup files in {} failed".format(self.config.parameters.backup_location),
+                            action="Checkout output for details", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+
+        # output of every file is after line DLPX-PROBE <index> <exit code>
+        # and it's parsed in place - without copying lines of file output
+        is_marker = lambda line: line.startswith("DLPX-PROBE ")
+        headers = {}
+        failed = dict([ (x, "") for x in filenames ])
+        line = output.readline()
+        while line is not None:
+            if not is_marker(line):
+                line = output.readline()
+                continue
+            (marker, index, exit_code) = line.split()
+            filename = filenames[int(index)]
+            if exit_code == "0":
+                headers[filename] = self.parse_backup_headers(filename, read_result_sets(output, is_marker))
+                del failed[filename]
+            line = output.readline()
+            lines = []
+            while line is not None and not is_marker(line):
+                if line:
+                    lines.append(line)
+                line = output.readline()
+            if filename in failed:
+                failed[filename] = "\n".join(lines)
+
+        return (headers, [ (x, failed[x]) for x in filenames if x in failed ])
+
+    def parse_backup_headers(self, filename, result_sets):
+        """
+        Return a list of headers (dictionaries) from RESTORE LABELONLY and RESTORE HEADERONLY result sets
+        Headers are parsed one by one, so output with thousands of backup sets is read in one pass
+        """
         backup_dict = {
             "1": "Full",
             "2": "Transaction log",
@@ -148,38 +217,60 @@ class mssql_ctl(db_object):
             "8": "Differential partial"
         }
 
-        backup_path = os.path.join(self.config.parameters.backup_location, filename)
-
-        try:
-            header_list = self.run_db_command("get_backup_headers", backup_path=backup_path)
-        except plugin_exception as p:
-            raise UserError("Reading data from backup file {} failed".format(backup_path), action="Checkout output for details", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
-
         backup_list = []
 
-        #  BackupName|BackupDescription|BackupType|ExpirationDate|Compressed|Position|DeviceType|UserName|ServerName|DatabaseName|DatabaseVersion|DatabaseCreationDate
-        # |BackupSize|FirstLSN|LastLSN|CheckpointLSN|DatabaseBackupLSN|BackupStartDate|BackupFinishDate|SortOrder|CodePage|UnicodeLocaleId|UnicodeComparisonStyle
-        # |CompatibilityLevel|SoftwareVendorId|SoftwareVersionMajor|SoftwareVersionMinor|SoftwareVersionBuild|MachineName|Flags|BindingID|RecoveryForkID|Collation
-        # |FamilyGUID|HasBulkLoggedData|IsSnapshot|IsReadOnly|IsSingleUser|HasBackupChecksums|IsDamaged|BeginsLogChain|HasIncompleteMetaData|IsForceOffline|IsCopyOnly
-        # |FirstRecoveryForkID|ForkPointLSN|RecoveryModel|DifferentialBaseLSN|DifferentialBaseGUID|BackupTypeDescription|BackupSetGUID|CompressedBackupSize|Containment
-        # |KeyAlgorithm|EncryptorThumbprint|EncryptorType
-
-
-
-        for backup in header_list:
-            cols = backup.split('|')
+        # first result set is a media label - stripes of one backup have same media set id
+        label = {}
+        headers = []
+        for (index, rows) in enumerate(result_sets):
+            if index == 0:
+                for row in rows:
+                    label = self.parse_media_label(row)
+            elif index == 1:
+                headers = rows
+                break
+
+        for row in headers:
             header = {
-                "backup_type": backup_dict[cols[2].strip()],
-                "position": int(cols[5].strip()),
-                "database_name": cols[9].strip(),
-                "backup_start_date": cols[17].strip(),
+                "backup_type": backup_dict[row["BackupType"]],
+                "position": row.number("Position"),
+                "database_name": row["DatabaseName"],
+                "backup_size": row.number("BackupSize"),
+                "first_lsn": row.number("FirstLSN"),
+                "last_lsn": row.number("LastLSN"),
+                "checkpoint_lsn": row.number("CheckpointLSN"),
+                "database_backup_lsn": row.number("DatabaseBackupLSN"),
+                "backup_start_date": row["BackupStartDate"],
+                "differential_base_lsn": row.number("DifferentialBaseLSN"),
                 "filename": filename
             }
+            header.update(label)
             backup_list.append(header)
 
         return backup_list
 
 
+    def parse_media_label(self, row):
+        """
+        Return a media set id and family number from RESTORE LABELONLY row
+        """
+        return {
+            "media_set_id": row["MediaSetId"],
+            "family_count": row.number("FamilyCount") or 1,
+            "family_sequence": row.number("FamilySequenceNumber") or 1
+        }
+
+
+    def parse_number(self, value):
+        """
+        Return a number (LSN or size) from sqlcmd column or None for NULL
+        """
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+        return None
+
+
     def drop_db(self):
         logger.debug("drop_db")
 
@@ -195,10 +286,19 @@ class mssql_ctl(db_object):
                 dbname), action="Check if you are restoring valid backup", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
 
 
+    def drop_db_if_exist(self):
+        """
+        Drop staging database or VDB if it exists
+        """
+        logger.debug("drop_db_if_exist")
+        if self.db_exist():
+            self.drop_db()
+
+
     def load_last_backup(self):
         try:
             filename = os.path.join(self.config_path, "{}_last_backup.json".format(self.get_db_name()))
-            last_backup = self.load_json(filename)
+            last_backup = decode_dict(self.load_json(filename))
         except plugin_exception as p:
             # if there is no file - first restore
             # just ignore it
@@ -206,167 +306,446 @@ class mssql_ctl(db_object):
 
         return last_backup
 
-    def get_backup_file_to_restore(self, resync):
-        logger.debug("get_backup_file_to_restore")
+    def load_backup_catalog(self):
+        """
+        Load a backup catalog from dSource config directory
+        Return an empty catalog if there is no catalog yet
+        """
+        logger.debug("load_backup_catalog")
+        filename = os.path.join(self.config_path, "{}_backup_catalog.json".format(self.get_db_name()))
+        try:
+            obj = decode_dict(self.load_json(filename))
+        except plugin_exception as p:
+            # if there is no file - first scan
+            obj = None
+        except ValueError:
+            logger.debug("backup catalog {} is corrupted - rebuilding".format(filename))
+            obj = None
 
+        return backup_catalog(obj)
 
-        backup_dir = os.path.join(self.config.parameters.backup_location, self.config.parameters.backup_pattern)
+    def save_backup_catalog(self, catalog):
+        """
+        Save a backup catalog into dSource config directory if it was changed
+        """
+        logger.debug("save_backup_catalog")
+        if not catalog.changed:
+            return
+        filename = os.path.join(self.config_path, "{}_backup_catalog.json".format(self.get_db_name()))
+        try:
+            self.save_json(filename, catalog.to_json())
+        except plugin_exception as p:
+            # catalog is only a cache - files will be probed again next time
+            logger.debug("save_backup_catalog failed")
+
+    def list_backup_files(self, newer_than=None):
+        """
+        List files matching backup_pattern in backup_location
+        Return a tuple with:
+        - list of tuples (filename, size, mtime) - only files changed after newer_than (epoch) if it's set
+        - newest change time (epoch) of listed files or None
+        - number of all files matching pattern
+        """
+        logger.debug("list_backup_files")
+        backup_dir = os.path.normpath(self.config.parameters.backup_location)
 
-        cmd = os_commands.list_dir(backup_dir, self.sudo, self.config.repository.uid)
+        cmd = os_commands.list_files(backup_dir, self.config.parameters.backup_pattern, newer_than, self.sudo, self.uid)
         logger.debug("list backup cmd: {}".format(cmd))
         backup_dir_output = execute_bash(
             source_connection=self.config.connection, command_name=cmd)
-	if backup_dir_output.exit_code != 0:
+        if backup_dir_output.exit_code != 0:
             raise UserError("Unable to list the files in the backup directory {}".format(
                 backup_dir), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(
-			backup_dir_output.stdout, backup_dir_output.stderr))
-
+                backup_dir_output.stdout, backup_dir_output.stderr))
 
+        # records: path, size, mtime, ctime - and TOTAL, number of all files at the end
         backup_file_list = []
+        watermark = None
+        total = 0
+        fields = iter_fields(backup_dir_output.stdout)
+        for filename in fields:
+            if filename == "TOTAL":
+                total = int(next(fields).strip())
+                break
+            size = int(next(fields))
+            mtime = next(fields)
+            ctime = float(next(fields))
+            backup_file_list.append((filename, size, mtime))
+            watermark = max(watermark, ctime)
+
+        return (backup_file_list, watermark, total)
+
+    def scan_backup_location(self, catalog):
+        """
+        Return a list of tuples (filename, size, mtime) for all backup files, and newest change time (epoch)
+        Only files changed after catalog watermark are listed. Other files are taken from catalog,
+        unless number of files shows that some of them were removed - then all files are listed.
+        """
+        logger.debug("scan_backup_location")
+
+        if catalog.watermark is not None:
+            # one second back to not miss files changed in same second as last scan
+            (changed_files, watermark, total) = self.list_backup_files(newer_than=catalog.watermark - 1)
+            changed_names = set([ x[0] for x in changed_files ])
+            backup_file_list = [ (path, entry["size"], entry["mtime"]) for (path, entry) in catalog.files.items() if path not in changed_names ]
+            backup_file_list.extend(changed_files)
+            if len(backup_file_list) == total:
+                logger.debug("{} of {} backup files changed since last scan".format(len(changed_files), total))
+                return (backup_file_list, max(watermark, catalog.watermark))
+            logger.debug("backup files were removed since last scan - listing all files")
+
+        (backup_file_list, watermark, total) = self.list_backup_files()
+        return (backup_file_list, watermark)
+
+    def get_backup_list(self):
+        """
+        Return a list of backup set headers for all files in backup location
+        Only files which are not in backup catalog or changed since are probed
+        Striped backups are returned as one backup set with list of all files
+        """
+        logger.debug("get_backup_list")
+        catalog = self.load_backup_catalog()
+        (backup_file_list, watermark) = self.scan_backup_location(catalog)
+        logger.debug(backup_file_list)
+
+        to_probe = [ x for x in backup_file_list if catalog.lookup(*x) is None ]
+        logger.debug("{} of {} backup files need to be probed".format(len(to_probe), len(backup_file_list)))
+
+        if to_probe:
+            (headers, failed) = self.get_backup_headers_parallel([ x[0] for x in to_probe ])
+            for (filename, size, mtime) in to_probe:
+                if filename in headers:
+                    catalog.update(filename, size, mtime, headers[filename])
+            if failed:
+                # keep files probed successfully, but don't move watermark
+                # so failed files will be listed again
+                self.save_backup_catalog(catalog)
+                (filename, output) = failed[0]
+                raise UserError("Reading data from backup file {} failed".format(filename), action="Checkout output for details", output="stdout: {}".format(output))
+
+        catalog.prune([ x[0] for x in backup_file_list ])
+        catalog.watermark = watermark
+        self.save_backup_catalog(catalog)
+
+        return catalog.backup_sets(backup_file_list)
+
+    def get_restore_plan(self, resync, last_backup=None):
+        """
+        Return a list of backup sets (headers) to restore - see restore_planner module
+        For resync plan is starting from a newest full backup
+        otherwise plan is moving staging database forward from last restored backup
+        (last_backup loaded by caller with load_last_backup)
+        """
+        logger.debug("get_restore_plan")
 
-        match_file = re.compile(r'[-rwx.]+\s\d\s[\w]+\s[\w]+[\s]+[\d]+\s\d\d\d\d-\d\d-\d\d\s\d\d:\d\d:\d\d\s([\S]*)')
-
-        for f in backup_dir_output.stdout.split("\n"):
-            filename = re.search(match_file, f)
-            if filename:
-                backup_file_list.append(filename.group(1))
+        backup_list = self.get_backup_list()
+        logger.debug("backup header list: {}".format(backup_list))
 
+        if resync or not last_backup:
+            last_backup = None
+        else:
+            # caller is keeping saved restore information
+            last_backup = dict(last_backup)
+
+        if last_backup and last_backup.get("last_lsn") is not None:
+            # log run interrupted without saving restore information (ex. plugin was stopped)
+            # is continued from last log found in restore history
+            restored_lsn = self.get_last_restored_lsn()
+            if restored_lsn is not None and restored_lsn > last_backup["last_lsn"]:
+                logger.debug("resuming from restored lsn {} instead of saved lsn {}".format(restored_lsn, last_backup["last_lsn"]))
+                last_backup["last_lsn"] = restored_lsn
+
+        if last_backup:
+            logger.debug("Looking for backups after last restore {}".format(last_backup))
+            plan = restore_planner.plan_incremental(backup_list, last_backup)
+            if plan is None:
+                raise UserError("No new backup found", action="Please check the backup location and verify there is a new backup. If you are certain there is a more recent backup, create a new set of support logs from the Delphix engine including plugin logs and review those.", output="N/A")
+        else:
+            plan = restore_planner.plan_resync(backup_list)
+            if plan is None:
+                raise UserError("No full backup found", action="Please check the backup location and verify there is a full backup matching backup pattern", output="N/A")
 
-        logger.debug(backup_file_list)        
+        for backup in plan:
+            logger.debug("restore plan: {} {} position {}".format(backup["backup_type"], ", ".join(backup["files"]), backup["position"]))
 
-        if resync:
-            # for resync we need to find a full backup
+        return plan
 
-            backup_list = []
 
-            for filename in backup_file_list:
-                backup_list = backup_list + self.get_backup_headers(filename)
-                logger.debug("backup header list: {}".format(backup_list))
+    def save_backup_info(self, plan, last_backup=None):
+        """
+        Save information about last restore used by post_snapshot and next restore plan
+        filename and position point to last full or differential backup (used to list database files)
+        and last_lsn / base_lsn are position of database in log chain
+        last_backup is a previous information - used if plan has only logs
+        """
+        logger.debug("save_backup_info")
+        obj = {
+            "backup": plan[-1]["backup_start_date"],
+            "database_name": plan[-1]["database_name"],
+            "last_lsn": plan[-1]["last_lsn"]
+        }
 
-            # list full backup only and sort by position - is sorting necessary ?
-            full_backups = sorted([ x for x in backup_list if x["backup_type"] == "Full" ], key=lambda x: x["backup_start_date"])
+        data_backups = [ x for x in plan if x["backup_type"] != restore_planner.LOG ]
+        if data_backups:
+            obj["filename"] = data_backups[-1]["filename"]
+            obj["files"] = data_backups[-1]["files"]
+            obj["position"] = data_backups[-1]["position"]
+        elif last_backup:
+            obj["filename"] = last_backup["filename"]
+            obj["files"] = last_backup.get("files", [ last_backup["filename"] ])
+            obj["position"] = last_backup["position"]
+
+        fulls = [ x for x in plan if x["backup_type"] == restore_planner.FULL ]
+        if fulls:
+            obj["base_lsn"] = fulls[-1]["checkpoint_lsn"]
+        elif data_backups:
+            obj["base_lsn"] = data_backups[-1]["database_backup_lsn"]
+        elif last_backup:
+            obj["base_lsn"] = last_backup.get("base_lsn")
 
-            # take the newest full backup and save a position no
-            position = full_backups[-1]["position"]
-            filename = full_backups[-1]["filename"]
-            last_backup = full_backups[-1]["backup_start_date"]
-            logger.debug("restore filename: {}".format(filename))
-            logger.debug("restore position: {}".format(position))
+        try:
+            filename = os.path.join(self.config_path, "{}_last_backup.json".format(self.get_db_name()))
+            last_backup = self.save_json(filename, obj)
+        except plugin_exception as p:
+            # what to do here ?????
+            logger.debug("save_backup_info failed")
+            last_backup = None
 
-        else:
-            # not resync - should it recover a last diff or all diffs ?
-            logger.debug("not resync")
 
-            backup_list = []
+    def restore_backup_plan(self, plan, last_backup=None, journal=None):
+        """
+        Restore all backups from plan in order
+        Full and differential backups are restored one by one, and all transaction logs
+        are applied as one run (see restore_log_run)
+        last_backup is a previous restore information used to save progress if log run is interrupted
+        journal is a step journal - backups restored by interrupted run are skipped
+        and logs already applied are found in restore history
+        """
+        logger.debug("restore_backup_plan")
+        data_backups = [ x for x in plan if x["backup_type"] != restore_planner.LOG ]
+        logs = [ x for x in plan if x["backup_type"] == restore_planner.LOG ]
+        resumed = journal is not None and journal.pending()
 
-            for filename in backup_file_list:
-                backup_list = backup_list + self.get_backup_headers(filename)
-                logger.debug("backup header list: {}".format(backup_list))
+        try:
+            for backup in data_backups:
+                if journal is not None:
+                    journal.run("restore {} {}".format(backup["files"][0], backup["position"]),
+                                self.restore_database_from_backup, backup["files"], backup["position"], backup.get("backup_size"))
+                else:
+                    self.restore_database_from_backup(backup["files"], backup["position"], backup.get("backup_size"))
 
-            # diff backup has to be after last full backup
-            # if there is only diff backup in dir - nothing we can do
-            # if there is a full and diff backups in dir - we need to apply full first
-            # but only if this is newer is last applied full
+            if resumed and logs:
+                restored_lsn = self.get_last_restored_lsn()
+                if restored_lsn is not None:
+                    logger.debug("skipping logs applied before lsn {}".format(restored_lsn))
+                    logs = [ x for x in logs if x["last_lsn"] > restored_lsn ]
 
-            last_backup = self.load_last_backup()
+            if logs:
+                self.restore_log_run(logs, data_backups + logs, last_backup)
+        finally:
+            # staging database was dropped or restored (resync) or switched between restoring and standby
+            self.invalidate_db_states()
 
 
-            if last_backup:
+    def get_plan_inputs(self, plan):
+        """
+        Return backup sets of restore plan as a step journal inputs
+        """
+        return [ [ x["files"], x["position"], x["last_lsn"] ] for x in plan ]
 
-                # check if there is a new full backup
-                logger.debug("Looking for full backups newer than {}".format(last_backup["backup"]))
-                full_backups = sorted([ x for x in backup_list if x["backup_type"] == "Full" and x["backup_start_date"] > last_backup["backup"]  ], key=lambda x: x["backup_start_date"])
-                logger.debug("List of full backups: {}".format(full_backups))
-                if len(full_backups) > 0:
-                    logger.debug("Newer full backup found")
-                    position = full_backups[-1]["position"]
-                    filename = full_backups[-1]["filename"]
-                    last_backup = full_backups[-1]["backup_start_date"]
-                    logger.debug("restore filename: {}".format(filename))
-                    logger.debug("restore position: {}".format(position))
-                else:
-                    logger.debug("No new full backups - filter on diff")
-                    logger.debug("Looking for diff backups newer than {}".format(last_backup["backup"]))
-                    diff_backups = sorted([ x for x in backup_list if x["backup_type"] == "Differential database" and x["backup_start_date"] > last_backup["backup"]  ], key=lambda x: x["backup_start_date"])
-                    logger.debug("List of diff backups: {}".format(diff_backups))
-                    if len(diff_backups) > 0:
-                        logger.debug("Newer diff backup found")
-                        position = diff_backups[-1]["position"]
-                        filename = diff_backups[-1]["filename"]
-                        last_backup = diff_backups[-1]["backup_start_date"]
-                        logger.debug("restore filename: {}".format(filename))
-                        logger.debug("restore position: {}".format(position))
-                    else:
-                        raise UserError("No new backup found", action="Please check the backup location and verify there is a new backup. If you are certain there is a more recent backup, create a new set of support logs from the Delphix engine including plugin logs and review those.", output="N/A")
 
+    def restore_log_run(self, logs, plan, last_backup):
+        """
+        Apply a list of transaction log backups in one sqlcmd script
+        All logs are restored WITH NORECOVERY and only the last one WITH STANDBY,
+        so standby file is written once per run (for upgrade all logs are using NORECOVERY)
+        If run fails, restore information is saved up to last applied log, so next snapshot
+        is resuming from there, and staging database is switched back to standby
+        """
+        logger.debug("restore_log_run")
+        dbname = "{}_staging".format(self.get_db_name())
+        standby_path = os.path.join(self.db_path, 'standby.bak')
+        for_upgrade = self.config.parameters.for_upgrade
+
+        batch = self.create_batch()
+        for log in logs:
+            if log is logs[-1] and not for_upgrade:
+                batch.add("restore_log_standby", database=dbname, backup_paths=log["files"],
+                          position=log["position"], standby_path=standby_path)
+            else:
+                batch.add("restore_log_norecovery", database=dbname, backup_paths=log["files"],
+                          position=log["position"])
 
+        try:
+            batch.run()
+        except plugin_exception as p:
+            timings = batch.timings
+            self.log_restore_timings(logs, timings)
+            applied = 0
+            while applied < len(logs) and timings[applied] is not None:
+                applied = applied + 1
+
+            if applied > 0:
+                logger.debug("{} of {} logs applied before failure".format(applied, len(logs)))
+                self.save_backup_info(plan[:len(plan) - len(logs) + applied], last_backup)
+                if not for_upgrade:
+                    try:
+                        self.run_db_command("restore_standby", database=dbname, standby_path=standby_path)
+                    except plugin_exception as s:
+                        logger.debug("Switch to standby after failed log restore failed")
+
+            if isinstance(p, db_batch_exception):
+                failed_file = ", ".join(p.kargs["backup_paths"])
             else:
-                backup_list = sorted(backup_list, key=lambda x: x["backup_start_date"])
-                # take the newest backup and save a position no
-                position = backup_list[-1]["position"]
-                filename = backup_list[-1]["filename"]
-                last_backup = backup_list[-1]["backup_start_date"]
-                logger.debug("restore filename: {}".format(filename))
-                logger.debug("restore position: {}".format(position))
+                failed_file = ", ".join(logs[min(applied, len(logs) - 1)]["files"])
+            raise UserError("Restore of transaction log from backup location {} failed".format(
+                failed_file), action="Check if you are restoring valid backup. {} of {} transaction logs were applied and next snapshot will continue from last applied log".format(applied, len(logs)),
+                output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+
+        self.log_restore_timings(logs, batch.timings)
 
 
-        return (filename, position, last_backup)
+    def log_restore_timings(self, logs, timings):
+        """
+        Log execution time of every applied transaction log and a total time
+        """
+        total = 0
+        for (log, timing) in zip(logs, timings):
+            if timing is None:
+                logger.debug("log {} position {} not applied".format(log["filename"], log["position"]))
+            else:
+                total = total + timing
+                logger.debug("log {} position {} applied in {:.3f} s".format(log["filename"], log["position"], timing))
+        logger.debug("{} transaction logs applied in {:.3f} s".format(len([ x for x in timings if x is not None ]), total))
 
 
-    def save_backup_info(self, last_backup, filename, position):
-        logger.debug("save_backup_info")
-        obj = { 
-            "backup": last_backup,
-            "filename": filename,
-            "position": position
-        }
+    def get_last_restored_lsn(self):
+        """
+        Return a last LSN of last backup restored into staging database from msdb history
+        or None if it's not known
+        """
+        logger.debug("get_last_restored_lsn")
+        dbname = "{}_staging".format(self.get_db_name())
         try:
-            filename = os.path.join(self.config_path, "{}_last_backup.json".format(self.get_db_name()))
-            last_backup = self.save_json(filename, obj)
+            output = self.run_db_command("get_last_restored_lsn", database=dbname)
         except plugin_exception as p:
-            # what to do here ?????
-            logger.debug("save_backup_info failed")
-            last_backup = None
+            logger.debug("Can't read restore history for {}".format(dbname))
+            return None
+
+        for line in output:
+            if line.strip():
+                return self.parse_number(line)
+        return None
 
 
-    def restore_database_from_backup(self, backup_file, position):
+    def restore_database_from_backup(self, backup_files, position, backup_size=None):
+        """
+        Restore backup set from backup_files - list with one file or all stripes of a media set
+        backup_size is used to size restore buffers in auto tuning mode
+        """
         logger.debug("restore_database_from_backup")
 
         # if this is resync find newest full backup
 
+        tuning = self.get_restore_tuning(backup_size, len(backup_files))
+        start = time.time()
         if self.config.parameters.for_upgrade:
-            self.restore_database_from_backup_for_upgrade(backup_file, position)
+            stats = self.restore_database_from_backup_for_upgrade(backup_files, position, tuning)
         else:
-            self.restore_database_from_backup_same_version(backup_file, position)
+            stats = self.restore_database_from_backup_same_version(backup_files, position, tuning)
+        self.save_restore_metrics(backup_files, backup_size, tuning, time.time() - start, stats)
+
+
+    def get_restore_tuning(self, backup_size, stripes):
+        """
+        Return restore tuning options (see restore_tuning module) for restore_tuning_mode parameter
+        """
+        logger.debug("get_restore_tuning")
+        mode = getattr(self.config.parameters, "restore_tuning_mode", None) or restore_tuning.DEFAULT
+        if mode == restore_tuning.MANUAL:
+            tuning = restore_tuning.manual_tuning(self.config.parameters)
+        elif mode == restore_tuning.AUTO:
+            tuning = restore_tuning.auto_tuning(backup_size, stripes, get_available_memory(self.config.connection))
+        else:
+            tuning = {}
+        logger.debug("restore tuning mode {}: {}".format(mode, tuning))
+        return tuning
+
+
+    def get_restore_stats_percent(self):
+        """
+        Return how often (in percent) restore is reporting progress
+        """
+        return max(1, min(100, int(getattr(self.config.parameters, "restore_stats_percent", None) or 10)))
+
+
+    def save_restore_metrics(self, backup_files, backup_size, tuning, seconds, stats=None):
+        """
+        Add restore time and throughput with tuning options used into .config/<db>_restore_metrics.json
+        stats is a summary parsed from restore output (see restore_stats module) - throughput
+        reported by SQL Server is used if it's there
+        Only last RESTORE_METRICS_KEEP restores are kept
+        """
+        logger.debug("save_restore_metrics")
+        metrics = {
+            "date": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            "files": backup_files,
+            "backup_size": backup_size,
+            "stripes": len(backup_files),
+            "tuning_mode": getattr(self.config.parameters, "restore_tuning_mode", None) or restore_tuning.DEFAULT,
+            "tuning": tuning,
+            "seconds": round(seconds, 3),
+            "mb_per_sec": None,
+            "stats": stats
+        }
+        if stats and stats.get("mb_per_sec") is not None:
+            metrics["mb_per_sec"] = stats["mb_per_sec"]
+        elif backup_size and seconds > 0:
+            metrics["mb_per_sec"] = round(float(backup_size) / restore_tuning.MB / seconds, 3)
+        logger.debug("restore metrics: {}".format(metrics))
+
+        filename = os.path.join(self.config_path, "{}_restore_metrics.json".format(self.get_db_name()))
+        try:
+            self.append_json(filename, metrics, RESTORE_METRICS_KEEP)
+        except plugin_exception as p:
+            # metrics are not critical for restore
+            logger.debug("save_restore_metrics failed")
+
 
-    def restore_database_from_backup_same_version(self, backup_file, position):
+    def restore_database_from_backup_same_version(self, backup_files, position, tuning=None):
         logger.debug("restore_database_from_backup_same_version")
         dbname = self.get_db_name()
-        backup_path = backup_file
-        filelist = self.get_backup_file_info(backup_path)
+        filelist = self.get_backup_file_info(backup_files)
         movelist = map(self.generate_move, filelist)
         logger.debug(movelist)
+        progress = restore_stats.restore_progress(", ".join(backup_files))
         try:
-            filesinfo = self.run_db_command("restore_full_backup", backup_path=backup_path, mount_path=self.db_path,
-                                            move=','.join(movelist), database=dbname, position=position)
+            filesinfo = self.run_db_command_progress("restore_full_backup", progress.feed, backup_paths=backup_files, mount_path=self.db_path,
+                                                     move=','.join(movelist), database=dbname, position=position, tuning=tuning,
+                                                     stats=self.get_restore_stats_percent())
         except plugin_exception as p:
             raise UserError("Restore from backup location {} failed".format(
-                backup_path), action="Check if you are restoring valid backup", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+                ", ".join(backup_files)), action="Check if you are restoring valid backup", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
 
-    def restore_database_from_backup_for_upgrade(self, backup_file, position ):
+        return progress.summary()
+
+    def restore_database_from_backup_for_upgrade(self, backup_files, position, tuning=None):
         logger.debug("restore_database_from_backup")
         dbname = self.get_db_name()
-        backup_path = backup_file
-        filelist = self.get_backup_file_info(backup_path)
+        filelist = self.get_backup_file_info(backup_files)
         movelist = map(self.generate_move, filelist)
         logger.debug(movelist)
 
+        progress = restore_stats.restore_progress(", ".join(backup_files))
         try:
-            filesinfo = self.run_db_command("restore_full_backup_for_upgrade", backup_path=backup_path, mount_path=self.db_path,
-                                            move=','.join(movelist), database=dbname, position=position)
+            filesinfo = self.run_db_command_progress("restore_full_backup_for_upgrade", progress.feed, backup_paths=backup_files, mount_path=self.db_path,
+                                                     move=','.join(movelist), database=dbname, position=position, tuning=tuning,
+                                                     stats=self.get_restore_stats_percent())
         except plugin_exception as p:
             raise UserError("Restore from backup location {} failed".format(
-                backup_path), action="Check if you are restoring valid backup or if for_upgrade flag need to be set", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+                ", ".join(backup_files)), action="Check if you are restoring valid backup or if for_upgrade flag need to be set", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+
+        return progress.summary()
 
     def get_file_list(self):
         """
@@ -383,7 +762,7 @@ class mssql_ctl(db_object):
                 return json.dumps({})
 
             backup_path = os.path.join(self.config.parameters.backup_location, last_backup["filename"])
-            return json.dumps(self.get_backup_file_info(backup_path))
+            return json.dumps(self.get_backup_file_info(last_backup.get("files", [ backup_path ])))
         else:
             logger.debug("extract files from database")
             return json.dumps(self.get_db_file_info())
@@ -395,14 +774,97 @@ class mssql_ctl(db_object):
         # add error handling
         file_list = json.loads(self.config.snapshot.db_files)
 
-        self.create_seed(file_list)
-        self.offline_vdb()
-        self.replace_files(file_list)
-        self.online_vdb()
+        # steps finished by interrupted provision are skipped
+        journal = self.create_journal("create_vdb", {"files": file_list}, CREATE_VDB_STATES)
+        journal.run("create_seed", self.create_seed, file_list)
+        journal.run("offline_vdb", self.offline_vdb)
+        journal.run("replace_files", self.replace_files, file_list)
+        journal.run("online_vdb", self.online_vdb)
 
         # TODO
         # if all OK cleanup
         self.cleanup()
+        journal.finish()
+
+
+    def create_vdb_pending(self):
+        """
+        Check if previous create_vdb for same snapshot was interrupted and left database
+        in state expected after its last finished step
+        """
+        file_list = json.loads(self.config.snapshot.db_files)
+        return self.create_journal("create_vdb", {"files": file_list}, CREATE_VDB_STATES).pending()
+
+    def provision_vdb(self):
+        """
+        Create VDB from snapshot files
+        Files are attached in one statement if snapshot is attachable (taken from online VDB)
+        and it's from same SQL Server version, otherwise (or if attach failed) a seed database
+        is created and files are replaced (see create_vdb)
+        Path taken and time are saved in .config/<db>_provision.json
+        """
+        logger.debug("provision_vdb")
+        start = time.time()
+        attach_error = None
+
+        path = SEED
+        if self.create_vdb_pending():
+            logger.debug("continue interrupted provision using seed")
+        elif self.can_attach():
+            try:
+                self.attach_vdb()
+                path = ATTACH
+            except UserError as e:
+                attach_error = e.message
+                logger.debug("attach of VDB failed - using seed: {}".format(e.message))
+
+        if path == SEED:
+            self.create_vdb()
+
+        self.save_provision_info(path, time.time() - start, attach_error)
+
+
+    def can_attach(self):
+        """
+        Check if snapshot files can be attached
+        """
+        snapshot = self.config.snapshot
+        attachable = getattr(snapshot, "attachable", None)
+        version = getattr(snapshot, "mssql_version", None)
+        logger.debug("snapshot attachable {} version {} instance version {}".format(attachable, version, self.config.repository.version))
+        return bool(attachable) and version == self.config.repository.version
+
+
+    def save_provision_info(self, path, seconds, attach_error=None):
+        """
+        Add provision path and time into .config/<db>_provision.json
+        """
+        logger.debug("save_provision_info")
+        info = {
+            "date": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            "path": path,
+            "seconds": round(seconds, 3),
+            "attach_error": attach_error
+        }
+        logger.debug("VDB {} provisioned using {} in {:.3f} s".format(self.get_db_name(), path, seconds))
+        filename = os.path.join(self.config_path, "{}_provision.json".format(self.get_db_name()))
+        try:
+            self.append_json(filename, info, PROVISION_HISTORY_KEEP)
+        except plugin_exception as p:
+            logger.debug("save_provision_info failed")
+
+
+    def checkpoint_vdb(self):
+        """
+        Write dirty pages to VDB files before snapshot, so attach after provision has little to recover
+        """
+        logger.debug("checkpoint_vdb")
+        dbname = self.get_db_name()
+        try:
+            self.run_db_command("checkpoint_database", database=dbname)
+        except plugin_exception as p:
+            logger.debug("checkpoint of {} failed".format(dbname))
+
 
     def attach_vdb(self):
         logger.debug("attach_vdb")
@@ -440,6 +902,107 @@ class mssql_ctl(db_object):
         command = execute_bash(
             source_connection=self.config.connection, command_name=cmd)
 
+        template_path = self.get_seed_template_path(file_list)
+        if self.restore_seed_template(file_list, dbname, template_path):
+            return
+
+        self.build_seed(file_list, dbname, seed_path)
+        self.save_seed_template(dbname, template_path)
+
+
+    def get_seed_template_path(self, file_list):
+        """
+        Return a path of seed template for file layout of file_list
+        Key is a hash of logical name, file id, file type and filegroup of all files
+        and SQL Server version
+        """
+        layout = sorted([ (x["fileid"], x["logicalname"], x["filetype"], x["groupname"]) for x in file_list ])
+        key = hashlib.sha1(json.dumps([ self.config.repository.version, layout ])).hexdigest()
+        return os.path.join(self.seed_cache_dir(), "seed_{}.bak".format(key))
+
+
+    def seed_cache_dir(self):
+        """
+        Return a path of seed template cache of repository instance
+        """
+        return os.path.join(mssql_status.plugin_dir(self.config.repository), SEED_CACHE_DIR)
+
+
+    def restore_seed_template(self, file_list, dbname, template_path):
+        """
+        Create seed database by restore of cached template with files moved into seed directory
+        Return False if there is no template or restore failed, so seed has to be build
+        """
+        logger.debug("restore_seed_template")
+        cmd = os_commands.check_file(template_path, self.sudo, self.uid)
+        if execute_bash(source_connection=self.config.connection, command_name=cmd).exit_code != 0:
+            logger.debug("no seed template {}".format(template_path))
+            return False
+
+        movelist = [ "MOVE '{}' TO '{}'".format(x["logicalname"], os.path.join(self.seed_path, x["physicalname"])) for x in file_list ]
+        try:
+            self.run_db_command("restore_seed_template", database=dbname, backup_path=template_path, move=','.join(movelist))
+        except plugin_exception as p:
+            logger.debug("restore of seed template {} failed - building seed".format(template_path))
+            # remove partially restored database and a template which can't be used
+            try:
+                self.run_db_command("drop_database", database=dbname)
+            except plugin_exception as d:
+                logger.debug("drop of seed database {} failed".format(dbname))
+            cmd = os_commands.delete_file(template_path, True, self.sudo, self.uid)
+            execute_bash(source_connection=self.config.connection, command_name=cmd)
+            return False
+
+        logger.debug("seed database {} restored from template {}".format(dbname, template_path))
+        self.touch_seed_template(template_path)
+        return True
+
+
+    def touch_seed_template(self, template_path):
+        """
+        Set modification time of restored seed template to now - templates are pruned
+        by modification time, so template used by many provisions and enables is kept
+        """
+        logger.debug("touch_seed_template")
+        cmd = os_commands.touch_file(template_path, self.sudo, self.uid)
+        execute_bash(source_connection=self.config.connection, command_name=cmd)
+
+
+    def save_seed_template(self, dbname, template_path):
+        """
+        Backup seed database into seed template cache
+        Backup is written into temporary file and renamed, so other operations never see partial template
+        Errors are only logged - template is an optimization
+        """
+        logger.debug("save_seed_template")
+        cache_dir = self.seed_cache_dir()
+        cmd = os_commands.make_directory(cache_dir, self.sudo, self.uid)
+        if execute_bash(source_connection=self.config.connection, command_name=cmd).exit_code != 0:
+            logger.debug("can't create seed cache directory {}".format(cache_dir))
+            return
+
+        temp_path = "{}.{}.tmp".format(template_path, dbname)
+        try:
+            self.run_compressed_backup("backup_seed_template", database=dbname, backup_path=temp_path)
+        except plugin_exception as p:
+            logger.debug("backup of seed template {} failed".format(template_path))
+            return
+
+        cmd = os_commands.os_mv(temp_path, template_path, self.sudo, self.uid)
+        if execute_bash(source_connection=self.config.connection, command_name=cmd).exit_code != 0:
+            logger.debug("can't rename seed template {}".format(temp_path))
+            return
+
+        cmd = os_commands.prune_files(cache_dir, "seed_*.bak", SEED_CACHE_KEEP, self.sudo, self.uid)
+        execute_bash(source_connection=self.config.connection, command_name=cmd)
+
+
+    def build_seed(self, file_list, dbname, seed_path):
+        """
+        Create seed database with same file ids, filegroups and logical names as in file_list
+        """
+        logger.debug("build_seed")
+
         primary_files = {x["filetype"]
             : x for x in file_list if x["fileid"] in [1, 2]}
         logger.debug(primary_files)
@@ -451,85 +1014,82 @@ class mssql_ctl(db_object):
         physical_logname = os.path.join(
             seed_path, primary_files["L"]["physicalname"])
 
-        try:
-            createvdb = self.run_db_command("create_target_mssql_vdb", filename=filename, physical_filename=physical_filename,
-                                            logname=logname, physical_logname=physical_logname, database=dbname)
-
-        except plugin_exception as p:
-            raise UserError("Creating a seed database {} failed".format(
-                dbname), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        # whole seed is created by one sqlcmd script
+        batch = self.create_batch()
+        batch.add("create_target_mssql_vdb", filename=filename, physical_filename=physical_filename,
+                  logname=logname, physical_logname=physical_logname, database=dbname)
 
         rest_of_files = sorted([x for x in file_list if x["fileid"] not in [
                                1, 2]], key=lambda f: f["fileid"])
 
+        for f in rest_of_files:
+            if f["filetype"] not in ["D", "L"]:
+                logger.error("Unknown file type: {}".format(f))
+                raise UserError(
+                    "Error with snapshot metadata - unknown file type", action="Contact Delphix", output=f)
+
         set_of_filegroups = set(
-            [x["groupname"] for x in rest_of_files if x["groupname"] != "NULL"])
+            [x["groupname"] for x in rest_of_files if x["groupname"] not in ["NULL", "PRIMARY"]])
         logger.debug("list of filegroups: {}".format(set_of_filegroups))
 
-        try:
+        for filegroup in sorted(set_of_filegroups):
+            batch.add("create_filegroup", filegroup=filegroup, database=dbname)
 
-            for filegroup in set_of_filegroups:
-                createfilegroup = self.run_db_command(
-                    "create_filegroup", filegroup=filegroup, database=dbname)
+        # fileId of new created files needs to match a fileid from backup so we may need to add dummy files
+        # and remove them at the end.
+        # Files get ids in order they are added, so files are added in fileid order
+        # as runs of files of same type and filegroup - one ALTER DATABASE per run.
+        # Dummy file is added into a run of next real file, so gaps are not splitting runs.
 
-        except plugin_exception as p:
-            raise UserError("Adding a filegroup {} to seed database {} failed".format(
-                filegroup, dbname), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        # FileId 1 and 2 are taken by primary so, next file should have id 3
+        local_fileid = 3
+        dummy_files = []
+        runs = []
 
-        # fileId of new created files needs to match a fileid from backup so we may need to add dummy files
-        # end remove them at the end by using
-        # DBCC SHRINKFILE (N'$files', EMPTYFILE)
-        # ALTER DATABASE [$databaseName]  REMOVE FILE [$files]
+        for f in rest_of_files:
+            fileid = int(f["fileid"])
+            run_key = (f["filetype"], f["groupname"])
+            if not runs or runs[-1][0] != run_key:
+                runs.append((run_key, []))
+            files = runs[-1][1]
 
-        # FileId 1 and 2 are taken by primary so, we need to check if next file position minus fileid = 0
+            for fakeid in range(local_fileid, fileid):
+                logger.debug("adding dummy file {}".format(fakeid))
+                dummy_file_name = "dummy_{}".format(fakeid)
+                dummy_files.append(dummy_file_name)
+                files.append((dummy_file_name, os.path.join(seed_path, dummy_file_name)))
 
-        local_fileid = 3  # this is a first file which should be added
-        dummy_files = []
+            files.append((f["logicalname"], os.path.join(seed_path, f["physicalname"])))
+            local_fileid = fileid + 1
 
-        try:
-            for f in rest_of_files:
-                fileid = int(f["fileid"])
-                logger.debug("fileid {} local_fileid {} : {}".format(
-                    fileid, local_fileid, fileid-local_fileid))
-                if (fileid - local_fileid) != 0:
-                    for fakeid in range(local_fileid, fileid):
-                        logger.debug("adding dummy file {}".format(fakeid))
-                        dummy_file_name = "dummy_{}".format(fakeid)
-                        dummy_physical_name = os.path.join(
-                            seed_path, dummy_file_name)
-                        dummy_files.append(dummy_file_name)
-                        createfile = self.run_db_command(
-                            "add_datafile", database=dbname, filename=dummy_file_name, physical_filename=dummy_physical_name)
-                        local_fileid = local_fileid + 1
-
-                physical_filename = os.path.join(seed_path, f["physicalname"])
-                if f["filetype"] == "D":
-                    createfile = self.run_db_command(
-                        "add_datafile_to_group", filegroup=f["groupname"], database=dbname, filename=f["logicalname"], physical_filename=physical_filename)
-                elif f["filetype"] == "L":
-                    createfile = self.run_db_command(
-                        "add_logfile", database=dbname, logfile=f["logicalname"], physical_logfile=physical_filename)
-                else:
-                    logger.error("Unknown file type: {}".format(f))
-                    raise UserError(
-                        "Error with snapshot metadata - unknown file type", action="Contact Delphix", output=f)
+        for ((filetype, filegroup), files) in runs:
+            batch.add("add_files", database=dbname, filegroup=filegroup, filetype=filetype, files=files)
 
-                local_fileid = local_fileid + 1
+        # clean dummy files
+        if dummy_files:
+            batch.add("remove_files", database=dbname, filenames=dummy_files)
 
-        except plugin_exception as p:
-            raise UserError("Adding a seed file {} to seed database {} failed".format(
-                fileid, dbname), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        logger.debug("seed {} - {} files in {} statements, {} dummy files".format(dbname, len(file_list), len(batch), len(dummy_files)))
 
         try:
-            # clean dummy files
-            for dummy in dummy_files:
-                shrink = self.run_db_command(
-                    "shrink_datafile", database=dbname, filename=dummy)
-                remove = self.run_db_command(
-                    "drop_datafile", database=dbname, filename=dummy)
+            batch.run()
+        except db_batch_exception as p:
+            output = "stdout: {}\nstderr: {}".format(p.stdout, p.stderr)
+            if p.command_name == "create_target_mssql_vdb":
+                raise UserError("Creating a seed database {} failed".format(
+                    dbname), action="Please check output for detailed error", output=output)
+            elif p.command_name == "create_filegroup":
+                raise UserError("Adding a filegroup {} to seed database {} failed".format(
+                    p.kargs["filegroup"], dbname), action="Please check output for detailed error", output=output)
+            elif p.command_name == "remove_files":
+                raise UserError("Problem with cleaning up dummy datafiles {}".format(
+                    ", ".join(p.kargs["filenames"])), action="Please check output for detailed error", output=output)
+            else:
+                raise UserError("Adding a seed files {} to seed database {} failed".format(
+                    ", ".join([ x[0] for x in p.kargs["files"] ]), dbname), action="Please check output for detailed error", output=output)
         except plugin_exception as p:
-            raise UserError("Problem with cleaning up dummy datafile {}".format(
-                dummy), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+            raise UserError("Creating a seed database {} failed".format(
+                dbname), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
 
 
 
@@ -542,15 +1102,20 @@ class mssql_ctl(db_object):
         else:
             dbname = self.get_db_name()
 
+        batch = self.create_batch()
+        for f in file_list:
+            physical_filename = os.path.join(
+                self.db_path, f["physicalname"])
+            batch.add("rename_datafile", filename=f["logicalname"], physical_filename=physical_filename, database=dbname)
+
         try:
-            for f in file_list:
-                physical_filename = os.path.join(
-                    self.db_path, f["physicalname"])
-                rename = self.run_db_command(
-                    "rename_datafile", filename=f["logicalname"], physical_filename=physical_filename, database=dbname)
-        except plugin_exception as p:
+            batch.run()
+        except db_batch_exception as p:
             raise UserError("Problem with renaming file {}".format(
-                f["logicalname"]), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+                p.kargs["filename"]), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        except plugin_exception as p:
+            raise UserError("Problem with renaming files of database {}".format(
+                dbname), action="Please check output for detailed error", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
 
     def cleanup(self):
         logger.debug("cleanup")
@@ -576,6 +1141,8 @@ class mssql_ctl(db_object):
         if backup is from previous - do nothing
         for same version, there is no way to attach database standby database
         so same trick with seed database, plus backup / restore has to be applied
+        Only an empty seed is backed up and restored - cached seed template is restored
+        directly if there is one, and size of seed backup is saved into enable metrics
         """
 
         logger.debug("start_staging")
@@ -586,14 +1153,19 @@ class mssql_ctl(db_object):
 
 
         file_list = self.get_file_list_from_file()
+
+        # steps finished by interrupted enable are skipped
+        journal = self.create_journal("start_staging", {"files": file_list}, START_STAGING_STATES)
+        journal.run("cleanup", self.cleanup)
+        journal.run("create_seed_backup", self.create_seed_backup, file_list)
+        journal.run("restore_seed_database", self.restore_seed_database, file_list)
+        journal.run("replace_files", self.replace_files, file_list)
+        try:
+            journal.run("switch_to_standby", self.switch_to_standby)
+        finally:
+            self.invalidate_db_states()
         self.cleanup()
-        self.create_seed(file_list)
-        self.backup_database()
-        self.drop_db()
-        self.restore_seed_database()
-        self.replace_files(file_list)
-        self.switch_to_standby()
-        self.cleanup()
+        journal.finish()
 
 
     def create_staging_dirs(self):
@@ -623,6 +1195,69 @@ class mssql_ctl(db_object):
         except plugin_exception as p:
             logger.debug("Detach database for {} failed".format(dbname))
             raise UserError("Detach database for {} failed".format(dbname), action="Check output for details", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        finally:
+            self.invalidate_db_states()
+
+    def run_compressed_backup(self, command_name, **kargs):
+        """
+        Run backup command with COMPRESSION and repeat it without compression
+        if edition is not supporting compression - other errors are raised
+        """
+        logger.debug("run_compressed_backup")
+        try:
+            return self.run_db_command(command_name, compression=True, **kargs)
+        except plugin_exception as p:
+            if not match_compression_not_supported.search("{}\n{}".format(p.stdout, p.stderr)):
+                raise
+            logger.debug("compression is not supported - retrying backup without compression")
+            return self.run_db_command(command_name, compression=False, **kargs)
+
+
+    def file_exists(self, file_path):
+        """
+        Check if file exists on host
+        """
+        cmd = os_commands.check_file(file_path, self.sudo, self.uid)
+        return execute_bash(source_connection=self.config.connection, command_name=cmd).exit_code == 0
+
+
+    def get_seed_backup_path(self, file_list):
+        """
+        Return a path of backup used to create staging database in restoring state
+        It's a seed template if it exists or a backup of seed database in seed directory
+        Return None if there is none of them (template can be pruned or removed by other operation)
+        """
+        template_path = self.get_seed_template_path(file_list)
+        if self.file_exists(template_path):
+            return template_path
+        backup_path = os.path.join(self.seed_path, 'seed_backup_{}_staging'.format(self.get_db_name()))
+        if self.file_exists(backup_path):
+            return backup_path
+        return None
+
+
+    def create_seed_backup(self, file_list):
+        """
+        Make sure there is a seed backup for restore_seed_database and return its path
+        Seed database is created only if there is no seed template for file layout,
+        and it's backed up into seed directory only if template can't be saved
+        """
+        logger.debug("create_seed_backup")
+
+        cmd = os_commands.make_directory(self.seed_path, self.sudo, self.config.repository.uid)
+        execute_bash(source_connection=self.config.connection, command_name=cmd)
+
+        template_path = self.get_seed_template_path(file_list)
+        if self.file_exists(template_path):
+            logger.debug("using seed template {}".format(template_path))
+            return template_path
+
+        self.create_seed(file_list)
+        if not self.file_exists(template_path):
+            self.backup_database()
+        self.drop_db()
+        return self.get_seed_backup_path(file_list)
+
 
     def backup_database(self):
         logger.debug("backup_database")
@@ -632,24 +1267,78 @@ class mssql_ctl(db_object):
             dbname = self.get_db_name()
         try:
             backup_path=os.path.join(self.seed_path, 'seed_backup_{}'.format(dbname))
-            backup_db = self.run_db_command("backup_database", database=dbname, backup_path=backup_path)
+            backup_db = self.run_compressed_backup("backup_database", database=dbname, backup_path=backup_path)
         except plugin_exception as p:
             logger.debug("Backup database for {} failed".format(dbname))
             raise UserError("Backup database for {} failed".format(dbname), action="Check output for details", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
 
 
-    def restore_seed_database(self):
+    def restore_seed_database(self, file_list):
+        """
+        Restore seed backup as staging database with NORECOVERY and files in seed directory
+        """
         logger.debug("restore_seed_database")
         if self.config.dSource:
             dbname = "{}_staging".format(self.get_db_name())
         else:
             dbname = self.get_db_name()
+        # seed backup created by create_seed_backup step (maybe in interrupted enable)
+        # could be removed since, so it's created again if it's missing
+        backup_path = self.get_seed_backup_path(file_list)
+        if backup_path is None:
+            logger.debug("seed backup for {} is missing - creating it again".format(dbname))
+            backup_path = self.create_seed_backup(file_list)
+        movelist = [ "MOVE '{}' TO '{}'".format(x["logicalname"], os.path.join(self.seed_path, x["physicalname"])) for x in file_list ]
+        start = time.time()
         try:
-            backup_path=os.path.join(self.seed_path, 'seed_backup_{}'.format(dbname))
-            backup_db = self.run_db_command("restore_seed_database", database=dbname, backup_path=backup_path)
+            try:
+                backup_db = self.run_db_command("restore_seed_database", database=dbname, backup_path=backup_path,
+                                                move=','.join(movelist), tuning=self.get_restore_tuning(None, 1))
+            except plugin_exception as p:
+                if backup_path is None or self.file_exists(backup_path):
+                    raise
+                # template was pruned or removed by other operation during restore
+                logger.debug("seed backup {} disappeared during restore - creating it again".format(backup_path))
+                try:
+                    self.run_db_command("drop_database", database=dbname)
+                except plugin_exception as d:
+                    logger.debug("drop of staging database {} failed".format(dbname))
+                backup_path = self.create_seed_backup(file_list)
+                start = time.time()
+                backup_db = self.run_db_command("restore_seed_database", database=dbname, backup_path=backup_path,
+                                                move=','.join(movelist), tuning=self.get_restore_tuning(None, 1))
         except plugin_exception as p:
             logger.debug("Restore seed database for {} failed".format(dbname))
             raise UserError("Restore seed database for {} failed".format(dbname), action="Check output for details", output="stdout: {}\nstderr: {}".format(p.stdout, p.stderr))
+        self.save_enable_metrics(backup_path, time.time() - start)
+        if backup_path.startswith(self.seed_cache_dir()):
+            self.touch_seed_template(backup_path)
+
+
+    def save_enable_metrics(self, backup_path, seconds):
+        """
+        Add size of seed backup restored by enable into .config/<db>_enable_metrics.json
+        It's all data copied by enable - database files detached by stop_staging are not copied
+        Only last ENABLE_METRICS_KEEP enables are kept
+        """
+        logger.debug("save_enable_metrics")
+        cmd = os_commands.file_size(backup_path, self.sudo, self.uid)
+        size = execute_bash(source_connection=self.config.connection, command_name=cmd)
+        metrics = {
+            "date": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            "seed_backup": backup_path,
+            "seed_template": backup_path.startswith(self.seed_cache_dir()),
+            "bytes": self.parse_number(size.stdout) if size.exit_code == 0 else None,
+            "seconds": round(seconds, 3)
+        }
+        logger.debug("enable metrics: {}".format(metrics))
+
+        filename = os.path.join(self.config_path, "{}_enable_metrics.json".format(self.get_db_name()))
+        try:
+            self.append_json(filename, metrics, ENABLE_METRICS_KEEP)
+        except plugin_exception as p:
+            # metrics are not critical for enable
+            logger.debug("save_enable_metrics failed")
 
 
     def stop_staging(self):
@@ -666,6 +1355,9 @@ class mssql_ctl(db_object):
             logger.debug("for upgrade flag is set - do nothing")
             return
 
+        # staging database is detached, so steps of interrupted enable can't be continued
+        self.remove_journal("start_staging")
+
         file_list = self.get_db_file_info()
         filename = os.path.join(self.config_path, "{}_filelist.json".format(self.get_db_name()))
         self.save_json(file_path=filename, obj=file_list)
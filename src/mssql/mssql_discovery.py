@@ -3,6 +3,7 @@
 #
 
 
+import json
 import logging
 import os
 import re
@@ -19,7 +20,12 @@ from generated.definitions import (
 
 from controller import os_commands
 from controller.helper import execute_bash
-from controller.helper import find_ids
+from controller.helper import decode_dict
+from controller.result_set import line_reader
+from controller.result_set import first_result_set
+from controller import host_facts
+from mssql import db_commands
+from mssql import mssql_status
 
 logger = logging.getLogger(__name__)
 
@@ -29,76 +35,166 @@ MSSQL_NICE_NAMES = {
     '15.0': '2019'
 }
 
+# standard installation of MS SQL on Linux
+SERVER_PACKAGE = 'mssql-server'
+CLIENT_PACKAGE = 'mssql-tools'
+SERVER_PATH = '/opt/mssql/bin/'
+CLIENT_PATH = '/opt/mssql-tools/bin/'
+CONF_PATH = '/var/opt/mssql/mssql.conf'
+DEFAULT_PORT = 1433
 
+# configuration files of additional instances (ex. /var/opt/mssql-dev/mssql.conf)
+# instances started with MSSQL_CONF pointing somewhere else are found by running processes
+CONF_PATTERN = '/var/opt/mssql*/mssql.conf'
 
+# source configs of repository are cached for a refresh interval (in seconds)
+SOURCE_CONFIG_TTL = 300
 
-def return_repository(connection):
+
+def read_discovery_facts(connection):
     """
-    Platform depended code to return a information about repository ( MS SQL installation )
+    Run a discovery probe on host and return a dictionary of facts (see os_commands.discovery_probe)
+    All facts are read by one command and environment user ids are cached in host facts for later operations
     """
-    repo_list = []
-    
-    logger.debug("finding a mssql-server packages")
-    cmd = os_commands.rpm(package_name="mssql-server")
-    server_pkg = execute_bash(source_connection=connection, command_name=cmd)
-
-    if server_pkg.exit_code != 0:
-        # add logger
-        UserError("Problem with finding a mssql server RPM package", output="stdout: {} stderr: {}".format(server_pkg.stdout, server_pkg.stderr))
-
-    logger.debug("finding a mssql-client packages")
-    cmd = os_commands.rpm(package_name="mssql-tools")
-    client_pkg = execute_bash(source_connection=connection, command_name=cmd)
-
-    if client_pkg.exit_code != 0:
-        UserError(message="Problem with finding a mssql client RPM package", output="stdout: {} stderr: {}".format(client_pkg.stdout, client_pkg.stderr))
-
-    logger.debug("finding a mssql-client path")
-    cmd = os_commands.check_directory('/opt/mssql-tools/bin/')
-    client_path = execute_bash(source_connection=connection, command_name=cmd) 
+    logger.debug("running a discovery probe")
+    cmd = os_commands.discovery_probe(server_package=SERVER_PACKAGE, client_package=CLIENT_PACKAGE,
+                                      server_path=SERVER_PATH, client_path=CLIENT_PATH, conf_path=CONF_PATH,
+                                      conf_pattern=CONF_PATTERN)
+    probe = execute_bash(source_connection=connection, command_name=cmd)
+
+    try:
+        if probe.exit_code != 0:
+            raise ValueError("exit code {}".format(probe.exit_code))
+        facts = decode_dict(json.loads(probe.stdout))
+    except ValueError:
+        raise UserError("Problem with discovery of MS SQL installation", action="Check output for detailed error",
+                        output="stdout: {}\nstderr: {}".format(probe.stdout, probe.stderr))
+    logger.debug("discovery facts: {}".format(facts))
+
+    # environment user ids are used by need_sudo in later operations
+    host_facts.set_fact(connection, "whoami", tuple(facts["whoami"]))
+    return facts
+
+
+def instance_name(instance):
+    """
+    Return a name of instance - name of directory with mssql.conf (ex. mssql-dev)
+    """
+    return os.path.basename(os.path.dirname(instance["conf_path"]))
 
-    if client_path.exit_code != 0:
-        UserError(message="Problem with finding a mssql client path", output="stdout: {} stderr: {}".format(client_path.stdout, client_path.stderr))
-    else:
-        os_client_path = '/opt/mssql-tools/bin/'
 
+def instance_pretty_name(hostname, instance, nice_version):
+    """
+    Return a pretty name of instance repository
+    Default instance is keeping a name used before instances were discovered, as it's a part of repository identity
+    """
+    if instance["conf_path"] == CONF_PATH:
+        return 'MSSQL Linux - {} (version: {})'.format(hostname, nice_version)
+    return 'MSSQL Linux - {} {} port {} (version: {})'.format(hostname, instance_name(instance), instance["port"], nice_version)
 
-    logger.debug("finding a mssql-server path")
-    cmd = os_commands.check_directory('/opt/mssql/bin/')
-    server_path = execute_bash(source_connection=connection, command_name=cmd) 
 
-    if server_path.exit_code != 0:
-        UserError(message="Problem with finding a mssql client path", output="stdout: {} stderr: {}".format(server_path.stdout, server_path.stderr))
-    else:
-        os_server_path = '/opt/mssql/bin/'
+def return_repository(connection):
+    """
+    Platform depended code to return a information about repository ( MS SQL installation )
+    All information is read from host in one round trip (see read_discovery_facts)
+    """
+    repo_list = []
 
-    # for now only hardcoded discovery
-    (uid, gid) = find_ids(connection, '/var/opt/mssql/mssql.conf')
+    # discovery is run on environment refresh - don't trust anything cached before
+    host_facts.invalidate(connection)
 
-    # check an instance name
-    logger.debug("finding a mssql-server hostname")
-    cmd = os_commands.get_hostname(short=True)
-    hostname = execute_bash(source_connection=connection, command_name=cmd) 
+    facts = read_discovery_facts(connection)
+    list_of_servers = facts["server_packages"]
 
-    if hostname.exit_code != 0:
-        UserError(message="Problem with finding a mssql hostname", output="stdout: {} stderr: {}".format(hostname.stdout, hostname.stderr))
-    else:
-        os_hostname = hostname.stdout.strip()
+    if not list_of_servers:
+        logger.debug("mssql server package {} is not installed".format(SERVER_PACKAGE))
+        return repo_list
 
-    # each mssql-server package can be a repository
+    if facts["client_path"] is None:
+        raise UserError("Problem with finding a mssql client path", action="Install {} package".format(CLIENT_PACKAGE),
+                        output="Directory {} not found".format(CLIENT_PATH))
+    if facts["server_path"] is None:
+        raise UserError("Problem with finding a mssql server path", action="Check mssql server installation",
+                        output="Directory {} not found".format(SERVER_PATH))
 
-    list_of_servers = server_pkg.stdout.split('\n')
+    os_client_path = facts["client_path"]
+    os_server_path = facts["server_path"]
+    os_hostname = facts["hostname"]
 
+    # each instance of mssql-server package is a repository, so VDBs can be spread across instances
     for server in list_of_servers:
         version = re.search(r"mssql-server-([\d]+.\d).([\d]+.[\d]+)", server)
         if version:
             main_version = version.group(1)
             rc_version = version.group(2)
-            repo = RepositoryDefinition(version='{} {}'.format(main_version, rc_version), rdbms_path=os_server_path, gid=gid, client_path=os_client_path, 
-                                        pretty_name='MSSQL Linux - {} (version: {})'.format(os_hostname, MSSQL_NICE_NAMES[main_version]), uid=uid)
-            logger.debug(repo)
-            repo_list.append(repo)
+            for instance in facts["instances"]:
+                (uid, gid) = instance["ids"]
+                logger.debug("instance {} port {} running {}".format(instance["conf_path"], instance["port"], instance["running"]))
+                repo = RepositoryDefinition(version='{} {}'.format(main_version, rc_version), rdbms_path=os_server_path, gid=gid, client_path=os_client_path,
+                                            pretty_name=instance_pretty_name(os_hostname, instance, MSSQL_NICE_NAMES.get(main_version, main_version)),
+                                            uid=uid, instance_name=instance_name(instance), conf_path=instance["conf_path"],
+                                            port=instance["port"], data_dir=instance["data_dir"], memory_limit_mb=instance["memory_limit_mb"])
+                logger.debug(repo)
+                repo_list.append(repo)
 
+    return repo_list
 
 
-    return repo_list
\ No newline at end of file
+def read_source_databases(connection, repository):
+    """
+    Return a list of dictionaries with SourceConfigDefinition fields for all user databases
+    of repository instance read by one query (see db_commands.list_source_databases)
+    Staging databases of dSources (<database>_staging in standby or restoring) are skipped -
+    other databases with _staging suffix are returned
+    Raise UserError if instance can't be queried, so failure is not reported as instance without databases
+    """
+    logger.debug("read_source_databases")
+    cmd = db_commands.list_source_databases(client_path=repository.client_path, login_timeout=mssql_status.LOGIN_TIMEOUT,
+                                            query_timeout=mssql_status.QUERY_TIMEOUT)
+    databases = execute_bash(source_connection=connection, command_name=cmd,
+                             environment_vars=db_commands.sqlcmd_environment(None, getattr(repository, "port", None)))
+
+    if databases.exit_code != 0:
+        logger.debug("Problem with reading databases stdout: {} stderr: {}".format(databases.stdout, databases.stderr))
+        raise UserError("Problem with discovery of databases in instance {}".format(getattr(repository, "pretty_name", "")),
+                        action="Check if instance is running and if SQLCMDUSER and SQLCMDPASSWORD in environment user profile are valid",
+                        output="stdout: {}\nstderr: {}".format(databases.stdout, databases.stderr))
+
+    output = line_reader(databases.stdout)
+    if output.peek() == "DLPX-NO-CREDENTIALS":
+        logger.debug("SQLCMDUSER is not set in environment user profile - databases can't be discovered")
+        raise UserError("Instance credentials for discovery of databases are not set",
+                        action="Set SQLCMDUSER and SQLCMDPASSWORD in environment user profile and refresh environment")
+
+    source_list = []
+    for row in first_result_set(output):
+        # staging databases are created by dSources and are never online for writes
+        if row["name"].endswith("_staging") and (row["state_desc"] == "RESTORING" or row["is_in_standby"] == "1"):
+            continue
+        source_list.append({
+            "database_name": row["name"],
+            "recovery_model": row["recovery_model_desc"] or "",
+            "size_mb": row.number("size_mb") or 0,
+            "file_count": row.number("file_count") or 0,
+            "last_full_backup": row["last_full"] or "",
+            "last_diff_backup": row["last_diff"] or "",
+            "last_log_backup": row["last_log"] or "",
+            "log_backup_interval_min": row.number("log_interval_min") or 0
+        })
+    return source_list
+
+
+def return_source_config(connection, repository):
+    """
+    Return a list of SourceConfigDefinition for all user databases of repository instance
+    List is cached in host facts for SOURCE_CONFIG_TTL seconds
+    """
+    name = "source_configs:{}".format(getattr(repository, "port", None) or DEFAULT_PORT)
+    databases = host_facts.cached_fact(connection, name, lambda: read_source_databases(connection, repository), ttl=SOURCE_CONFIG_TTL)
+
+    source_list = []
+    for database in databases:
+        logger.debug("database {database_name} size {size_mb} MB files {file_count} recovery {recovery_model} "
+                     "log backup every {log_backup_interval_min} min".format(**database))
+        source_list.append(SourceConfigDefinition(**database))
+    return source_list
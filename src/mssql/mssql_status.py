@@ -0,0 +1,185 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Status probe of staging database and VDB
+# Status check needs only a connection, repository, credentials and database name,
+# so it's not building a mssql_ctl object. State is read from host-wide cache of database
+# states and only a database missing in cache is checked by a live query.
+# Every sqlcmd call is bounded by login and query timeouts, so status check stays cheap
+# even if instance is busy with restores.
+
+import logging
+import os
+import time
+
+from controller import os_commands
+from controller.helper import execute_bash
+from controller.helper import need_sudo
+from controller.result_set import line_reader
+from controller.result_set import first_result_set
+from mssql import db_commands
+
+
+logger = logging.getLogger(__name__)
+
+# plugin files of instance (database state cache, seed templates) are kept in delphix directory
+# of instance directory (directory of mssql.conf), which is owned by instance user
+# repositories discovered before instances have no conf_path and are using default instance directory
+DEFAULT_INSTANCE_DIR = "/var/opt/mssql"
+PLUGIN_DIR = "delphix"
+
+# host-wide cache of all database states used by status checks - one file in plugin directory of instance
+# it's refreshed by one query if it's older than DB_STATE_TTL seconds
+DB_STATE_CACHE = "db_state"
+DB_STATE_TTL = 30
+
+# sqlcmd timeouts (in seconds) for status queries
+LOGIN_TIMEOUT = 5
+QUERY_TIMEOUT = 10
+
+# states returned by probe in addition to sys.databases state_desc
+# (ONLINE, RESTORING, RECOVERING, RECOVERY_PENDING, SUSPECT, EMERGENCY, OFFLINE)
+STANDBY = "STANDBY"
+READ_ONLY = "READ_ONLY"
+MISSING = "MISSING"
+UNREACHABLE = "UNREACHABLE"
+
+# states of running database
+ACTIVE_STATES = [ "ONLINE", STANDBY, READ_ONLY ]
+
+
+class db_state(object):
+    """
+    Result of status probe - state of database, probe latency and source of state
+    """
+
+    __slots__ = ("database", "state", "seconds", "cached", "message")
+
+    def __init__(self, database, state, seconds, cached, message=None):
+        self.database = database
+        self.state = state
+        self.seconds = seconds
+        self.cached = cached
+        self.message = message
+
+
+    @property
+    def active(self):
+        """
+        True if database is running (online, in standby or read only)
+        """
+        return self.state in ACTIVE_STATES
+
+
+    def __str__(self):
+        return "database {} state {} ({} in {:.3f}s)".format(self.database, self.state,
+                                                           "cached" if self.cached else "live", self.seconds)
+
+
+def plugin_dir(repository):
+    """
+    Return a path of plugin directory of repository instance
+    """
+    conf_path = getattr(repository, "conf_path", None)
+    if conf_path:
+        return os.path.join(os.path.dirname(conf_path), PLUGIN_DIR)
+    return os.path.join(DEFAULT_INSTANCE_DIR, PLUGIN_DIR)
+
+
+def state_cache_path(repository):
+    """
+    Return a path of database state cache of repository instance
+    """
+    return os.path.join(plugin_dir(repository), DB_STATE_CACHE)
+
+
+def row_state(row):
+    """
+    Return a state of database from sys.databases row
+    Database in standby or read only mode has state_desc ONLINE
+    """
+    state = row["state_desc"]
+    if state == "ONLINE" and row["is_in_standby"] == "1":
+        return STANDBY
+    if state == "ONLINE" and row["is_read_only"] == "1":
+        return READ_ONLY
+    return state
+
+
+def run_status_command(connection, password, port, command):
+    """
+    Run a status command and return a line_reader for output or None if command failed
+    """
+    response = execute_bash(source_connection=connection, command_name=command,
+                            environment_vars=db_commands.sqlcmd_environment(password, port))
+    if response.exit_code != 0:
+        logger.debug("status command failed stdout: {} stderr: {}".format(response.stdout, response.stderr))
+        return None
+    return line_reader(response.stdout)
+
+
+def read_cached_states(connection, repository, username, password, sudo):
+    """
+    Return a dictionary database name -> state for all databases in instance
+    from host-wide cache shared by all dSources and VDBs on host
+    Cache older than DB_STATE_TTL is refreshed by one query and concurrent checks are waiting for it
+    Cache is written as repository owner if sudo is set
+    Return None if cache is stale and instance can't be queried
+    """
+    logger.debug("read_cached_states")
+    output = run_status_command(connection, password, getattr(repository, "port", None), db_commands.get_databases_state_cached(
+        client_path=repository.client_path, username=username, cache_path=state_cache_path(repository), ttl=DB_STATE_TTL,
+        login_timeout=LOGIN_TIMEOUT, query_timeout=QUERY_TIMEOUT, sudo=sudo, uid=repository.uid))
+    if output is None:
+        return None
+    logger.debug(output.readline())
+    return dict([ (row["name"], row_state(row)) for row in first_result_set(output) ])
+
+
+def read_live_state(connection, repository, username, password, database):
+    """
+    Return a state of database read from instance, MISSING if there is no such database
+    or None if instance is not answering
+    """
+    logger.debug("read_live_state")
+    output = run_status_command(connection, password, getattr(repository, "port", None), db_commands.get_database_state(
+        client_path=repository.client_path, database=database, username=username,
+        login_timeout=LOGIN_TIMEOUT, query_timeout=QUERY_TIMEOUT))
+    if output is None:
+        return None
+    for row in first_result_set(output):
+        return row_state(row)
+    return MISSING
+
+
+def probe_status(connection, repository, username, password, database):
+    """
+    Return a db_state of database in repository instance
+    State is taken from host-wide cache and live query is run only if database is not in cache
+    """
+    logger.debug("probe_status")
+    start = time.time()
+    # environment user ids are cached in host facts
+    sudo = need_sudo(connection, repository.uid, repository.gid)
+    states = read_cached_states(connection, repository, username, password, sudo)
+    if states is not None and database in states:
+        status = db_state(database, states[database], time.time() - start, True)
+    else:
+        logger.debug("no cached state of database {} - checking instance".format(database))
+        state = read_live_state(connection, repository, username, password, database)
+        if state is None:
+            status = db_state(database, UNREACHABLE, time.time() - start, False,
+                              "instance is not answering within {}s".format(LOGIN_TIMEOUT + QUERY_TIMEOUT))
+        else:
+            status = db_state(database, state, time.time() - start, False)
+    logger.info("status probe: {}".format(status))
+    return status
+
+
+def invalidate_states(connection, repository, sudo):
+    """
+    Remove host-wide cache of database states of repository instance after state of database was changed
+    """
+    logger.debug("invalidate_states")
+    cmd = os_commands.delete_file(state_cache_path(repository), True, sudo, repository.uid)
+    execute_bash(source_connection=connection, command_name=cmd)
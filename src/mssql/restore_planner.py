@@ -0,0 +1,145 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Restore chain planner
+# It's using LSN columns from RESTORE HEADERONLY (see mssql_ctl.parse_backup_headers)
+# to find a minimal list of backups (full, differential, logs) to restore
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+FULL = "Full"
+DIFFERENTIAL = "Differential database"
+LOG = "Transaction log"
+
+
+def is_based_on(backup, full):
+    """
+    Check if differential or log backup was taken after a full backup
+    DatabaseBackupLSN (and DifferentialBaseLSN for differential) is a checkpoint LSN of the base full backup
+    """
+    return full["checkpoint_lsn"] is not None and \
+        full["checkpoint_lsn"] in [backup["database_backup_lsn"], backup["differential_base_lsn"]]
+
+
+def find_log_chain(backup_list, lsn, database_name):
+    """
+    Return a list of log backups to restore after a database is restored up to lsn
+    First log has to contain lsn and every next log has to start where previous finished
+    Chain stops on first gap
+    """
+    logs = sorted([ x for x in backup_list if x["backup_type"] == LOG and x["database_name"] == database_name
+                    and x["first_lsn"] is not None and x["last_lsn"] > lsn ], key=lambda x: (x["first_lsn"], x["last_lsn"]))
+    chain = []
+    for log in logs:
+        if log["first_lsn"] <= lsn < log["last_lsn"]:
+            chain.append(log)
+            lsn = log["last_lsn"]
+        elif log["first_lsn"] > lsn:
+            logger.debug("gap in log chain after lsn {}".format(lsn))
+            break
+    return chain
+
+
+def find_differential(backup_list, full, lsn):
+    """
+    Return a newest differential backup based on a full backup with data after lsn or None
+    """
+    diffs = [ x for x in backup_list if x["backup_type"] == DIFFERENTIAL and is_based_on(x, full) and x["last_lsn"] > lsn ]
+    if diffs:
+        return max(diffs, key=lambda x: x["last_lsn"])
+    return None
+
+
+def plan_from_full(backup_list, full):
+    """
+    Return a plan starting with full backup, followed by a newest differential and logs
+    """
+    plan = [ full ]
+    diff = find_differential(backup_list, full, full["last_lsn"])
+    if diff is not None:
+        plan.append(diff)
+    plan.extend(find_log_chain(backup_list, plan[-1]["last_lsn"], full["database_name"]))
+    return plan
+
+
+def plan_size(plan):
+    return sum([ x["backup_size"] or 0 for x in plan ])
+
+
+def newest_full(backup_list):
+    fulls = [ x for x in backup_list if x["backup_type"] == FULL ]
+    if fulls:
+        return max(fulls, key=lambda x: x["backup_start_date"])
+    return None
+
+
+def plan_resync(backup_list):
+    """
+    Return a plan for resync - from a newest full backup - or None if there is no full backup
+    """
+    full = newest_full(backup_list)
+    if full is None:
+        return None
+    return plan_from_full(backup_list, full)
+
+
+def plan_incremental(backup_list, state):
+    """
+    Return a plan to move restored database forward or None if there is nothing to restore
+    state is a saved information about last restore (see mssql_ctl.save_backup_info)
+
+    Candidates are:
+    - logs after last restored lsn
+    - newest differential based on current full backup followed by logs
+    - newer full backup followed by differential and logs
+    Plan which is moving database furthest is used, and if there is more than one,
+    plan with smallest backup size
+    """
+    if state.get("last_lsn") is None:
+        return plan_legacy(backup_list, state)
+
+    lsn = state["last_lsn"]
+    database_name = state["database_name"]
+    candidates = []
+
+    candidates.append(find_log_chain(backup_list, lsn, database_name))
+
+    if state.get("base_lsn") is not None:
+        base = { "checkpoint_lsn": state["base_lsn"] }
+        diff = find_differential(backup_list, base, lsn)
+        if diff is not None:
+            candidates.append([ diff ] + find_log_chain(backup_list, diff["last_lsn"], database_name))
+
+    for full in [ x for x in backup_list if x["backup_type"] == FULL and x["database_name"] == database_name
+                  and x["checkpoint_lsn"] > state.get("base_lsn") and x["last_lsn"] > lsn ]:
+        candidates.append(plan_from_full(backup_list, full))
+
+    candidates = [ x for x in candidates if x and x[-1]["last_lsn"] > lsn ]
+    if not candidates:
+        return None
+
+    end_lsn = max([ x[-1]["last_lsn"] for x in candidates ])
+    return min([ x for x in candidates if x[-1]["last_lsn"] == end_lsn ], key=plan_size)
+
+
+def plan_legacy(backup_list, state):
+    """
+    Plan for a state saved without LSN information - compare backup start dates
+    Newer full backup is used first, than newer differential, both followed by logs
+    """
+    logger.debug("no lsn in last restore information - using backup start date {}".format(state["backup"]))
+    newer = [ x for x in backup_list if x["backup_start_date"] > state["backup"] ]
+
+    full = newest_full(newer)
+    if full is not None:
+        return plan_from_full(backup_list, full)
+
+    diffs = [ x for x in newer if x["backup_type"] == DIFFERENTIAL ]
+    if diffs:
+        diff = max(diffs, key=lambda x: x["backup_start_date"])
+        return [ diff ] + find_log_chain(backup_list, diff["last_lsn"], diff["database_name"])
+
+    return None
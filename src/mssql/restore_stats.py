@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Parser of RESTORE ... WITH STATS output
+# Progress lines are logged as they are read from running restore
+# and parsed values are kept for a restore metrics summary
+
+import logging
+import re
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# 10 percent processed.
+match_percent = re.compile(r'^(\d+) percent processed\.')
+# Processed 328 pages for database 'db', file 'db' on file 1.
+match_file_pages = re.compile(r"^Processed (\d+) pages for database '[^']*', file '([^']*)' on file \d+\.")
+# RESTORE DATABASE successfully processed 330 pages in 0.052 seconds (49.466 MB/sec).
+match_summary = re.compile(r'^RESTORE (\w+) successfully processed (\d+) pages in ([\d.]+) seconds \(([\d.]+) MB/sec\)\.')
+
+
+class restore_progress(object):
+    """
+    Collect progress of one restore from sqlcmd output lines
+
+    progress = restore_progress(name)
+    db_object.run_db_command_progress("restore_full_backup", progress.feed, ...)
+    summary = progress.summary()
+    """
+
+    def __init__(self, name):
+        self.__name = name
+        self.__start = time.time()
+        self.__percent = None
+        self.__progress = []
+        self.__files = {}
+        self.__pages = None
+        self.__seconds = None
+        self.__mb_per_sec = None
+
+
+    def feed(self, line):
+        """
+        Parse one output line and log a progress record if line is a progress or summary line
+        """
+        elapsed = round(time.time() - self.__start, 1)
+
+        percent = re.search(match_percent, line)
+        if percent:
+            self.__percent = int(percent.group(1))
+            self.__progress.append((elapsed, self.__percent))
+            logger.info("restore {}: {} percent processed after {} s".format(self.__name, self.__percent, elapsed))
+            return
+
+        file_pages = re.search(match_file_pages, line)
+        if file_pages:
+            self.__files[file_pages.group(2)] = int(file_pages.group(1))
+            return
+
+        summary = re.search(match_summary, line)
+        if summary:
+            self.__pages = int(summary.group(2))
+            self.__seconds = float(summary.group(3))
+            self.__mb_per_sec = float(summary.group(4))
+            logger.info("restore {}: processed {} pages in {} s ({} MB/sec)".format(self.__name, self.__pages, self.__seconds, self.__mb_per_sec))
+
+
+    def summary(self):
+        """
+        Return a dictionary with parsed values - values not found in output are None
+        """
+        return {
+            "percent": self.__percent,
+            "pages": self.__pages,
+            "seconds": self.__seconds,
+            "mb_per_sec": self.__mb_per_sec,
+            "file_pages": self.__files,
+            "progress": self.__progress
+        }
@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2020 by Delphix. All rights reserved.
+#
+# Restore I/O tuning - BUFFERCOUNT, MAXTRANSFERSIZE and BLOCKSIZE options
+# for RESTORE DATABASE, set manually or sized automatically from
+# backup size, number of stripes and memory available on staging host
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT = "default"
+MANUAL = "manual"
+AUTO = "auto"
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+
+# SQL Server defaults are used for backups smaller than this
+AUTO_MIN_BACKUP_SIZE = 1 * GB
+
+# MAXTRANSFERSIZE for disk devices is 64 kB - 4 MB
+MAX_TRANSFER_SIZE = 4 * MB
+SMALL_TRANSFER_SIZE = 1 * MB
+
+# restore buffers are using up to 1/8 of available memory but not more than 2 GB
+MEMORY_FRACTION = 8
+MAX_BUFFER_MEMORY = 2 * GB
+# used if available memory can't be read from host
+DEFAULT_BUFFER_MEMORY = 512 * MB
+
+
+def manual_tuning(parameters):
+    """
+    Return tuning options set in dSource parameters - 0 or missing value is SQL Server default
+    """
+    tuning = {}
+    for (option, field) in [("buffer_count", "restore_buffer_count"),
+                            ("max_transfer_size", "restore_max_transfer_size"),
+                            ("block_size", "restore_block_size")]:
+        value = getattr(parameters, field, None)
+        if value:
+            tuning[option] = int(value)
+    return tuning
+
+
+def auto_tuning(backup_size, stripes, available_memory):
+    """
+    Return tuning options for backup set size (bytes), number of stripes (media families)
+    and memory available on host (bytes or None)
+
+    Every stripe is read by own reader thread, so number of buffers is growing with stripes
+    and backup size. Buffers (BUFFERCOUNT * MAXTRANSFERSIZE) have to fit into memory budget.
+    """
+    if not backup_size or backup_size < AUTO_MIN_BACKUP_SIZE:
+        logger.debug("backup size {} - using default restore options".format(backup_size))
+        return {}
+
+    stripes = max(1, stripes)
+    if available_memory:
+        budget = min(available_memory // MEMORY_FRACTION, MAX_BUFFER_MEMORY)
+    else:
+        budget = DEFAULT_BUFFER_MEMORY
+
+    if backup_size < 100 * GB:
+        buffers_per_stripe = 8
+    else:
+        buffers_per_stripe = 16
+
+    max_transfer_size = MAX_TRANSFER_SIZE
+    if budget // max_transfer_size < 2 * stripes:
+        max_transfer_size = SMALL_TRANSFER_SIZE
+
+    buffer_count = min(stripes * buffers_per_stripe, budget // max_transfer_size)
+    buffer_count = max(buffer_count, 2 * stripes)
+
+    tuning = {
+        "buffer_count": int(buffer_count),
+        "max_transfer_size": int(max_transfer_size)
+    }
+    logger.debug("auto tuning for size {} stripes {} memory {}: {}".format(backup_size, stripes, available_memory, tuning))
+    return tuning
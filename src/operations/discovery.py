@@ -8,6 +8,7 @@ import traceback
 
 from dlpx.virtualization.platform.exceptions import UserError
 from mssql.mssql_discovery import return_repository
+from mssql.mssql_discovery import return_source_config
 
 logger = logging.getLogger(__name__)
 
@@ -39,3 +40,31 @@ def find_repos(source_connection):
         logger.debug(tracebk.format_exc())
         UserError(message="Unhandled exception. Please contact Delphix", output=traceback.format_exc())
 
+
+def find_source_configs(source_connection, repository):
+    """
+    Run a discovery of databases in repository instance
+    Returns:
+        List of SourceConfigDefinition objects
+    """
+
+    try:
+
+        return return_source_config(source_connection, repository)
+
+    except UserError:
+        # pass lower code exception
+        ttype, value, tracebk = sys.exc_info()
+        logger.debug("General exception handing in find_source_configs")
+        logger.debug("type: {}, value: {}".format(ttype, value))
+        logger.debug("trackback")
+        logger.debug(traceback.format_exc())
+        raise
+
+    except Exception:
+        ttype, value, tracebk = sys.exc_info()
+        logger.debug("General exception handing in find_source_configs")
+        logger.debug("type: {}, value: {}".format(ttype, value))
+        logger.debug("trackback")
+        logger.debug(traceback.format_exc())
+        raise UserError("Unhandled exception in discovery of databases. Please contact Delphix", output=traceback.format_exc())
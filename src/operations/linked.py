@@ -10,6 +10,7 @@ from generated.definitions import SnapshotDefinition
 from dlpx.virtualization.platform import Mount, MountSpecification, Plugin, OwnershipSpecification
 from dlpx.virtualization.platform import Status
 from mssql.mssql_ctl import mssql_ctl
+from mssql import mssql_status
 from controller.plugin_exception import plugin_exception
 
 
@@ -41,21 +42,24 @@ def resync(staged_source, repository, source_config):
     db_object = mssql_ctl(staged_source=staged_source,
                           repository=repository, source_config=source_config)
 
-    # create required directories
-    db_object.create_staging_dirs()
-    # get backup
-    (backup_file, position, last_backup) = db_object.get_backup_file_to_restore(resync=True)
+    with db_object.sqlcmd_session():
+        # create required directories
+        db_object.create_staging_dirs()
+        # get list of backups to restore - full, differential and logs
+        plan = db_object.get_restore_plan(resync=True)
 
-    if db_object.db_exist():
-        # if staging database exists, drop and resore from backup
-        db_object.drop_db()
-        db_object.restore_database_from_backup(backup_file, position)
-    else:
-        # if staging database doesn't exist, resore from backup
-        db_object.restore_database_from_backup(backup_file, position)
+        # steps finished by interrupted resync with same plan are skipped
+        journal = db_object.create_journal("resync", db_object.get_plan_inputs(plan))
 
-    # save additional information into JSON file to use them in post_snapshot
-    db_object.save_backup_info(last_backup, backup_file, position)
+        # staging database is dropped only by resync started from scratch - drop_db step is saved
+        # even if there was no database, so database restored by interrupted resync is never dropped
+        if not journal.pending():
+            journal.run("drop_db", db_object.drop_db_if_exist)
+        db_object.restore_backup_plan(plan, journal=journal)
+
+        # save additional information into JSON file to use them in post_snapshot
+        db_object.save_backup_info(plan)
+        journal.finish()
 
 
 def pre_snapshot(staged_source, repository, source_config):
@@ -67,20 +71,22 @@ def pre_snapshot(staged_source, repository, source_config):
     # create an object of database
     db_object = mssql_ctl(staged_source=staged_source,
                           repository=repository, source_config=source_config)
-    # create required directories
-    db_object.create_staging_dirs()
-    # get backup
-    (backup_file, position, last_backup) = db_object.get_backup_file_to_restore(resync=False)
+    with db_object.sqlcmd_session():
+        # create required directories
+        db_object.create_staging_dirs()
+        # get list of backups to restore after last restored one
+        last_backup = db_object.load_last_backup()
+        plan = db_object.get_restore_plan(resync=False, last_backup=last_backup)
 
-    if db_object.db_exist():
-        # if staging database doesn't exist, resore from backup
-        db_object.restore_database_from_backup(backup_file, position)
-    else:
-        # add code to handle what to do if stating database doesn't exist
-        pass
+        if db_object.db_exist():
+            # if staging database doesn't exist, resore from backup
+            db_object.restore_backup_plan(plan, last_backup)
+        else:
+            # add code to handle what to do if stating database doesn't exist
+            pass
 
-    # save additional information into JSON file to use them in post_snapshot
-    db_object.save_backup_info(last_backup, backup_file, position)
+        # save additional information into JSON file to use them in post_snapshot
+        db_object.save_backup_info(plan, last_backup)
 
 
 def post_snapshot(staged_source, repository, source_config):
@@ -99,7 +105,9 @@ def post_snapshot(staged_source, repository, source_config):
         # read data from JSON to get backup info
         last_backup = db_object.load_last_backup()
         # define snapshot
-        snap = SnapshotDefinition(db_files=list_of_dbfile, backup_time=last_backup["backup"])
+        # staging database is in standby mode, so files can't be attached
+        snap = SnapshotDefinition(db_files=list_of_dbfile, backup_time=last_backup["backup"],
+                                  mssql_version=repository.version, attachable=False)
         logger.debug(snap)
         # return snapshot object
         return snap
@@ -120,14 +128,14 @@ def staging_status(staged_source, repository, source_config):
     statgin_status check a status of the staging
     """
     try:
-        # create an object of database
-        db_object = mssql_ctl(staged_source=staged_source,
-                              repository=repository, source_config=source_config)
-        # check status of the VDB using SQL from db commands
-        status = db_object.check_vdb()
-        logger.debug("Value of status variable is #{}#".format(status))
+        # check status of the staging database - database in standby mode is running as well
+        parameters = staged_source.parameters
+        status = mssql_status.probe_status(staged_source.staged_connection, repository,
+                                           parameters.instance_user, parameters.instance_password,
+                                           "{}_staging".format(source_config.database_name))
+        logger.debug("Value of status variable is #{}#".format(status.state))
         # compare status from SQL command and return status from Status class
-        if status == "ONLINE":
+        if status.active:
             logger.debug("Staging database status is:  {}".format("ACTIVE"))
             return Status.ACTIVE
         else:
@@ -155,7 +163,8 @@ def start_staging(staged_source, repository, source_config):
         db_object = mssql_ctl(staged_source=staged_source,
                               repository=repository, source_config=source_config)
         # start staging server
-        db_object.start_staging()
+        with db_object.sqlcmd_session():
+            db_object.start_staging()
     except Exception:
         ttype, value, traceb = sys.exc_info()
         logger.debug("General exception handing in virtual.stop_vdb")
@@ -176,7 +185,8 @@ def stop_staging(staged_source, repository, source_config):
         db_object = mssql_ctl(staged_source=staged_source,
                               repository=repository, source_config=source_config)
         # stop staging server
-        db_object.stop_staging()
+        with db_object.sqlcmd_session():
+            db_object.stop_staging()
     except Exception:
         ttype, value, traceb = sys.exc_info()
         logger.debug("General exception handing in virtual.stop_vdb")
@@ -16,6 +16,7 @@ from dlpx.virtualization.platform import Mount, MountSpecification, Plugin, Owne
 from dlpx.virtualization.platform.exceptions import UserError
 from dlpx.virtualization.platform import Status
 from mssql.mssql_ctl import mssql_ctl
+from mssql import mssql_status
 
 logger = logging.getLogger(__name__)
 
@@ -50,17 +51,19 @@ def configure(virtual_source, snapshot, repository):
     db_object = mssql_ctl(virtual_source=virtual_source,
                           repository=repository, snapshot=snapshot)
 
-    # create required directories
-    db_object.create_staging_dirs()
+    with db_object.sqlcmd_session():
+        # create required directories
+        db_object.create_staging_dirs()
 
-    # check if database already exist
-    if db_object.db_exist():
-        # raise a User Error and stop a job
-        raise UserError("DB with name {} exist in instance. Can't provision VDB.".format(
-            db_object.get_db_name()))
-    else:
-        # call method to create a new VDB
-        db_object.create_vdb()
+        # check if database already exist
+        # (it can be a seed database left by interrupted provision which is continued)
+        if db_object.db_exist() and not db_object.create_vdb_pending():
+            # raise a User Error and stop a job
+            raise UserError("DB with name {} exist in instance. Can't provision VDB.".format(
+                db_object.get_db_name()))
+        else:
+            # call method to create a new VDB - attach snapshot files or use a seed database
+            db_object.provision_vdb()
 
     # define source config data and return it to save inside Delphix
     sourceconfig = SourceConfigDefinition(
@@ -82,8 +85,10 @@ def post_snapshot(virtual_source, repository, source_config):
         # get information to save inside snapshot
         # schema depended 
         list_of_dbfile = db_object.get_file_list()
+        # files of online VDB can be attached on provision
+        attachable = db_object.check_vdb() == "ONLINE"
         # Create snapshot definition 
-        snap = SnapshotDefinition(db_files=list_of_dbfile)
+        snap = SnapshotDefinition(db_files=list_of_dbfile, mssql_version=repository.version, attachable=attachable)
         logger.debug(snap)
         return snap
 
@@ -131,14 +136,13 @@ def vdb_status(virtual_source, repository, source_config):
     vdb_status check a status of the VDB
     """
     try:
-        # create an object of database
-        db_object = mssql_ctl(virtual_source=virtual_source,
-                              repository=repository, source_config=source_config)
-
-        # status returned should be ONLINE or OFFLINE
-        status = db_object.check_vdb()
-        logger.debug("Value of status variable is: {}".format(status))
-        if status == "ONLINE":
+        # check status of the VDB - read only VDB is running as well
+        parameters = virtual_source.parameters
+        status = mssql_status.probe_status(virtual_source.connection, repository,
+                                           parameters.instance_user, parameters.instance_password,
+                                           parameters.database_name)
+        logger.debug("Value of status variable is: {}".format(status.state))
+        if status.active:
             return Status.ACTIVE
         else:
             return Status.INACTIVE
@@ -191,18 +195,19 @@ def reconfigure(virtual_source, repository, source_config, snapshot):
     db_object = mssql_ctl(virtual_source=virtual_source, repository=repository,
                           snapshot=snapshot, source_config=source_config)
 
-    # create required directories
-    db_object.create_staging_dirs()
+    with db_object.sqlcmd_session():
+        # create required directories
+        db_object.create_staging_dirs()
 
-    # check if database already exist
-    if db_object.db_exist():
-        # raise error is yes
-        # potential handling should be here as well
-        raise UserError("DB with name {} exist in instance. Can't provision VDB.".format(
-            db_object.get_db_name()))
-    else:
-        # recreate VDB after rewind
-        db_object.attach_vdb()
+        # check if database already exist
+        if db_object.db_exist():
+            # raise error is yes
+            # potential handling should be here as well
+            raise UserError("DB with name {} exist in instance. Can't provision VDB.".format(
+                db_object.get_db_name()))
+        else:
+            # recreate VDB after rewind
+            db_object.attach_vdb()
 
     # create a new source config object
     sourceconfig = SourceConfigDefinition(
@@ -220,18 +225,25 @@ def unconfigure(virtual_source, repository, source_config):
     db_object = mssql_ctl(virtual_source=virtual_source,
                           repository=repository, source_config=source_config)
 
-    if db_object.db_exist():
-        # we can't delete as this will delete data
-        # just detach is enough as data files are needed to enable
-        db_object.detach_db()
-    else:
-        logger.debug("Database doesn't exist in instance - good to go")
+    with db_object.sqlcmd_session():
+        if db_object.db_exist():
+            # we can't delete as this will delete data
+            # just detach is enough as data files are needed to enable
+            db_object.detach_db()
+        else:
+            logger.debug("Database doesn't exist in instance - good to go")
+        # steps of interrupted provision can't be continued without database
+        db_object.remove_journal("create_vdb")
 
 
 def pre_snapshot(virtual_source, repository, source_config):
     """
     pre_snapshot operation run before snapshot of VDB
-    potenial flush / sync operations for VDB should be implemented here
+    VDB is checkpointed, so snapshot files are attached by provision with little to recover
     """
     logger.info("In virtual pre_snapshot")
+
+    db_object = mssql_ctl(virtual_source=virtual_source,
+                          repository=repository, source_config=source_config)
+    db_object.checkpoint_vdb()
     